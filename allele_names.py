@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+型别名称解析：把队列中各种写法的型别名映射到 hla_exon_sequences.fasta 中的 4-digit 名称。
+
+dat_parse_debug.py 只保留前两个字段（A*02:01），而导出的基因型常见的写法有：
+    HLA-A*02:01:01:02   带 HLA- 前缀、6/8 位高分辨率
+    A*02:01:01G         G 组（以组内第一个型别命名，前两个字段即 4-digit 名称）
+    A*02:01P            P 组
+    A*01:147:01Q        带表达后缀，fasta 中为 A*01:147Q
+    a*02:01 / " A*02:01 "  大小写、空白
+null（N 结尾）型别不表达，fasta 中不存在，始终报告为无法解析。
+
+AlleleResolver 由序列存储一次性构建 {(locus, 字段1, 字段2): fasta 名称} 的哈希索引，
+每个不同的输入字符串只解析一次（memoize），百万行队列中只需处理去重后的名称。
+"""
+
+import re
+from collections import Counter
+
+import pandas as pd
+
+# 表达后缀：N null, L low, S secreted, C cytoplasm, A aberrant, Q questionable
+EXPRESSION_SUFFIXES = "NLSCAQ"
+GROUP_SUFFIXES = "GP"
+_NAME_RE = re.compile(r"^([A-Z0-9]+)\*(\d+(?::\d+)*)([A-Z]?)$")
+
+
+def split_allele_name(name):
+    """将名称拆为 (locus, 字段列表, 后缀)，无法识别时返回 None"""
+    name = name.strip().upper()
+    if name.startswith("HLA-"):
+        name = name[4:]
+    m = _NAME_RE.match(name)
+    if not m:
+        return None
+    return m.group(1), m.group(2).split(":"), m.group(3)
+
+
+class AlleleResolver:
+    """
+    将任意写法的型别名解析为 fasta 中的名称。
+
+    resolve(name) 返回 (fasta 名称或 None, 无法解析的原因或 None)，结果按输入字符串缓存；
+    resolve_many(values) 对整列批量解析，并累计无法解析的名称及其出现次数（unresolved）。
+    """
+
+    def __init__(self, alleles):
+        alleles = list(alleles)
+        self.alleles = set(alleles)
+        self.index = {}
+        for allele in alleles:
+            parts = split_allele_name(allele)
+            if parts and len(parts[1]) >= 2:
+                locus, fields, _ = parts
+                # 同一 4-digit 名称若同时存在带后缀和不带后缀的写法，优先不带后缀的
+                key = (locus, fields[0], fields[1])
+                if key not in self.index or self.index[key] != f"{locus}*{fields[0]}:{fields[1]}":
+                    self.index[key] = allele
+        self.memo = {}
+        self.unresolved = Counter()
+        self.reasons = {}
+
+    def resolve(self, name):
+        if name in self.memo:
+            return self.memo[name]
+        self.memo[name] = result = self._resolve(name)
+        return result
+
+    def _resolve(self, name):
+        if name in self.alleles:
+            return name, None
+        parts = split_allele_name(name)
+        if parts is None:
+            return None, "无法识别的格式"
+        locus, fields, suffix = parts
+        if suffix == "N":
+            return None, "null 型别（不表达）"
+        if suffix and suffix not in EXPRESSION_SUFFIXES + GROUP_SUFFIXES:
+            return None, f"未知后缀 {suffix}"
+        if len(fields) < 2:
+            return None, "分辨率不足（只有一个字段）"
+
+        allele = self.index.get((locus, fields[0], fields[1]))
+        if allele is None:
+            return None, "fasta 中没有对应的 4-digit 型别"
+        return allele, None
+
+    def resolve_many(self, values):
+        """批量解析一列名称，返回 object 数组；缺失值保持为 None，无法解析的名称为 None 并计入 unresolved"""
+        values = pd.Series(values, dtype=object)
+        present = values.notna()
+        names = values[present].astype(str)
+        unique_names = names.unique()
+        for name in unique_names:
+            if name not in self.memo:
+                self.resolve(name)
+        lookup = {name: self.memo[name][0] for name in unique_names}
+
+        resolved = pd.Series(None, index=values.index, dtype=object)
+        resolved[present] = names.map(lookup)
+        failed = names[resolved[present].isna()]
+        if len(failed):
+            counts = failed.value_counts()
+            self.unresolved.update(counts.to_dict())
+            for name in counts.index:
+                self.reasons[name] = self.memo[name][1]
+        return resolved.to_numpy(dtype=object)
+
+    def report(self, limit=20, path=None):
+        """打印无法解析的名称（按出现次数排序）；提供 path 时把全部名称写入 TSV"""
+        if not self.unresolved:
+            print("✅ 所有型别名称均已解析")
+            return
+        total = sum(self.unresolved.values())
+        print(f"⚠️ {len(self.unresolved)} 个不同的型别名称无法解析（共 {total} 次）:")
+        for name, count in self.unresolved.most_common(limit):
+            print(f"  {name:<24} {count:>8}  {self.reasons[name]}")
+        if len(self.unresolved) > limit:
+            print(f"  ... 另有 {len(self.unresolved) - limit} 个")
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("name\tcount\treason\n")
+                for name, count in self.unresolved.most_common():
+                    f.write(f"{name}\t{count}\t{self.reasons[name]}\n")
+            print(f"完整列表已写入 {path}")
+
+
+def normalizing_hed_fn(hed_fn, resolver):
+    """包装 hed_fn：先把两列型别名解析为 fasta 名称再计算"""
+    def wrapped(alleles1, alleles2):
+        return hed_fn(resolver.resolve_many(alleles1), resolver.resolve_many(alleles2))
+    return wrapped
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+可复现的性能基准：dat 解析、序列加载、批量 HED 计算与命令行冷启动延迟。
+
+所有输入均由固定随机种子合成：
+    - 队列：从 hla_exon_sequences.fasta 中按位点随机抽取同位点的两个型别（1k ~ 10M 行）
+    - hla.dat：复制 data/test1.dat 中的 record，改写 accession 与型别名使其互不重复
+
+结果写入 JSON 文件；提供 --baseline 时与上一次的结果比较，任何一项吞吐下降超过
+--tolerance 时以非零状态码退出，方便在提交之间发现性能回退。
+--max-startup 为单对查询（compute_HED_pairewise.py 新进程）的冷启动延迟设置绝对上限。
+
+    python benchmark_hed.py -o bench.json
+    python benchmark_hed.py -o bench_new.json --baseline bench.json
+"""
+
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+import numpy as np
+
+from compute_HED import calculate_hed_batch, encode_allele_sequences, load_allele_sequences
+from dat_parse_debug import iter_dat_records, parse_hla_dat_4res
+from seq_store import load_sequence_store
+
+DEFAULT_ROWS = "1000,100000,1000000"
+BENCH_LOCI = ["A", "B", "C", "DRB1", "DQB1", "DQA1", "DPB1", "DPA1"]
+STARTUP_PAIR = ("A*02:01", "A*01:01")
+
+
+# ------------------ 合成数据 ------------------
+def generate_cohort(store, n_rows, seed=0, loci=BENCH_LOCI):
+    """
+    合成 n_rows 行基因型：每行先均匀抽取位点，再在该位点内均匀抽取两个型别。
+    返回 (alleles1, alleles2) 两个 object 数组。
+    """
+    rng = np.random.default_rng(seed)
+    alleles = np.array(store.alleles, dtype=object)
+    locus_of = np.array(store.loci, dtype=object)
+    members = [np.flatnonzero(locus_of == locus) for locus in loci]
+    members = [m for m in members if len(m)]
+
+    row_locus = rng.integers(len(members), size=n_rows)
+    idx1 = np.empty(n_rows, dtype=np.int64)
+    idx2 = np.empty(n_rows, dtype=np.int64)
+    for k, m in enumerate(members):
+        rows = np.flatnonzero(row_locus == k)
+        idx1[rows] = m[rng.integers(len(m), size=len(rows))]
+        idx2[rows] = m[rng.integers(len(m), size=len(rows))]
+    return alleles[idx1], alleles[idx2]
+
+
+def write_cohort_tsv(path, alleles1, alleles2):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("id\tallele1\tallele2\n")
+        for i, (a1, a2) in enumerate(zip(alleles1, alleles2)):
+            f.write(f"S{i}\t{a1}\t{a2}\n")
+
+
+def generate_dat(template_path, n_records, output_path):
+    """
+    以 template_path 中的 record 为模板循环复制出 n_records 条 record，
+    accession 改为 HLB{i:06d}，型别名的第二、三个字段改写为唯一值，解析结果不会被去重。
+    """
+    templates = []
+    for lines in iter_dat_records(template_path):
+        text = "\n".join(lines)
+        accession = re.search(r"^AC   (\w+);", text, re.M).group(1)
+        allele = re.search(r"^DE   HLA-(\S+?),", text, re.M).group(1)
+        templates.append((text, accession, allele))
+
+    with open(output_path, "w", encoding="utf-8") as f:
+        for i in range(n_records):
+            text, accession, allele = templates[i % len(templates)]
+            gene = allele.split("*")[0]
+            new_allele = f"{gene}*{i // 10000 + 1:02d}:{i % 10000 + 1:04d}"
+            f.write(text.replace(accession, f"HLB{i:06d}").replace(f"HLA-{allele}", f"HLA-{new_allele}"))
+            f.write("\n//\n")
+
+
+# ------------------ 计时 ------------------
+def time_call(fn, repeat):
+    """运行 repeat 次，返回 (最短耗时, 中位耗时, 最后一次的返回值)"""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings), float(np.median(timings)), result
+
+
+def record(results, name, seconds, median, items, unit):
+    results[name] = {
+        "seconds": seconds,
+        "median_seconds": median,
+        "items": items,
+        "rate": items / seconds if seconds > 0 else float("inf"),
+        "unit": unit,
+    }
+    print(f"  {name:<28} {seconds:9.4f} s   {results[name]['rate']:>14,.0f} {unit}")
+
+
+def bench_parse(results, dat_template, n_records, workers, repeat, tmp_dir):
+    dat_path = os.path.join(tmp_dir, "synthetic.dat")
+    generate_dat(dat_template, n_records, dat_path)
+    seconds, median, mapping = time_call(lambda: parse_hla_dat_4res(dat_path, workers=workers, quiet=True), repeat)
+    record(results, f"parse_hla_dat_4res[{n_records}]", seconds, median, n_records, "records/s")
+    return mapping
+
+
+def bench_load(results, fasta_path, repeat, tmp_dir):
+    """冷启动：每次都重新编译序列存储；热启动：直接 mmap 已编译的存储"""
+    fasta_copy = os.path.join(tmp_dir, "sequences.fasta")
+    shutil.copyfile(fasta_path, fasta_copy)
+    store_path = os.path.join(tmp_dir, "sequences.hedstore")
+
+    def cold():
+        if os.path.exists(store_path):
+            os.unlink(store_path)
+        return load_sequence_store(fasta_copy, store_path)
+
+    seconds, median, store = time_call(cold, repeat)
+    record(results, "load_allele_sequences[cold]", seconds, median, len(store), "alleles/s")
+    seconds, median, store = time_call(lambda: load_allele_sequences(fasta_copy), repeat)
+    record(results, "load_allele_sequences[warm]", seconds, median, len(store), "alleles/s")
+    return store
+
+
+def bench_startup(results, fasta_path, repeat):
+    """
+    冷启动延迟：每次在新的 Python 进程中完成一次单对查询（序列存储已编译），
+    以及 compute_HED.py --help。返回单对查询的最短耗时（秒）。
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    load_sequence_store(fasta_path)  # 先编译好存储，只测量进程启动与查询本身
+    env = {k: v for k, v in os.environ.items() if k != "HED_SERVER"}
+    commands = {
+        "startup[pairwise]": [sys.executable, os.path.join(here, "compute_HED_pairewise.py"),
+                              *STARTUP_PAIR, "--fasta", fasta_path],
+        "startup[compute_HED --help]": [sys.executable, os.path.join(here, "compute_HED.py"), "--help"],
+    }
+    latency = {}
+    for name, command in commands.items():
+        seconds, median, _ = time_call(
+            lambda: subprocess.run(command, check=True, stdout=subprocess.DEVNULL, env=env), repeat)
+        record(results, name, seconds, median, 1, "starts/s")
+        latency[name] = seconds
+    return latency["startup[pairwise]"]
+
+
+def bench_hed(results, store, row_counts, repeat, seed):
+    encoded = encode_allele_sequences(store)
+    # 不计时的预热：calculate_hed_batch 第一次调用时才延迟导入 pandas，不应计入第一个行数档位
+    calculate_hed_batch(encoded, *generate_cohort(store, 100, seed))
+    for n_rows in row_counts:
+        alleles1, alleles2 = generate_cohort(store, n_rows, seed)
+        seconds, median, _ = time_call(lambda: calculate_hed_batch(encoded, alleles1, alleles2), repeat)
+        record(results, f"calculate_hed_batch[{n_rows}]", seconds, median, n_rows, "rows/s")
+
+
+# ------------------ 结果与回归比较 ------------------
+def environment_info():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit or None,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """返回吞吐下降超过 tolerance 的项目列表，同时打印每一项的变化"""
+    regressions = []
+    print(f"\n与基线比较（基线提交: {baseline['environment'].get('commit')}，容忍度 {tolerance:.0%}）:")
+    for name, current in results.items():
+        previous = baseline["benchmarks"].get(name)
+        if previous is None:
+            print(f"  {name:<28} 基线中不存在，跳过")
+            continue
+        ratio = current["rate"] / previous["rate"]
+        if ratio < 1 - tolerance:
+            flag = "❌ 回退"
+            regressions.append(name)
+        elif ratio > 1 + tolerance:
+            flag = "🚀 提升"
+        else:
+            flag = "持平"
+        print(f"  {name:<28} {ratio:6.2f}x  {flag}")
+    return regressions
+
+
+@click.command()
+@click.option('--fasta', '-f', default="./data/hla_exon_sequences.fasta", help='包含型别氨基酸序列的 fasta 文件')
+@click.option('--dat-template', default="./data/test1.dat", help='合成 hla.dat 时使用的模板 record')
+@click.option('--dat-records', type=int, default=2000, show_default=True, help='合成 hla.dat 的 record 数')
+@click.option('--rows', default=DEFAULT_ROWS, show_default=True, help='批量 HED 基准的队列行数（逗号分隔）')
+@click.option('--workers', '-w', type=int, default=1, show_default=True, help='解析 dat 的进程数')
+@click.option('--repeat', '-r', type=int, default=3, show_default=True, help='每项重复次数，取最短耗时')
+@click.option('--seed', type=int, default=0, show_default=True, help='合成队列的随机种子')
+@click.option('--output', '-o', default="benchmark_results.json", show_default=True, help='结果 JSON 文件')
+@click.option('--baseline', default=None, help='上一次的结果 JSON，吞吐下降超过容忍度时以状态码 1 退出')
+@click.option('--tolerance', type=float, default=0.2, show_default=True, help='允许的相对吞吐下降')
+@click.option('--write-cohort', default=None, help='将最大的合成队列写入该 TSV，供 compute_HED.py 端到端测试')
+@click.option('--max-startup', type=float, default=None,
+              help='单对查询冷启动延迟的上限（秒），超出时以状态码 1 退出')
+def main(fasta, dat_template, dat_records, rows, workers, repeat, seed, output, baseline, tolerance, write_cohort,
+         max_startup):
+    row_counts = [int(x) for x in rows.split(",") if x.strip()]
+    results = {}
+
+    with tempfile.TemporaryDirectory(prefix="hed_bench_") as tmp_dir:
+        print("⏱  基准测试:")
+        bench_parse(results, dat_template, dat_records, workers, repeat, tmp_dir)
+        store = bench_load(results, fasta, repeat, tmp_dir)
+        bench_hed(results, store, row_counts, repeat, seed)
+        startup = bench_startup(results, fasta, repeat)
+        if write_cohort:
+            write_cohort_tsv(write_cohort, *generate_cohort(store, max(row_counts), seed))
+            print(f"合成队列已写入 {write_cohort}")
+
+    report = {
+        "environment": environment_info(),
+        "parameters": {"dat_records": dat_records, "rows": row_counts, "workers": workers,
+                       "repeat": repeat, "seed": seed},
+        "benchmarks": results,
+    }
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n结果已写入 {output}")
+
+    failed = False
+    if max_startup is not None:
+        if startup > max_startup:
+            print(f"❌ 单对查询冷启动 {startup:.3f} s，超过上限 {max_startup:.3f} s")
+            failed = True
+        else:
+            print(f"✅ 单对查询冷启动 {startup:.3f} s（上限 {max_startup:.3f} s）")
+    if baseline:
+        with open(baseline, encoding="utf-8") as f:
+            regressions = compare_with_baseline(results, json.load(f), tolerance)
+        if regressions:
+            print(f"❌ {len(regressions)} 项性能回退: {', '.join(regressions)}")
+            failed = True
+        else:
+            print("✅ 没有性能回退")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
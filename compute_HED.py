@@ -1,104 +1,403 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import pandas as pd
-from Bio import SeqIO
 import click
 import numpy as np
 
-# ------------------ Grantham Distance Matrix ------------------
-AA_LIST = ['A', 'R', 'N', 'D', 'C', 'Q', 'E', 'G', 'H', 'I',
-           'L', 'K', 'M', 'F', 'P', 'S', 'T', 'W', 'Y', 'V']
-
-GRANTHAM_MATRIX = [
-    [0,112,111,126,195, 91,107, 60, 86, 94, 96,106, 84,113, 27, 99, 58,148,112, 64],
-    [112,  0, 86, 96,180, 43, 54,125, 29, 97,102, 26, 91, 97,103,110, 71,101, 77, 96],
-    [111, 86,  0, 23,139, 46, 42, 80, 68,149,153, 94,142,160, 91, 46, 65,174,143,133],
-    [126, 96, 23,  0,154, 61, 45, 94, 81,168,172,101,160,177,108, 65, 85,181,160,152],
-    [195,180,139,154,  0,154,170,159,174,198,198,202,196,205,169,112,149,215,194,192],
-    [ 91, 43, 46, 61,154,  0, 29, 87, 24,109,113, 53,101,116, 76, 68, 42,130, 99, 96],
-    [107, 54, 42, 45,170, 29,  0, 98, 40,134,138, 56,126,152, 93, 80, 65,181,140,121],
-    [ 60,125, 80, 94,159, 87, 98,  0, 98,135,138,127,127,153, 42, 56, 59,184,147,109],
-    [ 86, 29, 68, 81,174, 24, 40, 98,  0, 94, 99, 32, 87,100, 77, 89, 47,115, 83, 84],
-    [ 94, 97,149,168,198,109,134,135, 94,  0,  5,102, 10, 21, 95,142, 89, 61, 33, 29],
-    [ 96,102,153,172,198,113,138,138, 99,  5,  0,107, 21, 22, 98,145, 92, 61, 36, 32],
-    [106, 26, 94,101,202, 53, 56,127, 32,102,107,  0, 95,103,103,121, 78,110, 85, 97],
-    [ 84, 91,142,160,196,101,126,127, 87, 10, 21, 95,  0, 28, 87,135, 81, 84, 36, 21],
-    [113, 97,160,177,205,116,152,153,100, 21, 22,103, 28,  0,114,155,103, 40, 22, 50],
-    [ 27,103, 91,108,169, 76, 93, 42, 77, 95, 98,103, 87,114,  0, 74, 38,147,110, 68],
-    [ 99,110, 46, 65,112, 68, 80, 56, 89,142,145,121,135,155, 74,  0, 58,177,144,124],
-    [ 58, 71, 65, 85,149, 42, 65, 59, 47, 89, 92, 78, 81,103, 38, 58,  0,128, 92, 69],
-    [148,101,174,181,215,130,181,184,115, 61, 61,110, 84, 40,147,177,128,  0, 37, 88],
-    [112, 77,143,160,194, 99,140,147, 83, 33, 36, 85, 36, 22,110,144, 92, 37,  0, 55],
-    [ 64, 96,133,152,192, 96,121,109, 84, 29, 32, 97, 21, 50, 68,124, 69, 88, 55,  0]
-]
-
-GRANTHAM = {(AA_LIST[i], AA_LIST[j]): GRANTHAM_MATRIX[i][j] for i in range(20) for j in range(20)}
-
-# ------------------ HED计算函数 ------------------
-def grantham_distance(a1, a2):
-    return 0 if a1 == a2 else GRANTHAM.get((a1, a2), 0)
-
-# def calculate_hed(s1, s2):
-#     if len(s1) != len(s2):
-#         raise ValueError(f"Length mismatch: {len(s1)} vs {len(s2)}")
-#     return sum(grantham_distance(a, b) for a, b in zip(s1, s2)) / 2.2
-def calculate_hed(s1, s2):
-    if len(s1) != len(s2):
-        raise ValueError(f"Length mismatch: {len(s1)} vs {len(s2)}")
-    total = sum(grantham_distance(a, b) for a, b in zip(s1, s2))
-    return total / len(s1)  # 注意这里是除以长度，不是 2.2
+# pandas 只在读写表格时才需要，在各函数内延迟导入：只用到向量化引擎的调用方以及 --help 不必为此付出启动时间
+from seq_store import SequenceStore, load_sequence_store
+from distance_kernels import AA_LIST, GRANTHAM_MATRIX, stacked_kernel_tables
+# 标量实现已移至 distance_kernels.py，这里重新导出，保持 from compute_HED import calculate_hed 等旧用法可用
+from distance_kernels import GRANTHAM, calculate_hed, grantham_distance  # noqa: F401
+
+# ------------------ 向量化 HED 引擎 ------------------
+# 残基编码：20 种标准氨基酸编码为 0-19，其余字符（X、* 等）统一编码为 20，
+# 与 grantham_distance 对未知残基返回 0 的行为保持一致
+UNKNOWN_CODE = len(AA_LIST)
+AA_INDEX = {aa: i for i, aa in enumerate(AA_LIST)}
+
+_ASCII_TO_CODE = np.full(256, UNKNOWN_CODE, dtype=np.uint8)
+for _aa, _i in AA_INDEX.items():
+    _ASCII_TO_CODE[ord(_aa)] = _i
+
+# 21x21 查找表，最后一行/列为未知残基，距离恒为 0
+GRANTHAM_TABLE = np.zeros((UNKNOWN_CODE + 1, UNKNOWN_CODE + 1), dtype=np.int32)
+GRANTHAM_TABLE[:UNKNOWN_CODE, :UNKNOWN_CODE] = GRANTHAM_MATRIX
+
+HED_CHUNK_SIZE = 65536
+# 多距离核计算时每块的配对数更小：中间结果为 (配对数, 长度, 距离核数) 的 float64
+DISTANCE_CHUNK_SIZE = 8192
+
+
+def encode_sequence(seq):
+    """将氨基酸序列编码为 uint8 残基索引数组"""
+    return _ASCII_TO_CODE[np.frombuffer(seq.encode("ascii"), dtype=np.uint8)]
+
+
+def encode_allele_sequences(allele_seqs):
+    """
+    将 {allele: seq} 一次性编码为定宽残基矩阵。
+
+    外显子蛋白序列完全相同的型别很常见，因此只为每条唯一序列保留一行，
+    index 把型别直接映射到唯一序列的行号，后续的去重、查表和缓存都在唯一序列上进行。
+
+    返回:
+        dict: {
+            "alleles": 型别名称列表,
+            "sequence_ids": int64 数组，每个型别对应的唯一序列行号（与 alleles 对应）,
+            "index": {allele: 唯一序列行号},
+            "residues": uint8 矩阵 (n_sequences, max_len)，不足部分以 UNKNOWN_CODE 填充,
+            "lengths": int32 数组，每条唯一序列的长度,
+        }
+    """
+    if isinstance(allele_seqs, SequenceStore):
+        return _encode_sequence_store(allele_seqs)
+
+    alleles = list(allele_seqs.keys())
+    unique = {}
+    sequence_ids = np.array([unique.setdefault(allele_seqs[a], len(unique)) for a in alleles], dtype=np.int64)
+    lengths = np.array([len(seq) for seq in unique], dtype=np.int32)
+    max_len = int(lengths.max()) if len(unique) else 0
+    residues = np.full((len(unique), max_len), UNKNOWN_CODE, dtype=np.uint8)
+    for i, seq in enumerate(unique):
+        residues[i, :lengths[i]] = encode_sequence(seq)
+    return {
+        "alleles": alleles,
+        "sequence_ids": sequence_ids,
+        "index": dict(zip(alleles, sequence_ids.tolist())),
+        "residues": residues,
+        "lengths": lengths,
+    }
+
+
+def _encode_sequence_store(store):
+    """直接从序列存储的连续残基缓冲区编码，无需逐条解码字符串"""
+    sequence_ids = np.array(store.sequence_ids, dtype=np.int64)
+    # 每条唯一序列取其第一个型别在缓冲区中的位置
+    _, first = np.unique(sequence_ids, return_index=True)
+    lengths = np.frombuffer(store.lengths, dtype=np.int32)[first]
+    starts = np.frombuffer(store.offsets, dtype=np.int64)[first]
+    max_len = int(lengths.max()) if len(lengths) else 0
+    residues = np.full((len(lengths), max_len), UNKNOWN_CODE, dtype=np.uint8)
+
+    buffer = np.frombuffer(store.residue_buffer(), dtype=np.uint8)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    cols = np.arange(int(lengths.sum())) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    residues[rows, cols] = _ASCII_TO_CODE[buffer[np.repeat(starts, lengths) + cols]]
+    return {
+        "alleles": store.alleles,
+        "sequence_ids": sequence_ids,
+        "index": dict(zip(store.alleles, store.sequence_ids)),
+        "residues": residues,
+        "lengths": lengths,
+    }
+
+
+def sequence_digests(encoded):
+    """每条唯一序列的 sha1（基于残基编码），作为与 fasta 版本、型别命名无关的缓存键"""
+    import hashlib
+
+    return [hashlib.sha1(row[:length].tobytes()).hexdigest()
+            for row, length in zip(encoded["residues"], encoded["lengths"].tolist())]
+
+
+def lookup_allele_indices(encoded, alleles):
+    """将型别名称映射为唯一序列的行号，不存在（或缺失值）的型别返回 -1"""
+    import pandas as pd
+
+    return pd.Series(alleles, dtype=object).map(encoded["index"]).fillna(-1).to_numpy(np.int64)
+
+
+def unique_allele_pairs(idx1, idx2):
+    """
+    把逐行的 (idx1, idx2) 折叠为无序唯一配对。
+
+    返回:
+        (rows, u1, u2, inverse): rows 为两个型别都存在的行，u1 <= u2 为唯一配对，
+        rows 上的第 k 行对应唯一配对 inverse[k]。
+    """
+    idx1 = np.asarray(idx1, dtype=np.int64)
+    idx2 = np.asarray(idx2, dtype=np.int64)
+    rows = np.flatnonzero((idx1 >= 0) & (idx2 >= 0))
+    lo = np.minimum(idx1[rows], idx2[rows])
+    hi = np.maximum(idx1[rows], idx2[rows])
+    width = int(hi.max()) + 1 if len(rows) else 1
+    _, first, inverse = np.unique(lo * width + hi, return_index=True, return_inverse=True)
+    return rows, lo[first], hi[first], inverse.reshape(-1)
+
+
+def calculate_hed_for_pairs(encoded, idx1, idx2, chunk_size=HED_CHUNK_SIZE):
+    """
+    对已知存在的唯一序列行号逐对计算 HED（不去重），返回 float64 数组。
+    长度不一致或空序列的位置为 NaN；同一条序列直接为 0，无需查表。
+    """
+    residues, lengths = encoded["residues"], encoded["lengths"]
+    heds = np.full(len(idx1), np.nan)
+    valid = (lengths[idx1] == lengths[idx2]) & (lengths[idx1] > 0)
+    heds[valid & (idx1 == idx2)] = 0.0
+    rows = np.flatnonzero(valid & (idx1 != idx2))
+
+    # 分块计算，避免 (n_pairs, max_len) 的中间矩阵占用过多内存
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        r1, r2 = idx1[chunk], idx2[chunk]
+        totals = GRANTHAM_TABLE[residues[r1], residues[r2]].sum(axis=1, dtype=np.int64)
+        heds[chunk] = totals / lengths[r1]
+    return heds
+
+
+def calculate_distances_for_pairs(encoded, idx1, idx2, metrics, chunk_size=DISTANCE_CHUNK_SIZE):
+    """
+    一次遍历同时计算多个距离核（见 distance_kernels.py）下的 HED，返回 (len(idx1), len(metrics)) 数组。
+
+    每块配对只做一次残基配对编码 code1 * 21 + code2，再在堆叠的 (441, K) 查找表上一次取出 K 种距离，
+    各距离核共享编码与内存访问。长度不一致或空序列的行为 NaN，同一条序列直接为 0。
+    """
+    residues, lengths = encoded["residues"], encoded["lengths"]
+    table = stacked_kernel_tables(metrics)
+    n_codes = UNKNOWN_CODE + 1
+    out = np.full((len(idx1), len(metrics)), np.nan)
+    valid = (lengths[idx1] == lengths[idx2]) & (lengths[idx1] > 0)
+    out[valid & (idx1 == idx2)] = 0.0
+    rows = np.flatnonzero(valid & (idx1 != idx2))
+
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        r1, r2 = idx1[chunk], idx2[chunk]
+        codes = residues[r1].astype(np.intp) * n_codes + residues[r2]
+        out[chunk] = table[codes].sum(axis=1) / lengths[r1][:, None]
+    return out
+
+
+def calculate_hed_from_indices(encoded, idx1, idx2, chunk_size=HED_CHUNK_SIZE, pair_fn=None):
+    """
+    按行号批量计算 HED，返回 float64 数组。
+    型别缺失 (-1)、长度不一致或空序列的位置为 NaN，对应 calculate_hed 的 None。
+
+    队列中常见基因型大量重复，因此先折叠为唯一序列的无序配对，每个配对只计算一次再广播回各行。
+    pair_fn(u1, u2) 可替换唯一配对的计算方式（例如先查询持久化缓存）；
+    pair_fn 返回 (n, K) 数组（多个距离核）时结果为 (len(idx1), K)。
+    """
+    rows, u1, u2, inverse = unique_allele_pairs(idx1, idx2)
+    if pair_fn is None:
+        unique_heds = calculate_hed_for_pairs(encoded, u1, u2, chunk_size)
+    else:
+        unique_heds = pair_fn(u1, u2)
+    heds = np.full((len(idx1),) + unique_heds.shape[1:], np.nan)
+    heds[rows] = unique_heds[inverse]
+    return heds
+
+
+def calculate_hed_batch(encoded, alleles1, alleles2, chunk_size=HED_CHUNK_SIZE):
+    """对一整列 (allele1, allele2) 批量计算 HED，结果与逐行调用 calculate_hed 一致"""
+    idx1 = lookup_allele_indices(encoded, alleles1)
+    idx2 = lookup_allele_indices(encoded, alleles2)
+    return calculate_hed_from_indices(encoded, idx1, idx2, chunk_size=chunk_size)
+
+
+def make_hed_calculator(fasta_path, matrix_dir=None, cache_path=None, cache_size=None, aligned_dir=None,
+                        metrics=None, masks=None, position_weights=None):
+    """
+    返回 hed_fn(alleles1, alleles2) -> float64 数组。
+
+    提供 matrix_dir（hed_matrix.py 构建的预计算矩阵）时直接查表，仅在矩阵无法覆盖的
+    跨位点配对上才按需加载序列计算；否则加载 fasta 并使用向量化引擎计算。
+    提供 cache_path 时，唯一配对先查询持久化的 SQLite 缓存（见 hed_cache.py，以序列摘要为键），
+    只计算未命中的配对并写回缓存；矩阵查表已是预计算结果，两者不能同时使用。
+    提供 aligned_dir（locus_alignment.py 构建的比对矩阵）时，长度相同的配对仍按位置计算（结果不变），
+    长度不一致的型别在比对坐标上计算，也能得到 HED。
+    提供 metrics（distance_kernels.py 中的距离核名称列表）时一次遍历计算全部距离核，
+    返回 (行数, len(metrics)) 数组；该模式不使用矩阵、缓存与比对坐标。
+    提供 masks（position_masks.py 中的位置掩码名称列表，可由 position_weights 文件补充）时
+    一次遍历计算全部掩码下的加权 HED，返回 (行数, len(masks)) 数组。
+    """
+    if matrix_dir is not None and cache_path is not None:
+        raise ValueError("matrix_dir 与 cache_path 不能同时使用：矩阵查表不经过缓存")
+
+    if masks is not None:
+        from position_masks import MaskedHed, load_position_weights
+
+        encoded = encode_allele_sequences(load_allele_sequences(fasta_path))
+        custom = load_position_weights(position_weights) if position_weights else None
+        masked = MaskedHed(encoded, masks, custom)
+
+        def masked_fn(alleles1, alleles2):
+            idx1 = lookup_allele_indices(encoded, alleles1)
+            idx2 = lookup_allele_indices(encoded, alleles2)
+            return calculate_hed_from_indices(encoded, idx1, idx2, pair_fn=masked.calculate)
+
+        return masked_fn
+
+    if metrics is not None:
+        encoded = encode_allele_sequences(load_allele_sequences(fasta_path))
+        metrics = list(metrics)
+
+        def distances_fn(alleles1, alleles2):
+            idx1 = lookup_allele_indices(encoded, alleles1)
+            idx2 = lookup_allele_indices(encoded, alleles2)
+            return calculate_hed_from_indices(
+                encoded, idx1, idx2,
+                pair_fn=lambda u1, u2: calculate_distances_for_pairs(encoded, u1, u2, metrics))
+
+        return distances_fn
+
+    if aligned_dir is not None:
+        from locus_alignment import calculate_aligned_hed_batch, load_alignment
+
+        aligned = load_alignment(aligned_dir, fasta_path)
+        return lambda alleles1, alleles2: calculate_aligned_hed_batch(aligned, alleles1, alleles2)
+
+    encoded = {}
+
+    def get_encoded():
+        if not encoded:
+            encoded.update(encode_allele_sequences(load_allele_sequences(fasta_path)))
+        return encoded
+
+    if cache_path is not None:
+        from hed_cache import HedCache
+
+        encoded.update(encode_allele_sequences(load_allele_sequences(fasta_path)))
+        digests = sequence_digests(encoded)
+        cache = HedCache(cache_path, "grantham", cache_size)
+
+        def cached_pairs(u1, u2):
+            return cache.fetch_or_compute(digests, u1, u2,
+                                          lambda i1, i2: calculate_hed_for_pairs(encoded, i1, i2))
+
+        def hed_fn(alleles1, alleles2):
+            idx1 = lookup_allele_indices(encoded, alleles1)
+            idx2 = lookup_allele_indices(encoded, alleles2)
+            return calculate_hed_from_indices(encoded, idx1, idx2, pair_fn=cached_pairs)
+
+        return hed_fn
+
+    if matrix_dir is None:
+        get_encoded()
+        return lambda alleles1, alleles2: calculate_hed_batch(encoded, alleles1, alleles2)
+
+    from hed_matrix import load_hed_matrices, lookup_hed_from_matrices
+    store = load_hed_matrices(matrix_dir, fasta_path)
+
+    def hed_fn(alleles1, alleles2):
+        alleles1, alleles2 = np.asarray(alleles1, dtype=object), np.asarray(alleles2, dtype=object)
+        heds, uncovered = lookup_hed_from_matrices(store, alleles1, alleles2)
+        if len(uncovered):
+            heds[uncovered] = calculate_hed_batch(get_encoded(), alleles1[uncovered], alleles2[uncovered])
+        return heds
+
+    return hed_fn
+
 
 def load_allele_sequences(fasta_path):
-    seqs = {}
-    for record in SeqIO.parse(fasta_path, "fasta"):
-        allele = record.id.split()[0]
-        seq = str(record.seq).replace("\n", "").replace(" ", "")
-        seqs[allele] = seq
-    return seqs
-
-def summarize_hed_per_locus_with_calculation(directory="data", fasta_file="data/hla_exon_sequences.fasta"):
+    """以 mmap 方式加载编译后的序列存储（fasta 变化时自动重新编译），返回只读的 {allele: seq} 映射"""
+    return load_sequence_store(fasta_path)
+
+# 经典 HLA 位点（--summary 的 data/{locus}.txt 与 --wide 的 {locus}_1 / {locus}_2 列只识别这些位点）
+CLASS_I_LOCI = ("A", "B", "C")
+CLASS_II_LOCI = ("DRB1", "DQB1", "DQA1", "DPB1", "DPA1", "DRB3", "DRB4", "DRB5")
+HLA_LOCI = CLASS_I_LOCI + CLASS_II_LOCI
+
+SUMMARY_CHUNK_ROWS = 200000
+
+# 并行汇总时每个 worker 进程内的 HED 计算函数（由 _init_summary_worker 初始化）
+_worker_hed_fn = None
+
+
+def _init_summary_worker(fasta_file, matrix_dir, cache_path=None, cache_size=None, aligned_dir=None):
+    # 每个 worker 以 mmap 打开同一份序列存储/矩阵文件，由页缓存共享，无需把序列字典 pickle 给子进程
+    global _worker_hed_fn
+    _worker_hed_fn = make_hed_calculator(fasta_file, matrix_dir, cache_path, cache_size, aligned_dir)
+
+
+def _summary_chunk(alleles1, alleles2):
+    return _worker_hed_fn(alleles1, alleles2)
+
+
+def _read_locus_table(input_path):
+    """读取单个位点的输入文件，返回 (df, 错误信息)"""
     import os
 
-    target_genes = ["A", "B", "C", "DRB1", "DQB1", "DQA1", "DPB1", "DPA1", "DRB3", "DRB4", "DRB5",]
+    import pandas as pd
+
+    if not os.path.exists(input_path):
+        return None, f"⚠️ Input file not found: {input_path}"
+    df = pd.read_csv(input_path, sep="\t")
+    if df.shape[1] < 3:
+        return None, f"⚠️ Invalid columns in {input_path}"
+    return df, None
+
+
+def _iter_locus_heds_parallel(paths, fasta_file, matrix_dir, workers, cache_path=None, cache_size=None,
+                              aligned_dir=None):
+    """
+    将各位点（大位点再按 SUMMARY_CHUNK_ROWS 分块）分发到进程池，
+    按 target_genes 的顺序产出 (gene, df, heds, 错误信息)。
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    load_sequence_store(fasta_file)  # 必要时先在主进程编译好存储，避免各 worker 重复编译
+    with ProcessPoolExecutor(workers, initializer=_init_summary_worker,
+                             initargs=(fasta_file, matrix_dir, cache_path, cache_size, aligned_dir)) as pool:
+        submitted = []
+        for gene, input_path in paths:
+            df, message = _read_locus_table(input_path)
+            futures = []
+            if df is not None:
+                col1, col2 = df.columns[1], df.columns[2]
+                alleles1 = df[col1].to_numpy(dtype=object)
+                alleles2 = df[col2].to_numpy(dtype=object)
+                for start in range(0, len(df), SUMMARY_CHUNK_ROWS):
+                    stop = start + SUMMARY_CHUNK_ROWS
+                    futures.append(pool.submit(_summary_chunk, alleles1[start:stop], alleles2[start:stop]))
+            submitted.append((gene, df, futures, message))
+
+        for gene, df, futures, message in submitted:
+            heds = np.concatenate([f.result() for f in futures]) if futures else np.array([])
+            yield gene, df, heds, message
+
+
+def summarize_hed_per_locus_with_calculation(directory="data", fasta_file="data/hla_exon_sequences.fasta",
+                                             matrix_dir=None, workers=1, cache_path=None, cache_size=None,
+                                             aligned_dir=None):
+    import os
+
+    target_genes = list(HLA_LOCI)
     # target_genes = [ "DPA1"]
-    allele_seqs = load_allele_sequences(fasta_file)
+    paths = [(gene, os.path.join(directory, f"{gene}.txt")) for gene in target_genes]
 
-    print("\n📊 Summary of HED per HLA locus:")
-    print(f"{'HLA Locus':<10} {'Median HED':>12} {'IQR':>20} {'Valid Pairs':>15}")
+    if workers > 1:
+        results = _iter_locus_heds_parallel(paths, fasta_file, matrix_dir, workers, cache_path, cache_size,
+                                            aligned_dir)
+    else:
+        hed_fn = make_hed_calculator(fasta_file, matrix_dir, cache_path, cache_size, aligned_dir)
 
-    for gene in target_genes:
-        input_path = os.path.join(directory, f"{gene}.txt")
-        output_path = os.path.join(directory, f"{gene}_anno.txt")
+        def results_iter():
+            for gene, input_path in paths:
+                df, message = _read_locus_table(input_path)
+                if df is None:
+                    yield gene, None, None, message
+                    continue
+                col1, col2 = df.columns[1], df.columns[2]
+                yield gene, df, hed_fn(df[col1], df[col2]), None
 
-        if not os.path.exists(input_path):
-            print(f"⚠️ Input file not found: {input_path}")
-            continue
+        results = results_iter()
 
-        # 读取并计算 HED
-        df = pd.read_csv(input_path, sep="\t")
-        if df.shape[1] < 3:
-            print(f"⚠️ Invalid columns in {input_path}")
+    print("\n📊 Summary of HED per HLA locus:")
+    print(f"{'HLA Locus':<10} {'Median HED':>12} {'IQR':>20} {'Valid Pairs':>15}")
+
+    for gene, df, heds, message in results:
+        if df is None:
+            print(message)
             continue
 
-        col1, col2 = df.columns[1], df.columns[2]
-        heds = []
-        for _, row in df.iterrows():
-            a1, a2 = row[col1], row[col2]
-            if a1 in allele_seqs and a2 in allele_seqs:
-                try:
-                    hed = calculate_hed(allele_seqs[a1], allele_seqs[a2])
-                except:
-                    hed = None
-            else:
-                hed = None
-            heds.append(hed)
+        output_path = os.path.join(directory, f"{gene}_anno.txt")
         df["HED"] = heds
         df.to_csv(output_path, sep="\t", index=False)
 
         # 汇总统计
-        values = [h for h in heds if h is not None]
-        if not values:
+        values = heds[~np.isnan(heds)]
+        if not len(values):
             print(f"{gene:<10} {'N/A':>12} {'N/A':>20} {'0':>15}")
             continue
 
@@ -106,43 +405,359 @@ def summarize_hed_per_locus_with_calculation(directory="data", fasta_file="data/
         print(f"{gene:<10} {median:12.2f} ({q1:.2f}-{q3:.2f}){len(values):15d}")
 
 
+# ------------------ 流式处理 ------------------
+QUANTILES = np.array([25.0, 50.0, 75.0])
+
+
+def percentiles_from_counts(values, counts, q=QUANTILES):
+    """
+    values 为升序的不同取值 (D,)，counts 为各取值的计数 (D,) 或多组计数 (B, D)（如 hed_stats.py 的重采样），
+    返回 (B, len(q))，与对展开后的样本调用 np.percentile(..., q)（linear 插值）逐位一致。
+    """
+    counts = np.atleast_2d(counts)
+    n_rows, n_values = counts.shape
+    cum = np.cumsum(counts, axis=1)
+    total = cum[:, -1:].astype(np.float64)
+
+    virtual = np.asarray(q, dtype=np.float64)[None, :] / 100 * (total - 1)
+    lower = np.floor(virtual)
+    gamma = virtual - lower
+    upper = np.minimum(lower + 1, total - 1)
+
+    # 各行的累积和加上行偏移后首尾相接成一个有序数组，一次 searchsorted 完成所有行的查找
+    offset = (np.arange(n_rows) * (cum[:, -1].max() + 1))[:, None]
+    flat = (cum + offset).ravel()
+    row_start = (np.arange(n_rows) * n_values)[:, None]
+    a = values[np.searchsorted(flat, lower + offset, side="right") - row_start]
+    b = values[np.searchsorted(flat, upper + offset, side="right") - row_start]
+    # 与 numpy 内部 _lerp 相同的插值方式，保证逐位一致
+    diff = b - a
+    return np.where(gamma >= 0.5, b - diff * (1 - gamma), a + diff * gamma)
+
+
+class HedValueCounts:
+    """
+    HED 的运行统计状态：只保存 {HED 值: 出现次数}。
+
+    HED 是整数 Grantham 总和除以序列长度，不同取值的数量很有限，
+    因此无论输入多少行，内存占用都基本恒定，且分位数与 np.percentile 逐位一致。
+    多个位点的平均 HED 几乎每行都是不同的取值，此时用 decimals 先四舍五入再计数，
+    不同取值的数量只取决于 HED 的取值范围，分位数的误差不超过舍入精度的一半。
+    """
+
+    def __init__(self, decimals=None):
+        self.counts = {}
+        self.decimals = decimals
+
+    def update(self, heds):
+        heds = heds[~np.isnan(heds)]
+        if self.decimals is not None:
+            heds = np.round(heds, self.decimals)
+        values, counts = np.unique(heds, return_counts=True)
+        for value, count in zip(values.tolist(), counts.tolist()):
+            self.counts[value] = self.counts.get(value, 0) + count
+
+    @property
+    def n(self):
+        return sum(self.counts.values())
+
+    def percentile(self, q):
+        """与 np.percentile(values, q)（linear 插值）相同的结果，q 为分位数列表"""
+        values = np.array(sorted(self.counts))
+        return percentiles_from_counts(values, [self.counts[v] for v in values.tolist()], q)[0]
+
+
+class TableWriter:
+    """
+    按块追加写出注释结果；输出文件以 .parquet 结尾时写 Parquet（需要 pyarrow），否则写 TSV。
+    Parquet 的 schema 在第一块时确定，string_columns 中的列固定为字符串类型，
+    不依赖第一块推断出的类型（第一块全为空时会推断为 null，后续块无法写入）。
+    """
+
+    def __init__(self, output, string_columns=()):
+        self.output = output
+        self.parquet = output.endswith(".parquet")
+        self.string_columns = set(string_columns)
+        self._writer = None
+        self._schema = None
+        self._header = True
+
+    def write(self, df):
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            if self._writer is None:
+                inferred = pa.Table.from_pandas(df, preserve_index=False).schema
+                fields = [pa.field(f.name, pa.string()) if f.name in self.string_columns else f for f in inferred]
+                self._schema = pa.schema(fields, metadata=inferred.metadata)
+                self._writer = pq.ParquetWriter(self.output, self._schema)
+            table = pa.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+            self._writer.write_table(table)
+        else:
+            df.to_csv(self.output, sep="\t", index=False, header=self._header, mode="w" if self._header else "a")
+        self._header = False
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+def metric_columns(metrics):
+    """距离核对应的输出列名：grantham 仍为 HED，其余为 HED_{距离核}"""
+    return ["HED" if metric == "grantham" else f"HED_{metric}" for metric in metrics]
+
+
+def annotate_hed_streaming(input, output, hed_fn, chunksize, hed_columns=("HED",)):
+    """
+    按固定行数分块读取输入、计算 HED 并增量写出，只保留计算分位数所需的 HedValueCounts。
+    峰值内存只与 chunksize 有关。
+    hed_fn 返回 (行数, K) 数组时依次写入 hed_columns 的 K 列，返回 {列名: HedValueCounts}。
+    """
+    import pandas as pd
+
+    columns = pd.read_csv(input, sep="\t", nrows=0).columns
+    if len(columns) < 3:
+        raise ValueError("输入文件应至少包含3列：id, allele1, allele2")
+    col1, col2 = columns[1], columns[2]
+
+    digests = {col: HedValueCounts() for col in hed_columns}
+    # 输入列全部按字符串原样读取并写出：逐块推断的类型可能不一致（如前几块为空、之后出现文本的列），
+    # 而 Parquet 需要统一的 schema
+    writer = TableWriter(output, string_columns=columns)
+    try:
+        for chunk in pd.read_csv(input, sep="\t", chunksize=chunksize, dtype=str):
+            heds = np.asarray(hed_fn(chunk[col1], chunk[col2])).reshape(len(chunk), -1)
+            for k, col in enumerate(hed_columns):
+                chunk[col] = heds[:, k]
+                digests[col].update(heds[:, k])
+            writer.write(chunk)
+    finally:
+        writer.close()
+    return digests
+
+
+# ------------------ 宽表模式 ------------------
+# class I / II 平均 HED 列在汇总计数前保留的小数位（比打印的 2 位多一位）
+MEAN_SUMMARY_DECIMALS = 3
+
+
+def wide_locus_columns(columns):
+    """
+    识别宽表中成对的 {locus}_1 / {locus}_2 列，按列出现顺序返回 [(locus, col1, col2)]。
+    只识别 HLA_LOCI 中的位点，PC_1 / PC_2 等普通协变量列原样保留。
+    """
+    import re
+
+    found = {}
+    for col in columns:
+        m = re.fullmatch(r"(?:HLA-)?([A-Za-z0-9]+)_([12])", str(col))
+        if m and m.group(1) in HLA_LOCI:
+            found.setdefault(m.group(1), {})[m.group(2)] = col
+    return [(locus, cols["1"], cols["2"]) for locus, cols in found.items() if len(cols) == 2]
+
+
+def _with_locus_prefix(values, locus):
+    """宽表中常省略位点前缀（如 A_1 列写作 01:01），补全为 A*01:01"""
+    values = values.astype(object)
+    bare = values.notna() & ~values.astype(str).str.contains("*", regex=False)
+    return values.where(~bare, locus + "*" + values.astype(str))
+
+
+def annotate_wide_table(df, loci_columns, hed_fn):
+    """
+    一次调用 hed_fn 计算所有位点的 HED：各位点的两列首尾拼接成一个批次，
+    结果写入 HED_{locus} 列，并追加 class I / class II 的患者平均 HED（忽略缺失位点）。
+    返回 {locus: heds}。
+    """
+    alleles1 = np.concatenate([_with_locus_prefix(df[c1], locus).to_numpy() for locus, c1, _ in loci_columns])
+    alleles2 = np.concatenate([_with_locus_prefix(df[c2], locus).to_numpy() for locus, _, c2 in loci_columns])
+    heds = np.asarray(hed_fn(alleles1, alleles2)).reshape(len(loci_columns), len(df))
+
+    per_locus = {}
+    for (locus, _, _), locus_heds in zip(loci_columns, heds):
+        df[f"HED_{locus}"] = locus_heds
+        per_locus[locus] = locus_heds
+
+    class_i = [f"HED_{locus}" for locus in per_locus if locus in CLASS_I_LOCI]
+    class_ii = [f"HED_{locus}" for locus in per_locus if locus in CLASS_II_LOCI]
+    if class_i:
+        df["HED_classI_mean"] = df[class_i].mean(axis=1)
+    if class_ii:
+        df["HED_classII_mean"] = df[class_ii].mean(axis=1)
+    return per_locus
+
+
+def annotate_wide(input, output, hed_fn, chunksize=None):
+    """读取宽表（可分块），逐块注释并写出，返回 {位点或 class 列名: HedValueCounts}"""
+    import pandas as pd
+
+    columns = pd.read_csv(input, sep="\t", nrows=0).columns
+    loci_columns = wide_locus_columns(columns)
+    if not loci_columns:
+        raise ValueError("宽表中没有找到成对的 {locus}_1 / {locus}_2 列")
+    if chunksize:
+        # 分块时输入列全部按字符串读取，保证各块的列类型一致（同 annotate_hed_streaming）
+        chunks = pd.read_csv(input, sep="\t", chunksize=chunksize, dtype=str)
+        writer = TableWriter(output, string_columns=columns)
+    else:
+        dtype = {col: str for _, c1, c2 in loci_columns for col in (c1, c2)}
+        chunks = [pd.read_csv(input, sep="\t", dtype=dtype)]
+        writer = TableWriter(output)
+
+    digests = {}
+    try:
+        for chunk in chunks:
+            annotate_wide_table(chunk, loci_columns, hed_fn)
+            for col in chunk.columns[len(columns):]:
+                if col not in digests:
+                    decimals = MEAN_SUMMARY_DECIMALS if col.endswith("_mean") else None
+                    digests[col] = HedValueCounts(decimals)
+                digests[col].update(chunk[col].to_numpy(np.float64))
+            writer.write(chunk)
+    finally:
+        writer.close()
+    return digests
+
+
 # ------------------ CLI 主逻辑 ------------------
+def print_column_summary(digests, title="📊 Summary of HED per HLA locus:"):
+    """按列打印 {列名: HedValueCounts} 的中位数、IQR 与有效数"""
+    print(f"\n{title}")
+    print(f"{'Column':<18} {'Median HED':>12} {'IQR':>20} {'Valid':>10}")
+    for col, digest in digests.items():
+        if not digest.n:
+            print(f"{col:<18} {'N/A':>12} {'N/A':>20} {'0':>10}")
+            continue
+        q1, median, q3 = digest.percentile([25, 50, 75])
+        print(f"{col:<18} {median:12.2f} {f'({q1:.2f}-{q3:.2f})':>20} {digest.n:10d}")
+
+
 @click.command()
 @click.option('--input', '-i', help='输入的 TSV 文件，列顺序为 id, allele1, allele2')
 @click.option('--fasta', '-f', default="./data/hla_exon_sequences.fasta", help='包含型别氨基酸序列的 fasta 文件')
-@click.option('--output', '-o', help='输出带有 HED 列的 TSV 文件')
+@click.option('--output', '-o', help='输出带有 HED 列的 TSV 文件（以 .parquet 结尾时输出 Parquet）')
 @click.option('--summary', is_flag=True, help='是否汇总所有HLA位点的HED统计')
-def main(input, fasta, output,summary):
+@click.option('--matrix-dir', default=None, help='hed_matrix.py 预计算的 HED 矩阵目录，提供时直接查表')
+@click.option('--workers', '-w', type=int, default=1, show_default=True, help='--summary 模式下并行计算的进程数')
+@click.option('--chunksize', type=int, default=None, help='流式模式：每次读取的行数，内存占用与输入大小无关')
+@click.option('--cache', 'cache_path', default=None, help='持久化 HED 结果缓存（SQLite 文件），重复运行时直接复用')
+@click.option('--cache-size', type=int, default=None, help='缓存最多保留的配对数，超出时淘汰最久未使用的配对')
+@click.option('--aligned', 'aligned_dir', default=None,
+              help='locus_alignment.py 构建的比对矩阵目录，提供时长度不一致的型别也按比对坐标计算 HED')
+@click.option('--wide', is_flag=True, help='输入为宽表（A_1, A_2, B_1, ... 列），一次计算所有位点及 class I/II 平均 HED')
+@click.option('--normalize', is_flag=True, help='先把 HLA-A*02:01:01:02、A*02:01:01G 等写法解析为 fasta 中的 4-digit 名称')
+@click.option('--unresolved-report', default=None, help='--normalize 时把所有无法解析的型别名称写入该 TSV')
+@click.option('--metrics', default="grantham", show_default=True,
+              help='距离核（逗号分隔，可选 grantham, sandberg, p, blosum62），一次遍历全部计算；'
+                   'grantham 写入 HED 列，其余写入 HED_{距离核} 列')
+@click.option('--masks', default=None,
+              help='位置掩码（逗号分隔，可选 full, pbr, pocketA-pocketF 及权重文件中定义的掩码），一次遍历全部计算；'
+                   'full 写入 HED 列，其余写入 HED_{掩码} 列')
+@click.option('--position-weights', default=None,
+              help='自定义逐位置权重 TSV（mask, locus, position, weight），与 --masks 一起使用')
+def main(input, fasta, output, summary, matrix_dir, workers, chunksize, cache_path, cache_size, aligned_dir, wide,
+         normalize, unresolved_report, metrics, masks, position_weights):
+    import pandas as pd
+
+    from distance_kernels import KERNELS
+
+    if aligned_dir and (matrix_dir or cache_path):
+        raise click.UsageError("--aligned 不能与 --matrix-dir / --cache 同时使用")
+    if matrix_dir and cache_path:
+        raise click.UsageError("--matrix-dir 已是预计算的查表结果，不能与 --cache 同时使用")
+    metrics = [m.strip() for m in metrics.split(",") if m.strip()]
+    unknown = [m for m in metrics if m not in KERNELS]
+    if not metrics or unknown:
+        raise click.UsageError(f"未知的距离核: {', '.join(unknown)}（可选: {', '.join(KERNELS)}）")
+    if metrics == ["grantham"]:
+        metrics = None  # 默认 HED 走原有的整数查表路径（以及矩阵、缓存、比对）
+    elif summary or wide or matrix_dir or cache_path or aligned_dir:
+        raise click.UsageError("--metrics 只适用于 --input 模式，不能与 --summary / --wide / --matrix-dir / "
+                               "--cache / --aligned 同时使用")
+    if position_weights and not masks:
+        raise click.UsageError("--position-weights 需要与 --masks 一起使用")
+    if masks:
+        masks = [m.strip() for m in masks.split(",") if m.strip()]
+        if metrics or summary or wide or matrix_dir or cache_path or aligned_dir:
+            raise click.UsageError("--masks 只适用于 --input 模式（Grantham 距离），不能与 --metrics / --summary / "
+                                   "--wide / --matrix-dir / --cache / --aligned 同时使用")
+    if normalize and summary:
+        raise click.UsageError("--normalize 只适用于 --input 模式")
+
+    resolver = None
+    if normalize and input and output:
+        from allele_names import AlleleResolver
+
+        resolver = AlleleResolver(load_allele_sequences(fasta))
+
+    def get_hed_fn():
+        hed_fn = make_hed_calculator(fasta, matrix_dir, cache_path, cache_size, aligned_dir, metrics, masks,
+                                     position_weights)
+        if resolver is None:
+            return hed_fn
+        from allele_names import normalizing_hed_fn
+
+        return normalizing_hed_fn(hed_fn, resolver)
     if summary:
-         summarize_hed_per_locus_with_calculation("data", "data/hla_exon_sequences.fasta")
+         summarize_hed_per_locus_with_calculation("data", "data/hla_exon_sequences.fasta", matrix_dir, workers,
+                                                  cache_path, cache_size, aligned_dir)
+    elif input and output and wide:
+        hed_fn = get_hed_fn()
+        digests = annotate_wide(input, output, hed_fn, chunksize)
+        print_column_summary(digests)
+        print(f"✅ 结果已写入 {output}")
+    elif input and output and (metrics or masks):
+        from position_masks import mask_columns
+
+        hed_fn = get_hed_fn()
+        hed_columns = mask_columns(masks) if masks else metric_columns(metrics)
+        if chunksize:
+            digests = annotate_hed_streaming(input, output, hed_fn, chunksize, hed_columns)
+        else:
+            df = pd.read_csv(input, sep="\t")
+            if df.shape[1] < 3:
+                raise ValueError("输入文件应至少包含3列：id, allele1, allele2")
+            heds = hed_fn(df[df.columns[1]], df[df.columns[2]])
+            digests = {}
+            for k, col in enumerate(hed_columns):
+                df[col] = heds[:, k]
+                digests[col] = HedValueCounts()
+                digests[col].update(heds[:, k])
+            writer = TableWriter(output)
+            writer.write(df)
+            writer.close()
+        print_column_summary(digests, "📊 Summary of HED per position mask:" if masks
+                             else "📊 Summary of HED per distance kernel:")
+        print(f"✅ 结果已写入 {output}")
     elif input and output:
-        allele_seqs = load_allele_sequences(fasta)
-        df = pd.read_csv(input, sep="\t")
-
-        if df.shape[1] < 3:
-            raise ValueError("输入文件应至少包含3列：id, allele1, allele2")
-
-        col1, col2 = df.columns[1], df.columns[2]
-
-        heds = []
-        for _, row in df.iterrows():
-            a1, a2 = row[col1], row[col2]
-            if a1 in allele_seqs and a2 in allele_seqs:
-                try:
-                    hed = calculate_hed(allele_seqs[a1], allele_seqs[a2])
-                except Exception:
-                    hed = None
-            else:
-                hed = None
-            heds.append(hed)
+        hed_fn = get_hed_fn()
+        if chunksize:
+            digest = annotate_hed_streaming(input, output, hed_fn, chunksize)["HED"]
+            n_valid = digest.n
+            quartiles = digest.percentile([25, 50, 75]) if n_valid else None
+        else:
+            df = pd.read_csv(input, sep="\t")
 
-        df["HED"] = heds
-        df.to_csv(output, sep="\t", index=False)
+            if df.shape[1] < 3:
+                raise ValueError("输入文件应至少包含3列：id, allele1, allele2")
+
+            col1, col2 = df.columns[1], df.columns[2]
 
-        hed_vals = [h for h in heds if h is not None]
-        if hed_vals:
-            q1, median, q3 = np.percentile(hed_vals, [25, 50, 75])
-            print(f"✅ 计算完成，共 {len(hed_vals)} 对有效配对")
+            heds = hed_fn(df[col1], df[col2])
+
+            df["HED"] = heds
+            writer = TableWriter(output)
+            writer.write(df)
+            writer.close()
+
+            hed_vals = heds[~np.isnan(heds)]
+            n_valid = len(hed_vals)
+            quartiles = np.percentile(hed_vals, [25, 50, 75]) if n_valid else None
+
+        if n_valid:
+            q1, median, q3 = quartiles
+            print(f"✅ 计算完成，共 {n_valid} 对有效配对")
             print(f"中位数 HED: {median:.2f}")
             print(f"IQR: ({q1:.2f} - {q3:.2f})")
         else:
@@ -150,5 +765,8 @@ def main(input, fasta, output,summary):
     else:
         print("--input 或者 --summary 是必选项")
 
+    if resolver is not None:
+        resolver.report(path=unresolved_report)
+
 if __name__ == "__main__":
     main()
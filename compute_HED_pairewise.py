@@ -1,94 +1,176 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+"""
+计算两个型别之间的 HED，或以批量模式从文件 / 标准输入读取多对型别，逐行输出 TSV。
 
+    python compute_HED_pairewise.py "A*01:01" "A*02:01"
+    python compute_HED_pairewise.py --batch pairs.tsv > heds.tsv
+    cut -f2,3 cohort.tsv | python compute_HED_pairewise.py --batch - > heds.tsv
+
+本脚本只依赖标准库（序列存储以 mmap 读取，HED 为逐位点查表），不导入 Biopython / numpy / pandas，
+单次查询的启动时间即为 Python 解释器的启动时间。
+"""
+
+import os
 import sys
-from Bio import SeqIO
-
-# ------------------ Grantham Distance Matrix ------------------
-AA_LIST = ['A', 'R', 'N', 'D', 'C', 'Q', 'E', 'G', 'H', 'I',
-           'L', 'K', 'M', 'F', 'P', 'S', 'T', 'W', 'Y', 'V']
-
-GRANTHAM_MATRIX = [
-    [0,112,111,126,195, 91,107, 60, 86, 94, 96,106, 84,113, 27, 99, 58,148,112, 64],
-    [112,  0, 86, 96,180, 43, 54,125, 29, 97,102, 26, 91, 97,103,110, 71,101, 77, 96],
-    [111, 86,  0, 23,139, 46, 42, 80, 68,149,153, 94,142,160, 91, 46, 65,174,143,133],
-    [126, 96, 23,  0,154, 61, 45, 94, 81,168,172,101,160,177,108, 65, 85,181,160,152],
-    [195,180,139,154,  0,154,170,159,174,198,198,202,196,205,169,112,149,215,194,192],
-    [ 91, 43, 46, 61,154,  0, 29, 87, 24,109,113, 53,101,116, 76, 68, 42,130, 99, 96],
-    [107, 54, 42, 45,170, 29,  0, 98, 40,134,138, 56,126,152, 93, 80, 65,181,140,121],
-    [ 60,125, 80, 94,159, 87, 98,  0, 98,135,138,127,127,153, 42, 56, 59,184,147,109],
-    [ 86, 29, 68, 81,174, 24, 40, 98,  0, 94, 99, 32, 87,100, 77, 89, 47,115, 83, 84],
-    [ 94, 97,149,168,198,109,134,135, 94,  0,  5,102, 10, 21, 95,142, 89, 61, 33, 29],
-    [ 96,102,153,172,198,113,138,138, 99,  5,  0,107, 21, 22, 98,145, 92, 61, 36, 32],
-    [106, 26, 94,101,202, 53, 56,127, 32,102,107,  0, 95,103,103,121, 78,110, 85, 97],
-    [ 84, 91,142,160,196,101,126,127, 87, 10, 21, 95,  0, 28, 87,135, 81, 84, 36, 21],
-    [113, 97,160,177,205,116,152,153,100, 21, 22,103, 28,  0,114,155,103, 40, 22, 50],
-    [ 27,103, 91,108,169, 76, 93, 42, 77, 95, 98,103, 87,114,  0, 74, 38,147,110, 68],
-    [ 99,110, 46, 65,112, 68, 80, 56, 89,142,145,121,135,155, 74,  0, 58,177,144,124],
-    [ 58, 71, 65, 85,149, 42, 65, 59, 47, 89, 92, 78, 81,103, 38, 58,  0,128, 92, 69],
-    [148,101,174,181,215,130,181,184,115, 61, 61,110, 84, 40,147,177,128,  0, 37, 88],
-    [112, 77,143,160,194, 99,140,147, 83, 33, 36, 85, 36, 22,110,144, 92, 37,  0, 55],
-    [ 64, 96,133,152,192, 96,121,109, 84, 29, 32, 97, 21, 50, 68,124, 69, 88, 55,  0]
-]
-
-GRANTHAM = {
-    (AA_LIST[i], AA_LIST[j]): GRANTHAM_MATRIX[i][j]
-    for i in range(20) for j in range(20)
-}
-
-# ------------------ HED计算函数 ------------------
-def grantham_distance(a1, a2):
-    return 0 if a1 == a2 else GRANTHAM.get((a1, a2), 0)
-
-# def calculate_hed(s1, s2):
-#     if len(s1) != len(s2):
-#         raise ValueError(f"Length mismatch: {len(s1)} vs {len(s2)}")
-#     return sum(grantham_distance(a, b) for a, b in zip(s1, s2)) / 2.2
-
-def calculate_hed(s1, s2):
-    if len(s1) != len(s2):
-        raise ValueError(f"Length mismatch: {len(s1)} vs {len(s2)}")
-    total = sum(grantham_distance(a, b) for a, b in zip(s1, s2))
-    return total / len(s1)  # 注意这里是除以长度，不是 2.2
+from functools import lru_cache
+
+from seq_store import load_sequence_store
+from distance_kernels import calculate_hed
+
+# 批量模式通过服务查询时每次请求的配对数
+SERVER_BATCH_PAIRS = 1000
+# 批量模式按 (序列, 序列) 缓存的 HED 数，队列中重复的基因型只计算一次
+PAIR_CACHE_SIZE = 1 << 16
 
 # ------------------ 序列读取函数 ------------------
 def load_allele_sequences(fasta_path):
-    seqs = {}
-    for record in SeqIO.parse(fasta_path, "fasta"):
-        allele = record.id.split()[0]
-        seq = str(record.seq).replace("\n", "").replace(" ", "")
-        seqs[allele] = seq
-    return seqs
+    # mmap 加载编译后的序列存储，无需 Biopython 解析整个 fasta
+    return load_sequence_store(fasta_path)
 
 # ------------------ 主计算函数 ------------------
-def compute_hed_between_alleles(allele1, allele2, fasta_path):
-    allele_seqs = load_allele_sequences(fasta_path)
-
+def check_pair(allele_seqs, allele1, allele2):
+    """返回 (s1, s2, 错误信息)；型别不存在或长度不一致时序列为 None"""
     if allele1 not in allele_seqs:
-        raise ValueError(f"{allele1} not found in fasta file")
+        return None, None, f"{allele1} not found in fasta file"
     if allele2 not in allele_seqs:
-        raise ValueError(f"{allele2} not found in fasta file")
+        return None, None, f"{allele2} not found in fasta file"
 
     s1 = allele_seqs[allele1]
     s2 = allele_seqs[allele2]
 
     if len(s1) != len(s2):
-        raise ValueError(f"Length mismatch between {allele1} and {allele2}")
+        return None, None, f"Length mismatch between {allele1} and {allele2}"
+    return s1, s2, None
+
+def compute_hed_between_alleles(allele1, allele2, fasta_path):
+    allele_seqs = load_allele_sequences(fasta_path)
+
+    s1, s2, error = check_pair(allele_seqs, allele1, allele2)
+    if error:
+        raise ValueError(error)
 
     hed = calculate_hed(s1, s2)
     print(f"HED({allele1}, {allele2}) = {hed:.2f}")
     return hed
 
+def compute_hed_via_server(allele1, allele2, address):
+    """通过常驻的 hed_server.py 查询，省去每次启动时加载序列的开销"""
+    from hed_server import query_hed_server
+
+    result = query_hed_server(address, [(allele1, allele2)])[0]
+    if result["error"]:
+        raise ValueError(result["error"])
+    hed = result["hed"]
+    print(f"HED({allele1}, {allele2}) = {hed:.2f}")
+    return hed
+
+# ------------------ 批量模式 ------------------
+def iter_pair_lines(stream):
+    """
+    逐行读取配对：每行两个型别（制表符或空白分隔），空行与 # 开头的行跳过，
+    allele1/allele2 表头跳过。产出 (allele1, allele2, 错误信息)。
+    制表符分隔时保留空字段，缺失型别的行仍输出一行错误，输出与输入逐行对应。
+    """
+    for line in stream:
+        line = line.rstrip("\r\n")
+        if not line.strip() and "\t" not in line or line.startswith("#"):
+            continue
+        fields = [f.strip() for f in line.split("\t")] if "\t" in line else line.split()
+        if fields[:2] == ["allele1", "allele2"]:
+            continue
+        if len(fields) != 2:
+            yield line, "", f"expected 2 columns, got {len(fields)}"
+        else:
+            yield fields[0], fields[1], None
+
+def _local_batch(pairs, fasta_path):
+    """在本进程内逐对计算，产出 (allele1, allele2, hed, 错误信息)；序列存储在读到第一对时才加载"""
+    allele_seqs = None
+
+    @lru_cache(maxsize=PAIR_CACHE_SIZE)
+    def cached_hed(s1, s2):
+        return calculate_hed(s1, s2)
+
+    for allele1, allele2, error in pairs:
+        if error:
+            yield allele1, allele2, None, error
+            continue
+        if allele_seqs is None:
+            allele_seqs = load_allele_sequences(fasta_path)
+        s1, s2, error = check_pair(allele_seqs, allele1, allele2)
+        if error:
+            yield allele1, allele2, None, error
+        else:
+            # HED 对称，按序列排序后缓存，(a, b) 与 (b, a) 共用一次计算
+            yield allele1, allele2, cached_hed(*sorted((s1, s2))), None
+
+def _server_batch(pairs, address):
+    """按 SERVER_BATCH_PAIRS 分批查询 hed_server.py，产出 (allele1, allele2, hed, 错误信息)"""
+    from itertools import islice
+
+    from hed_server import query_hed_server
+
+    pairs = iter(pairs)
+    while block := list(islice(pairs, SERVER_BATCH_PAIRS)):
+        valid = [(a1, a2) for a1, a2, error in block if not error]
+        results = iter(query_hed_server(address, valid) if valid else [])
+        for allele1, allele2, error in block:
+            if error:
+                yield allele1, allele2, None, error
+            else:
+                result = next(results)
+                yield allele1, allele2, result["hed"], result["error"]
+
+def run_batch(stream, out, fasta_path, server=None):
+    """读取配对并逐行写出 TSV: allele1, allele2, HED, error，返回 (成功数, 失败数)"""
+    pairs = iter_pair_lines(stream)
+    results = _server_batch(pairs, server) if server else _local_batch(pairs, fasta_path)
+
+    n_ok = n_error = 0
+    out.write("allele1\tallele2\tHED\terror\n")
+    for allele1, allele2, hed, error in results:
+        if error:
+            n_error += 1
+            out.write(f"{allele1}\t{allele2}\t\t{error}\n")
+        else:
+            n_ok += 1
+            out.write(f"{allele1}\t{allele2}\t{hed!r}\t\n")
+    out.flush()
+    return n_ok, n_error
+
 # ------------------ 命令行调用支持 ------------------
 def main():
-    if len(sys.argv) != 3:
-        print("用法: python compute_hed_pairwise.py A*01:01 A*02:01")
-        sys.exit(1)
-
-    allele1 = sys.argv[1]
-    allele2 = sys.argv[2]
-    fasta_path = "./data/hla_exon_sequences.fasta"
-    compute_hed_between_alleles(allele1, allele2, fasta_path)
+    import argparse
+
+    parser = argparse.ArgumentParser(usage="python compute_hed_pairwise.py A*01:01 A*02:01 [--server ADDRESS]\n"
+                                           "       python compute_hed_pairwise.py --batch PAIRS [--server ADDRESS]")
+    parser.add_argument("allele1", nargs="?")
+    parser.add_argument("allele2", nargs="?")
+    parser.add_argument("--fasta", "-f", default="./data/hla_exon_sequences.fasta")
+    parser.add_argument("--server", default=os.environ.get("HED_SERVER"),
+                        help="hed_server.py 的 Unix socket 路径或 host:port（默认读取环境变量 HED_SERVER）")
+    parser.add_argument("--batch", "-b", default=None,
+                        help="批量模式：从该文件（- 表示标准输入）读取每行一对型别，向标准输出写 TSV")
+    args = parser.parse_args()
+
+    if args.batch:
+        if args.allele1 or args.allele2:
+            parser.error("--batch 模式下不需要位置参数")
+        if args.batch == "-":
+            n_ok, n_error = run_batch(sys.stdin, sys.stdout, args.fasta, args.server)
+        else:
+            with open(args.batch, encoding="utf-8") as f:
+                n_ok, n_error = run_batch(f, sys.stdout, args.fasta, args.server)
+        print(f"完成 {n_ok} 对，失败 {n_error} 对", file=sys.stderr)
+        return
+    if not args.allele2:
+        parser.error("需要两个型别，或使用 --batch")
+
+    if args.server:
+        compute_hed_via_server(args.allele1, args.allele2, args.server)
+    else:
+        compute_hed_between_alleles(args.allele1, args.allele2, args.fasta)
 
 if __name__ == "__main__":
     main()
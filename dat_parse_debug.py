@@ -1,255 +1,593 @@
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import os
 import re
-from Bio.Seq import Seq
+import time
+import zipfile
+from collections import Counter, defaultdict
 
-def parse_hla_dat_4res(dat_path, top=None):
-    """
-    解析 HLA .dat 文件，提取 HLA Class I 的 exon2+3 和 Class II 的 exon2 的氨基酸序列。
+import click
+import numpy as np
 
-    参数：
-        dat_path (str): .dat 文件路径
-        top (int): 限制解析的记录数，用于调试
+ZIP_MAGIC = b"PK\x03\x04"
+GZIP_MAGIC = b"\x1f\x8b"
 
-    返回：
-        dict: {allele4: {"class": "I" or "II", "seq": translated_aa_sequence}}
-    """
-    seen_allele4 = set()
 
-    # 支持的经典HLA基因
-    classical_genes = {"A", "B", "C", "DRB1", "DRB3", "DRB4", "DRB5", "DQA1", "DQB1", "DPA1", "DPB1"}
-    mapping = {}
+def _zip_dat_member(zf):
+    """在 ZIP 中选择 .dat 成员：优先 hla.dat，其次唯一的 .dat 文件，再次唯一的文件"""
+    names = [info.filename for info in zf.infolist() if not info.is_dir()]
+    for candidates in (
+        [n for n in names if os.path.basename(n) == "hla.dat"],
+        [n for n in names if n.endswith(".dat")],
+        names,
+    ):
+        if len(candidates) == 1:
+            return candidates[0]
+    raise ValueError(f"无法在 ZIP 中确定 .dat 文件: {names}")
 
-    # 读取并按 record 切分
-    with open(dat_path, encoding='utf-8') as f:
-        text = f.read()
-    records = re.split(r"(?m)^\s*//\s*$", text)
 
-    count = 0
-    for rec in records:
-        lines = rec.strip().splitlines()
-        if not lines or not lines[0].startswith("ID"):
-            continue
+@contextlib.contextmanager
+def open_dat_text(dat_path):
+    """
+    以文本流方式打开 hla.dat，支持未压缩文件、IPD-IMGT 发布的 hla.dat.zip 以及 gzip。
+    压缩文件按魔数识别，边解压边读取，不需要先解压到磁盘。
+    """
+    with open(dat_path, "rb") as f:
+        magic = f.read(4)
+
+    if magic.startswith(ZIP_MAGIC):
+        with zipfile.ZipFile(dat_path) as zf:
+            with zf.open(_zip_dat_member(zf)) as raw:
+                yield io.TextIOWrapper(raw, encoding='utf-8')
+    elif magic.startswith(GZIP_MAGIC):
+        with gzip.open(dat_path, "rt", encoding='utf-8') as f:
+            yield f
+    else:
+        with open(dat_path, encoding='utf-8') as f:
+            yield f
+
+
+def iter_dat_records(dat_path):
+    """
+    逐行读取 .dat 文件（可为 ZIP / gzip 压缩），以 "//" 行为分隔，每次产出一条 record 的行列表。
+    内存占用只与单条 record 的大小有关，而不是整个文件。
+    """
+    buf = []
+    with open_dat_text(dat_path) as f:
+        for line in f:
+            if line.strip() == "//":
+                lines = "".join(buf).strip().splitlines()
+                buf = []
+                if lines:
+                    yield lines
+            else:
+                buf.append(line)
+    lines = "".join(buf).strip().splitlines()
+    if lines:
+        yield lines
+
 
-        # DE 行抓 allele name 和 class
-        allele_full = cls = None
-        for line in lines:
-            if line.startswith("DE") and "Class II" in line:
+def extract_record_fields(lines):
+    """
+    单次遍历 record 的所有行，同时提取 DE、FT CDS/exon/translation 与 SQ 字段。
+
+    返回:
+        dict: allele_full, cls, translation_aa, codon_start, cds_coords,
+              exon_coords, exon_number_coords, sq_lines
+    """
+    allele_full = cls = None
+    de_done = False
+    translation_parts = []
+    in_translation = False
+    codon_start = 1  # 默认值
+    cds_coords = []
+    cds_state = 0  # 0: 未进入 CDS 区块, 1: CDS 区块内, 2: CDS 区块已结束
+    exon_coords = []
+    exon_number_coords = {}
+    pending_exon = None  # 上一行 exon 的坐标，等待下一行的 /number
+    in_seq = False
+    sq_lines = []
+
+    for line in lines:
+        # DE 行抓 allele name 和 class（找到第一个 HLA- 名称后停止）
+        if not de_done and line.startswith("DE"):
+            if "Class II" in line:
                 cls = "II"
-            elif line.startswith("DE") and "Class I" in line:
+            elif "Class I" in line:
                 cls = "I"
-            if line.startswith("DE") and "HLA-" in line:
+            if "HLA-" in line:
                 match = re.search(r"HLA-([\w\*:\-]+)", line)
                 if match:
                     allele_full = match.group(1)
-                    break
-        if not allele_full or cls is None:
-            print("跳过: 无法识别 DE 行")
-            continue
+                    de_done = True
+
+        # /translation（多行拼接）
+        if '/translation="' in line:
+            in_translation = True
+            part = line.split('="')[1].strip()
+            translation_parts.append(part.rstrip('"'))
+            if part.endswith('"'):
+                in_translation = False
+        elif in_translation:
+            # 去除行首的 "FT" 和空格，保留实际氨基酸序列
+            aa_part = line.strip()
+            if aa_part.startswith("FT"):
+                aa_part = aa_part[2:].strip()
+            translation_parts.append(aa_part.rstrip('"'))
+            if line.strip().endswith('"'):
+                in_translation = False
+
+        if '/codon_start=' in line:
+            codon_start = int(line.strip().split('=')[1])
+
+        # CDS 区域坐标：从 "FT   CDS" 开始，到连续 FT 行结束
+        if cds_state == 0 and line.startswith("FT   CDS"):
+            cds_state = 1
+        elif cds_state == 1 and not line.startswith("FT"):
+            cds_state = 2
+        if cds_state == 1:
+            cds_coords.extend((int(s) - 1, int(e)) for s, e in re.findall(r"(\d+)\.\.(\d+)", line))
+
+        # exon 坐标及编号（编号在 exon 行的下一行）
+        if pending_exon is not None:
+            exon_num_match = re.search(r'/number="(\d+)"', line)
+            if exon_num_match:
+                exon_number_coords[int(exon_num_match.group(1))] = pending_exon
+            pending_exon = None
+        if line.startswith("FT   exon"):
+            ex_match = re.search(r"(\d+)\.\.(\d+)", line)
+            if ex_match:
+                pending_exon = (int(ex_match.group(1)) - 1, int(ex_match.group(2)))  # Python 0-based
+                exon_coords.append(pending_exon)
+
+        # DNA 序列行（清洗与拼接由 assemble_dna 完成）
+        if line.startswith("SQ"):
+            in_seq = True
+        elif in_seq:
+            sq_lines.append(line)
+
+    translation_aa = "".join(translation_parts)
+    return {
+        "allele_full": allele_full,
+        "cls": cls,
+        # 最终 strip 一下，保险起见
+        "translation_aa": translation_aa.strip() if translation_aa else None,
+        "codon_start": codon_start,
+        "cds_coords": cds_coords,
+        "exon_coords": exon_coords,
+        "exon_number_coords": exon_number_coords,
+        "sq_lines": sq_lines,
+    }
 
-        # 跳过 null allele
-        if allele_full.endswith("N"):
-            print(f"跳过 null allele: {allele_full}")
-            continue
 
-        # 只保留经典基因
-        locus = allele_full.split("*")[0]
-        if locus not in classical_genes:
-            print(f"跳过非经典基因: {allele_full}")
-            continue
+def assemble_dna(sq_lines):
+    """去除 SQ 区块中的空格与位置编号，拼接为大写 DNA 序列"""
+    return "".join(re.sub(r"[^ACGTacgt]", "", line) for line in sq_lines).upper()
 
-        # 构造 4-digit allele
-        fields = allele_full.split("*")[1].split(":")
-        if len(fields) < 2:
-            print(f"跳过格式错误: {allele_full}")
-            continue
-        allele4 = f"{locus}*{fields[0]}:{fields[1]}"
-        if allele4 in seen_allele4:
-            print(f"跳过重复 4-digit allele: {allele4}")
-            continue
-        print(f"处理 allele: {allele4} (class {cls})")
-
-        # 提取 /translation（多行拼接）和 /codon_start
-        translation_aa = ""
-        in_translation = False
-        codon_start = 1  # 默认值
-
-        for line in lines:
-            if '/translation="' in line:
-                in_translation = True
-                part = line.split('="')[1].strip()
-                translation_aa += part.rstrip('"')
-                if part.endswith('"'):
-                    in_translation = False
-            elif in_translation:
-                # 去除行首的 "FT" 和空格，保留实际氨基酸序列
-                aa_part = line.strip()
-                if aa_part.startswith("FT"):
-                    aa_part = aa_part[2:].strip()
-                translation_aa += aa_part.rstrip('"')
-                if line.strip().endswith('"'):
-                    in_translation = False
-            elif line.strip().startswith('/codon_start='):
-                codon_start = int(line.strip().split('=')[1])
 
-        # 最终 strip 一下，保险起见
-        translation_aa = translation_aa.strip() if translation_aa else None
-
-        # 获取 CDS 区域坐标（拼接所有 CDS 相关的 FT 行）
-        cds_txt_lines = []
-        in_cds = False
-        for line in lines:
-            if line.startswith("FT   CDS"):
-                in_cds = True
-                cds_txt_lines.append(line)
-            elif in_cds and line.startswith("FT"):
-                cds_txt_lines.append(line)
-            elif in_cds:
-                break
-        cds_txt = "\n".join(cds_txt_lines)
+# ------------------ 密码子查找表 ------------------
+# 标准遗传密码（NCBI table 1），密码子按 TCAG 顺序编号：index = 16 * b1 + 4 * b2 + b3
+CODON_BASES = "TCAG"
+CODON_AMINO_ACIDS = "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG"
+_BASE_CODE = np.full(256, 255, dtype=np.uint8)
+for _i, _base in enumerate(CODON_BASES):
+    _BASE_CODE[ord(_base)] = _i
+_CODON_TO_AA = np.frombuffer(CODON_AMINO_ACIDS.encode("ascii"), dtype=np.uint8)
 
-        coords = re.findall(r"(\d+)\.\.(\d+)", cds_txt)
-        if not coords:
-            print(f"跳过无 CDS: {allele_full}")
-            continue
-        cds_coords = [(int(s) - 1, int(e)) for s, e in coords]  # 注意减1：python index从0开始
-        print(f"CDS 坐标: {cds_coords}")
-
-        # 获取 exon 坐标（用于 later exon 切片）
-        exon_coords = []
-        for line in lines:
-            if line.startswith("FT   exon"):
-                ex_match = re.search(r"(\d+)\.\.(\d+)", line)
-                if ex_match:
-                    start = int(ex_match.group(1)) - 1  # Python 0-based
-                    end = int(ex_match.group(2))
-                    exon_coords.append((start, end))
-
-        print(f"exon 区段: {exon_coords}")
-
-        # 获取 DNA 序列
-        in_seq = False
-        dna_lines = []
-        for line in lines:
-            if line.startswith("SQ"):
-                in_seq = True
-                continue
-            if in_seq:
-                dna_lines.append(re.sub(r"[^ACGTacgt]", "", line))
-        dna = "".join(dna_lines).upper()
-        if not dna:
-            print(f"跳过: 无 DNA 序列")
-            continue
 
-        # 提取 CDS 段落并处理 codon_start 偏移（只对第一段偏移）
-        cds_segs = []
-        for idx, (s, e) in enumerate(cds_coords):
-            seg = dna[s:e]
-            if idx == 0:
-                seg = seg[codon_start - 1:]  # 只对第一段偏移
-            cds_segs.append(seg)
-
-        cds_full = "".join(cds_segs)
-        cds_full = cds_full[:len(cds_full)//3*3]
-
-
-        aa_full = str(Seq(cds_full).translate(table=1))
-        print(f"翻译长度: {len(aa_full)} 氨基酸")
-
-        # 定位 exon 片段
-        # 提取 codon_start (前面已有，不变)
-        codon_start = 1  # 默认值
-        for line in lines:
-            if '/codon_start=' in line:
-                codon_start = int(line.strip().split('=')[1])
-
-        # 提取 exon number 和坐标
-        exon_number_coords = {}
-        for i, line in enumerate(lines):
-            if line.strip().startswith("FT   exon"):
-                exon_coord_match = re.search(r'(\d+)\.\.(\d+)', line)
-                exon_num_match = re.search(r'/number="(\d+)"', lines[i+1] if i+1 < len(lines) else "")
-                if exon_coord_match and exon_num_match:
-                    exon_number = int(exon_num_match.group(1))
-                    start, end = int(exon_coord_match.group(1)) - 1, int(exon_coord_match.group(2))
-                    exon_number_coords[exon_number] = (start, end)
-
-        # 根据 exon_number 获取 exon1 (用于记录), exon2, exon3
-        exon1 = exon_number_coords.get(1, None)
-        exon2 = exon_number_coords.get(2, None)
-        exon3 = exon_number_coords.get(3, None)
-
-        # 检查 exon2 是否存在（必需）
-        if exon2 is None:
-            print(f"跳过: exon2 不存在")
-            continue
+def translate_dna(dna):
+    """
+    按标准遗传密码翻译 DNA（只含 ACGT 的大写字符串，尾部不足一个密码子的碱基忽略），
+    与 Bio.Seq.translate(table=1) 的结果一致。在字节缓冲区上整体查表，不逐个密码子循环。
+    """
+    codes = _BASE_CODE[np.frombuffer(dna.encode("ascii"), dtype=np.uint8)]
+    n = len(codes) // 3 * 3
+    if (codes[:n] == 255).any():
+        raise ValueError("DNA 序列中含有 ACGT 以外的字符")
+    codons = codes[0:n:3].astype(np.intp) * 16 + codes[1:n:3] * 4 + codes[2:n:3]
+    return _CODON_TO_AA[codons].tobytes().decode("ascii")
 
-        # 拼接分析用 exon（只用于 exon2 + exon3）
-        analysis_exon_segs = []
-        analysis_exon_segs.append(dna[exon2[0]:exon2[1]])
-        if cls == "I":
-            if exon3:
-                analysis_exon_segs.append(dna[exon3[0]:exon3[1]])
-            else:
-                print(f"跳过: class I exon3 不存在")
-                continue
 
-        exon_dna = "".join(analysis_exon_segs)
+# 支持的经典HLA基因
+CLASSICAL_GENES = {"A", "B", "C", "DRB1", "DRB3", "DRB4", "DRB5", "DQA1", "DQB1", "DPA1", "DPB1"}
+MIN_EXON_AA_LENGTH = 50  # 定义最小合理长度
+RECORDS_PER_TASK = 64  # 并行模式下每个任务包含的 record 数
 
-        # codon_start 偏移仅当 exon1 缺失时使用
-        if exon1 is None and codon_start > 1:
-            exon_dna = exon_dna[codon_start - 1:]
 
-        # 确保长度为3的倍数
-        exon_dna = exon_dna[:len(exon_dna)//3*3]
+class ParseStats:
+    """
+    解析过程的结构化统计：各跳过原因的计数与各阶段的累计耗时（秒）。
 
-        # 翻译为氨基酸（分析+验证用）
-        print(f"exon_dna is {exon_dna}")
+    阶段：split（读取并切分 record）、coords（单次遍历提取字段与坐标）、
+    dna（拼接 DNA 与 exon 片段）、translate（3 个 reading frame 的查表翻译）、
+    frame（reading frame 与 /translation 的匹配）。
+    """
 
-        # 尝试3个reading frame，找最匹配translation_aa的那个
-        best_match = ""
-        best_offset = -1
+    STAGES = ("split", "coords", "dna", "translate", "frame")
 
-        for offset in range(3):
-            frame_dna = exon_dna[offset:]
-            frame_dna = frame_dna[:len(frame_dna) // 3 * 3]
-            frame_aa = str(Seq(frame_dna).translate(table=1))
-            if frame_aa in translation_aa:
-                best_match = frame_aa
-                best_offset = offset
-                break  # 完全匹配直接选用
-            if len(frame_aa) > len(best_match):
-                best_match = frame_aa
-                best_offset = offset
+    def __init__(self):
+        self.counts = Counter()
+        self.timers = defaultdict(float)
 
-        exon_aa = best_match.split("*", 1)[0]
-        print(f"✅ 使用 reading frame {best_offset} 翻译")
-        print(f"exon_aa is {exon_aa}")
+    def add_time(self, stage, seconds):
+        self.timers[stage] += seconds
 
-        # 与 translation 注释比对 (严格版本)
-        MIN_EXON_AA_LENGTH = 50  # 定义最小合理长度
+    def merge(self, other):
+        self.counts.update(other["counts"])
+        for stage, seconds in other["timers"].items():
+            self.timers[stage] += seconds
 
-        if translation_aa:
-            if len(exon_aa) < MIN_EXON_AA_LENGTH:
-                print(f"跳过: exon氨基酸序列过短 ({len(exon_aa)} 个氨基酸)")
-                continue
-            if exon_aa not in translation_aa:
-                print(f"跳过: exon翻译与 /translation 不匹配")
-                print(f"[Translation片段开头] {translation_aa[:60]}...")
-                print(f"[Exon翻译片段]      {exon_aa[:60]}...")
-                print(f"[Translation长度] {len(translation_aa)}")
-                print(f"[Exon翻译长度]    {len(exon_aa)}")
+    def to_dict(self):
+        return {
+            "records": sum(self.counts.values()),
+            "counts": dict(self.counts.most_common()),
+            "timers": {stage: round(self.timers[stage], 6) for stage in self.STAGES},
+        }
+
+    def print_summary(self):
+        print("\n📊 解析统计:")
+        for reason, n in self.counts.most_common():
+            print(f"  {reason:<20} {n:>8d}")
+        print("⏱️ 阶段耗时:")
+        for stage in self.STAGES:
+            print(f"  {stage:<20} {self.timers[stage]:>8.3f} s")
+
+
+def _no_log(message):
+    pass
+
+
+def process_record(lines, seen_allele4=None, log=print, stats=None):
+    """
+    处理单条 record，提取 exon2(+3) 的氨基酸序列。
+
+    参数：
+        lines (list): record 的行列表
+        seen_allele4 (set): 已成功解析的 4-digit allele，提供时在翻译前跳过重复型别
+        log (callable): 日志输出函数
+        stats (ParseStats): 提供时累计各阶段耗时
+
+    返回：
+        tuple: (allele4, class, seq, skip_reason)。成功时 skip_reason 为 None；
+        allele4 在构造出 4-digit 名称之后才非 None，供调用方做去重。
+    """
+    if not lines[0].startswith("ID"):
+        return None, None, None, "not_record"
+
+    t0 = time.perf_counter()
+    fields = extract_record_fields(lines)
+    if stats is not None:
+        stats.add_time("coords", time.perf_counter() - t0)
+    allele_full, cls = fields["allele_full"], fields["cls"]
+    if not allele_full or cls is None:
+        log("跳过: 无法识别 DE 行")
+        return None, None, None, "unrecognized_de"
+
+    # 跳过 null allele
+    if allele_full.endswith("N"):
+        log(f"跳过 null allele: {allele_full}")
+        return None, None, None, "null_allele"
+
+    # 只保留经典基因
+    locus = allele_full.split("*")[0]
+    if locus not in CLASSICAL_GENES:
+        log(f"跳过非经典基因: {allele_full}")
+        return None, None, None, "non_classical"
+
+    # 构造 4-digit allele
+    allele_fields = allele_full.split("*")[1].split(":")
+    if len(allele_fields) < 2:
+        log(f"跳过格式错误: {allele_full}")
+        return None, None, None, "bad_format"
+    allele4 = f"{locus}*{allele_fields[0]}:{allele_fields[1]}"
+    if seen_allele4 is not None and allele4 in seen_allele4:
+        log(f"跳过重复 4-digit allele: {allele4}")
+        return allele4, None, None, "duplicate_allele4"
+    log(f"处理 allele: {allele4} (class {cls})")
+
+    translation_aa = fields["translation_aa"]
+    codon_start = fields["codon_start"]
+
+    cds_coords = fields["cds_coords"]  # 注意减1：python index从0开始
+    if not cds_coords:
+        log(f"跳过无 CDS: {allele_full}")
+        return allele4, None, None, "no_cds"
+    log(f"CDS 坐标: {cds_coords}")
+
+    # exon 坐标（用于 later exon 切片）
+    exon_coords = fields["exon_coords"]
+    log(f"exon 区段: {exon_coords}")
+
+    # 获取 DNA 序列
+    t0 = time.perf_counter()
+    dna = assemble_dna(fields["sq_lines"])
+    if not dna:
+        log(f"跳过: 无 DNA 序列")
+        return allele4, None, None, "no_dna"
+
+    # CDS 段落的总长度；完整 CDS 的翻译不参与结果，只需密码子数。
+    # 与原始日志保持一致：这里不按 codon_start 偏移（原实现在此处从未读到 codon_start，始终按 1 计算）
+    cds_length = sum(max(0, min(e, len(dna)) - s) for s, e in cds_coords)
+    log(f"翻译长度: {cds_length // 3} 氨基酸")
+
+    # exon number -> 坐标
+    exon_number_coords = fields["exon_number_coords"]
+
+    # 根据 exon_number 获取 exon1 (用于记录), exon2, exon3
+    exon1 = exon_number_coords.get(1, None)
+    exon2 = exon_number_coords.get(2, None)
+    exon3 = exon_number_coords.get(3, None)
+
+    # 检查 exon2 是否存在（必需）
+    if exon2 is None:
+        log(f"跳过: exon2 不存在")
+        return allele4, None, None, "no_exon2"
+
+    # 拼接分析用 exon（只用于 exon2 + exon3）
+    analysis_exon_segs = []
+    analysis_exon_segs.append(dna[exon2[0]:exon2[1]])
+    if cls == "I":
+        if exon3:
+            analysis_exon_segs.append(dna[exon3[0]:exon3[1]])
+        else:
+            log(f"跳过: class I exon3 不存在")
+            return allele4, None, None, "no_exon3"
+
+    exon_dna = "".join(analysis_exon_segs)
+
+    # codon_start 偏移仅当 exon1 缺失时使用
+    if exon1 is None and codon_start > 1:
+        exon_dna = exon_dna[codon_start - 1:]
+
+    # 确保长度为3的倍数
+    exon_dna = exon_dna[:len(exon_dna)//3*3]
+    t1 = time.perf_counter()
+    if stats is not None:
+        stats.add_time("dna", t1 - t0)
+
+    # 翻译为氨基酸（分析+验证用）
+    log(f"exon_dna is {exon_dna}")
+
+    # 尝试3个reading frame，找最匹配translation_aa的那个
+    frames = [translate_dna(exon_dna[offset:]) for offset in range(3)]
+    t0 = time.perf_counter()
+    if stats is not None:
+        stats.add_time("translate", t0 - t1)
+
+    best_match = ""
+    best_offset = -1
+    # /translation 中没有终止密码子时，含 "*" 的 frame 不可能是其子串，无需搜索
+    stop_free = "*" not in translation_aa
+
+    for offset, frame_aa in enumerate(frames):
+        if not (stop_free and "*" in frame_aa) and frame_aa in translation_aa:
+            best_match = frame_aa
+            best_offset = offset
+            break  # 完全匹配直接选用
+        if len(frame_aa) > len(best_match):
+            best_match = frame_aa
+            best_offset = offset
+
+    exon_aa = best_match.split("*", 1)[0]
+    if stats is not None:
+        stats.add_time("frame", time.perf_counter() - t0)
+    log(f"✅ 使用 reading frame {best_offset} 翻译")
+    log(f"exon_aa is {exon_aa}")
+
+    # 与 translation 注释比对 (严格版本)
+    if translation_aa:
+        if len(exon_aa) < MIN_EXON_AA_LENGTH:
+            log(f"跳过: exon氨基酸序列过短 ({len(exon_aa)} 个氨基酸)")
+            return allele4, None, None, "too_short"
+        if exon_aa not in translation_aa:
+            log(f"跳过: exon翻译与 /translation 不匹配")
+            log(f"[Translation片段开头] {translation_aa[:60]}...")
+            log(f"[Exon翻译片段]      {exon_aa[:60]}...")
+            log(f"[Translation长度] {len(translation_aa)}")
+            log(f"[Exon翻译长度]    {len(exon_aa)}")
+            return allele4, None, None, "frame_mismatch"
+        else:
+            log(f"✅ exon翻译在 /translation 中匹配成功 (长度 {len(exon_aa)} 个氨基酸)")
+
+    return allele4, cls, exon_aa, None
+
+
+def _process_task(task, quiet=False):
+    """并行 worker：处理一批 (ordinal, lines)，日志与耗时统计交给主进程按文件顺序合并"""
+    stats = ParseStats()
+    results = []
+    for ordinal, lines in task:
+        messages = []
+        allele4, cls, seq, reason = process_record(
+            lines, log=_no_log if quiet else messages.append, stats=stats)
+        results.append((ordinal, allele4, cls, seq, reason, messages))
+    return results, stats.to_dict()
+
+
+class RecordCache:
+    """
+    hla.dat 逐条 record 的指纹缓存，用于跨 IMGT 版本增量重建。
+
+    以 accession（ID 行中的 HLAxxxxx）为键，保存 record 内容的 sha1 及其解析结果
+    (allele4, class, seq, skip_reason)。新版本中内容未变的 record 直接复用缓存结果，
+    只有新增或改动的 record 需要重新翻译。
+    """
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.live = set()
+        self.hits = self.misses = 0
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION:
+                self.entries = data["records"]
+
+    @staticmethod
+    def fingerprint(lines):
+        """返回 (accession, 内容哈希)；非 ID 开头的 record 返回 (None, None)"""
+        if not lines[0].startswith("ID"):
+            return None, None
+        accession = lines[0].split()[1].rstrip(";")
+        return accession, hashlib.sha1("\n".join(lines).encode('utf-8')).hexdigest()
+
+    def lookup(self, accession, digest):
+        if accession is None:
+            return None
+        self.live.add(accession)
+        entry = self.entries.get(accession)
+        if entry is not None and entry[0] == digest:
+            self.hits += 1
+            return tuple(entry[1:])
+        self.misses += 1
+        return None
+
+    def store(self, accession, digest, result):
+        if accession is not None:
+            self.entries[accession] = [digest, *result]
+
+    def save(self, prune=True):
+        """写回缓存；prune 时删除本次未出现的 record（完整解析时才应剪枝）"""
+        if prune:
+            self.entries = {k: v for k, v in self.entries.items() if k in self.live}
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"version": self.VERSION, "records": self.entries}, f)
+        os.replace(tmp_path, self.path)
+
+
+def _submit_batch(batch, pool, cache, quiet=False):
+    """为一批 (ordinal, lines) 查询缓存，未命中的 record 提交给进程池（或直接处理）"""
+    items, todo = [], []
+    for ordinal, lines in batch:
+        accession = digest = cached = None
+        if cache is not None:
+            accession, digest = cache.fingerprint(lines)
+            cached = cache.lookup(accession, digest)
+        items.append((ordinal, accession, digest, cached))
+        if cached is None:
+            todo.append((ordinal, lines))
+    if pool is not None and todo:
+        return items, pool.apply_async(_process_task, (todo, quiet))
+    return items, _process_task(todo, quiet)
+
+
+def _collect_batch(submitted, cache, stats):
+    """按文件顺序合并缓存命中与新处理的结果，并把新结果写入缓存"""
+    items, results = submitted
+    if hasattr(results, "get"):
+        results = results.get()
+    results, task_stats = results
+    stats.merge(task_stats)
+    by_ordinal = {result[0]: result for result in results}
+    for ordinal, accession, digest, cached in items:
+        if cached is not None:
+            yield (ordinal, *cached, [])
+            continue
+        result = by_ordinal[ordinal]
+        if cache is not None:
+            cache.store(accession, digest, result[1:5])
+        yield result
+
+
+def _timed_records(dat_path, stats):
+    """逐条产出 (ordinal, lines)，并把读取与切分 record 的耗时计入 split 阶段"""
+    records = iter_dat_records(dat_path)
+    ordinal = 0
+    while True:
+        t0 = time.perf_counter()
+        lines = next(records, None)
+        stats.add_time("split", time.perf_counter() - t0)
+        if lines is None:
+            return
+        yield ordinal, lines
+        ordinal += 1
+
+
+def _iter_record_results(dat_path, workers=1, cache=None, seen_allele4=None, quiet=False, stats=None):
+    """
+    按文件顺序产出 (ordinal, allele4, class, seq, skip_reason, messages)。
+
+    串行且不使用缓存时，直接在 process_record 中去重并输出日志（messages 为 None）；
+    否则每条 record 独立处理，由调用方按文件顺序去重。并行模式下同时在途的任务数有上限，
+    读取进度不会远超合并进度，内存占用保持有界。
+    """
+    from collections import deque
+    from itertools import islice
+    from multiprocessing import Pool
+
+    stats = stats if stats is not None else ParseStats()
+    records = _timed_records(dat_path, stats)
+    if workers <= 1 and cache is None:
+        log = _no_log if quiet else print
+        for ordinal, lines in records:
+            yield (ordinal, *process_record(lines, seen_allele4, log, stats), None)
+        return
+
+    with (Pool(workers) if workers > 1 else contextlib.nullcontext()) as pool:
+        pending = deque()
+        while True:
+            batch = list(islice(records, RECORDS_PER_TASK))
+            if batch:
+                pending.append(_submit_batch(batch, pool, cache, quiet))
+            if pending and (not batch or len(pending) >= 2 * workers):
+                yield from _collect_batch(pending.popleft(), cache, stats)
+            elif not batch:
+                break
+
+
+def parse_hla_dat_4res(dat_path, top=None, workers=1, cache=None, quiet=False, stats=None):
+    """
+    解析 HLA .dat 文件，提取 HLA Class I 的 exon2+3 和 Class II 的 exon2 的氨基酸序列。
+    逐条流式读取 record，每条 record 只遍历一次。
+
+    参数：
+        dat_path (str): .dat 文件路径
+        top (int): 限制解析的记录数，用于调试
+        workers (int): 并行解析的进程数；大于 1 时结果按文件顺序合并，与串行输出完全一致
+        cache (RecordCache): 逐条 record 的指纹缓存，命中时跳过翻译
+        quiet (bool): 不输出逐条 record 的日志
+        stats (ParseStats): 提供时累计各跳过原因的计数和各阶段耗时
+
+    返回：
+        dict: {allele4: {"class": "I" or "II", "seq": translated_aa_sequence}}
+    """
+    seen_allele4 = set()
+    mapping = {}
+
+    stats = stats if stats is not None else ParseStats()
+    log = _no_log if quiet else print
+    results = _iter_record_results(dat_path, workers, cache, seen_allele4, quiet, stats)
+
+    count = 0
+    for ordinal, allele4, cls, seq, reason, messages in results:
+        # 并行/缓存模式下单条 record 不知道已出现的型别，这里按文件顺序补做首次出现去重
+        if messages is not None:
+            if allele4 is not None and allele4 in seen_allele4:
+                log(f"跳过重复 4-digit allele: {allele4}")
+                stats.counts["duplicate_allele4"] += 1
                 continue
-            else:
-                print(f"✅ exon翻译在 /translation 中匹配成功 (长度 {len(exon_aa)} 个氨基酸)")
+            for message in messages:
+                print(message)
+        if seq is None:
+            stats.counts[reason] += 1
+            continue
+        stats.counts["parsed"] += 1
 
         # 最终存储（直接使用 exon_aa）
-        mapping[allele4] = {"class": cls, "seq": exon_aa}
-
+        mapping[allele4] = {"class": cls, "seq": seq}
 
         seen_allele4.add(allele4)
         count += 1
-        print(f"当前已成功解析记录数：{count}")
+        log(f"当前已成功解析记录数：{count}")
         if top is not None and count >= top:
-            print(f"已达到 top={top} 限制，停止解析。")
+            log(f"已达到 top={top} 限制，停止解析。")
             break
 
     return mapping
@@ -273,17 +611,84 @@ def write_mapping_to_fasta(mapping, output_path):
             for i in range(0, len(seq), 60):
                 f.write(seq[i:i+60] + '\n')
 
-def main():
-    dat_file = "./data/hla.dat"
-    # dat_file = "./data/test1.dat"
-    mapping = parse_hla_dat_4res(dat_file, top=None)
-    print("\nParsed sequences:", list(mapping.keys()))
+def read_fasta_mapping(fasta_path):
+    """读取已有的输出 fasta，返回与 parse_hla_dat_4res 相同结构的 mapping"""
+    from seq_store import read_fasta_records
+
+    return {allele: {"class": cls, "seq": seq} for allele, cls, seq in read_fasta_records(fasta_path)}
+
+
+def diff_mappings(old, new):
+    """比较两个版本的 mapping，返回 [(change, allele4), ...]，change 为 added/removed/changed"""
+    changes = [("added", a) for a in new if a not in old]
+    changes += [("removed", a) for a in old if a not in new]
+    changes += [("changed", a) for a in new if a in old and new[a] != old[a]]
+    return changes
 
-    # 新增的输出调用
-    output_fasta = "./data/hla_exon_sequences.fasta"
-    print(mapping)
+
+def write_changelog(changes, old, new, output_path):
+    with open(output_path, 'w', encoding='utf-8') as f:
+        f.write("change\tallele4\told_length\tnew_length\n")
+        for change, allele4 in changes:
+            old_len = len(old[allele4]["seq"]) if allele4 in old else ""
+            new_len = len(new[allele4]["seq"]) if allele4 in new else ""
+            f.write(f"{change}\t{allele4}\t{old_len}\t{new_len}\n")
+
+
+@click.command()
+@click.option('--dat', 'dat_file', default="./data/hla.dat", help='IMGT/HLA 的 hla.dat 文件，可为 hla.dat.zip 或 .gz')
+@click.option('--output', '-o', 'output_fasta', default="./data/hla_exon_sequences.fasta", help='输出的 exon 氨基酸序列 fasta 文件')
+@click.option('--top', type=int, default=None, help='限制解析的记录数，用于调试')
+@click.option('--workers', '-w', type=int, default=1, show_default=True, help='并行解析的进程数')
+@click.option('--cache', 'cache_path', default=None, help='逐条 record 的指纹缓存文件（JSON），用于跨版本增量重建')
+@click.option('--quiet', '-q', is_flag=True, help='不输出逐条 record 的日志，只输出汇总统计')
+@click.option('--report', default=None, help='将跳过原因计数与各阶段耗时写入 JSON 报告')
+@click.option('--changelog', default=None, help='与上一版输出 fasta 的差异列表（默认与输出同名的 .changelog.tsv，仅在使用 --cache 时写出）')
+def main(dat_file, output_fasta, top, workers, cache_path, quiet, report, changelog):
+    # dat_file = "./data/test1.dat"
+    # 3.56.0 之后 IPD-IMGT 只发布 hla.dat.zip，未解压时直接读取压缩包
+    if not os.path.exists(dat_file) and os.path.exists(dat_file + ".zip"):
+        dat_file = dat_file + ".zip"
+    cache = RecordCache(cache_path) if cache_path else None
+    previous = read_fasta_mapping(output_fasta) if cache and os.path.exists(output_fasta) else {}
+
+    stats = ParseStats()
+    t0 = time.perf_counter()
+    mapping = parse_hla_dat_4res(dat_file, top=top, workers=workers, cache=cache, quiet=quiet, stats=stats)
+    elapsed = time.perf_counter() - t0
+    if not quiet:
+        print("\nParsed sequences:", list(mapping.keys()))
+
+        # 新增的输出调用
+        print(mapping)
     write_mapping_to_fasta(mapping, output_fasta)
     print(f"成功将结果写入到 {output_fasta}")
 
+    stats.print_summary()
+    print(f"  {'total':<20} {elapsed:>8.3f} s")
+    if report:
+        summary = stats.to_dict()
+        summary.update({"dat": dat_file, "output": output_fasta, "workers": workers,
+                        "alleles": len(mapping), "elapsed": round(elapsed, 6)})
+        if cache:
+            summary["cache"] = {"hits": cache.hits, "misses": cache.misses}
+        with open(report, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"统计报告已写入 {report}")
+
+    if cache:
+        cache.save(prune=top is None)
+        print(f"缓存命中 {cache.hits} 条 record，重新解析 {cache.misses} 条")
+
+        changes = diff_mappings(previous, mapping)
+        changelog = changelog or os.path.splitext(output_fasta)[0] + ".changelog.tsv"
+        write_changelog(changes, previous, mapping, changelog)
+        counts = {kind: sum(1 for c, _ in changes if c == kind) for kind in ("added", "removed", "changed")}
+        print(f"版本差异: 新增 {counts['added']}, 删除 {counts['removed']}, 改变 {counts['changed']} -> {changelog}")
+
+        # 重建派生索引：序列存储在来源 fasta 变化后自动重新编译
+        from seq_store import load_sequence_store
+        load_sequence_store(output_fasta)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+氨基酸替换距离核的注册表。
+
+每个距离核是一个 20x20 的氨基酸距离矩阵（AA_LIST 顺序），使用时编译为 21x21 的稠密查找表
+（最后一行/列为未知残基，距离恒为 0）。多个距离核可以堆叠为 (21*21, K) 的表，
+对一批配对只做一次残基配对编码 (code1 * 21 + code2)，一次查表同时得到 K 种距离。
+
+内置距离核：
+    grantham   Grantham (1974) 距离，即原 HED
+    sandberg   Sandberg et al. (1998) 五维 z-scale 描述符之间的欧氏距离
+    p          p-distance：残基不同记 1，相同记 0（HED 即为差异位点比例）
+    blosum62   由 BLOSUM62 得分导出的距离 d(a, b) = (s(a, a) + s(b, b)) / 2 - s(a, b)
+
+本模块导入时只依赖标准库（compute_HED_pairewise.py 只需要标量函数），numpy 在编译查找表时才导入。
+"""
+
+from functools import lru_cache
+
+# ------------------ Grantham Distance Matrix ------------------
+AA_LIST = ['A', 'R', 'N', 'D', 'C', 'Q', 'E', 'G', 'H', 'I',
+           'L', 'K', 'M', 'F', 'P', 'S', 'T', 'W', 'Y', 'V']
+
+GRANTHAM_MATRIX = [
+    [0,112,111,126,195, 91,107, 60, 86, 94, 96,106, 84,113, 27, 99, 58,148,112, 64],
+    [112,  0, 86, 96,180, 43, 54,125, 29, 97,102, 26, 91, 97,103,110, 71,101, 77, 96],
+    [111, 86,  0, 23,139, 46, 42, 80, 68,149,153, 94,142,160, 91, 46, 65,174,143,133],
+    [126, 96, 23,  0,154, 61, 45, 94, 81,168,172,101,160,177,108, 65, 85,181,160,152],
+    [195,180,139,154,  0,154,170,159,174,198,198,202,196,205,169,112,149,215,194,192],
+    [ 91, 43, 46, 61,154,  0, 29, 87, 24,109,113, 53,101,116, 76, 68, 42,130, 99, 96],
+    [107, 54, 42, 45,170, 29,  0, 98, 40,134,138, 56,126,152, 93, 80, 65,181,140,121],
+    [ 60,125, 80, 94,159, 87, 98,  0, 98,135,138,127,127,153, 42, 56, 59,184,147,109],
+    [ 86, 29, 68, 81,174, 24, 40, 98,  0, 94, 99, 32, 87,100, 77, 89, 47,115, 83, 84],
+    [ 94, 97,149,168,198,109,134,135, 94,  0,  5,102, 10, 21, 95,142, 89, 61, 33, 29],
+    [ 96,102,153,172,198,113,138,138, 99,  5,  0,107, 21, 22, 98,145, 92, 61, 36, 32],
+    [106, 26, 94,101,202, 53, 56,127, 32,102,107,  0, 95,103,103,121, 78,110, 85, 97],
+    [ 84, 91,142,160,196,101,126,127, 87, 10, 21, 95,  0, 28, 87,135, 81, 84, 36, 21],
+    [113, 97,160,177,205,116,152,153,100, 21, 22,103, 28,  0,114,155,103, 40, 22, 50],
+    [ 27,103, 91,108,169, 76, 93, 42, 77, 95, 98,103, 87,114,  0, 74, 38,147,110, 68],
+    [ 99,110, 46, 65,112, 68, 80, 56, 89,142,145,121,135,155, 74,  0, 58,177,144,124],
+    [ 58, 71, 65, 85,149, 42, 65, 59, 47, 89, 92, 78, 81,103, 38, 58,  0,128, 92, 69],
+    [148,101,174,181,215,130,181,184,115, 61, 61,110, 84, 40,147,177,128,  0, 37, 88],
+    [112, 77,143,160,194, 99,140,147, 83, 33, 36, 85, 36, 22,110,144, 92, 37,  0, 55],
+    [ 64, 96,133,152,192, 96,121,109, 84, 29, 32, 97, 21, 50, 68,124, 69, 88, 55,  0]
+]
+
+GRANTHAM = {(AA_LIST[i], AA_LIST[j]): GRANTHAM_MATRIX[i][j] for i in range(20) for j in range(20)}
+
+# ------------------ BLOSUM62（AA_LIST 顺序） ------------------
+BLOSUM62_MATRIX = [
+    [ 4,-1,-2,-2, 0,-1,-1, 0,-2,-1,-1,-1,-1,-2,-1, 1, 0,-3,-2, 0],
+    [-1, 5, 0,-2,-3, 1, 0,-2, 0,-3,-2, 2,-1,-3,-2,-1,-1,-3,-2,-3],
+    [-2, 0, 6, 1,-3, 0, 0, 0, 1,-3,-3, 0,-2,-3,-2, 1, 0,-4,-2,-3],
+    [-2,-2, 1, 6,-3, 0, 2,-1,-1,-3,-4,-1,-3,-3,-1, 0,-1,-4,-3,-3],
+    [ 0,-3,-3,-3, 9,-3,-4,-3,-3,-1,-1,-3,-1,-2,-3,-1,-1,-2,-2,-1],
+    [-1, 1, 0, 0,-3, 5, 2,-2, 0,-3,-2, 1, 0,-3,-1, 0,-1,-2,-1,-2],
+    [-1, 0, 0, 2,-4, 2, 5,-2, 0,-3,-3, 1,-2,-3,-1, 0,-1,-3,-2,-2],
+    [ 0,-2, 0,-1,-3,-2,-2, 6,-2,-4,-4,-2,-3,-3,-2, 0,-2,-2,-3,-3],
+    [-2, 0, 1,-1,-3, 0, 0,-2, 8,-3,-3,-1,-2,-1,-2,-1,-2,-2, 2,-3],
+    [-1,-3,-3,-3,-1,-3,-3,-4,-3, 4, 2,-3, 1, 0,-3,-2,-1,-3,-1, 3],
+    [-1,-2,-3,-4,-1,-2,-3,-4,-3, 2, 4,-2, 2, 0,-3,-2,-1,-2,-1, 1],
+    [-1, 2, 0,-1,-3, 1, 1,-2,-1,-3,-2, 5,-1,-3,-1, 0,-1,-3,-2,-2],
+    [-1,-1,-2,-3,-1, 0,-2,-3,-2, 1, 2,-1, 5, 0,-2,-1,-1,-1,-1, 1],
+    [-2,-3,-3,-3,-2,-3,-3,-3,-1, 0, 0,-3, 0, 6,-4,-2,-2, 1, 3,-1],
+    [-1,-2,-2,-1,-3,-1,-1,-2,-2,-3,-3,-1,-2,-4, 7,-1,-1,-4,-3,-2],
+    [ 1,-1, 1, 0,-1, 0, 0, 0,-1,-2,-2, 0,-1,-2,-1, 4, 1,-3,-2,-2],
+    [ 0,-1, 0,-1,-1,-1,-1,-2,-2,-1,-1,-1,-1,-2,-1, 1, 5,-2,-2, 0],
+    [-3,-3,-4,-4,-2,-2,-3,-2,-2,-3,-2,-3,-1, 1,-4,-3,-2,11, 2,-3],
+    [-2,-2,-2,-3,-2,-1,-2,-3, 2,-1,-1,-2,-1, 3,-3,-2,-2, 2, 7,-1],
+    [ 0,-3,-3,-3,-1,-2,-2,-3,-3, 3, 1,-2, 1,-1,-2,-2, 0,-3,-1, 4]
+]
+
+# ------------------ Sandberg z-scales (z1-z5) ------------------
+SANDBERG_Z_SCALES = {
+    'A': ( 0.24, -2.32,  0.60, -0.14,  1.30),
+    'R': ( 3.52,  2.50, -3.50,  1.99, -0.17),
+    'N': ( 3.05,  1.62,  1.04, -1.15,  1.61),
+    'D': ( 3.98,  0.93,  1.93, -2.46,  0.75),
+    'C': ( 0.84, -1.67,  3.71,  0.18, -2.65),
+    'Q': ( 1.75,  0.50, -1.44, -1.34,  0.66),
+    'E': ( 3.11,  0.26, -0.11, -3.04, -0.25),
+    'G': ( 2.05, -4.06,  0.36, -0.82, -0.38),
+    'H': ( 2.47,  1.95,  0.26,  3.90,  0.09),
+    'I': (-3.89, -1.73, -1.71, -0.84,  0.26),
+    'L': (-4.28, -1.30, -1.49, -0.72,  0.84),
+    'K': ( 2.29,  0.89, -2.49,  1.49,  0.31),
+    'M': (-2.85, -0.22,  0.47,  1.94, -0.98),
+    'F': (-4.22,  1.94,  1.06,  0.54, -0.62),
+    'P': (-1.66,  0.27,  1.84,  0.70,  2.00),
+    'S': ( 2.39, -1.07,  1.15, -1.39,  0.67),
+    'T': ( 0.75, -2.18, -1.12, -1.46, -0.40),
+    'W': (-4.36,  3.94,  0.59,  3.44, -1.59),
+    'Y': (-2.54,  2.44,  0.43,  0.04, -1.47),
+    'V': (-2.59, -2.64, -1.54, -0.85, -0.02),
+}
+
+
+# ------------------ 标量 HED（逐位点参考实现） ------------------
+def grantham_distance(a1, a2):
+    return 0 if a1 == a2 else GRANTHAM.get((a1, a2), 0)
+
+def calculate_hed(s1, s2):
+    if len(s1) != len(s2):
+        raise ValueError(f"Length mismatch: {len(s1)} vs {len(s2)}")
+    total = sum(grantham_distance(a, b) for a, b in zip(s1, s2))
+    return total / len(s1)  # 注意这里是除以长度，不是 2.2
+
+
+# ------------------ 距离核注册表 ------------------
+KERNELS = {}
+
+
+def register_kernel(name, builder, description=""):
+    """
+    注册距离核。builder() 返回 AA_LIST 顺序的 20x20 距离矩阵（嵌套列表或数组），
+    要求对角线为 0（同一残基距离为 0，引擎据此让相同序列直接得到 0）。
+    """
+    KERNELS[name] = {"builder": builder, "description": description}
+    kernel_table.cache_clear()
+
+
+def _sandberg_distances():
+    z = [SANDBERG_Z_SCALES[aa] for aa in AA_LIST]
+    return [[sum((x - y) ** 2 for x, y in zip(z[i], z[j])) ** 0.5 for j in range(20)] for i in range(20)]
+
+
+def _p_distances():
+    return [[0 if i == j else 1 for j in range(20)] for i in range(20)]
+
+
+def _blosum62_distances():
+    s = BLOSUM62_MATRIX
+    return [[(s[i][i] + s[j][j]) / 2 - s[i][j] for j in range(20)] for i in range(20)]
+
+
+@lru_cache(maxsize=None)
+def kernel_table(name):
+    """将距离核编译为 21x21 float64 查找表（最后一行/列为未知残基，距离为 0）"""
+    import numpy as np
+
+    if name not in KERNELS:
+        raise ValueError(f"未知的距离核: {name}（可选: {', '.join(KERNELS)}）")
+    matrix = np.asarray(KERNELS[name]["builder"](), dtype=np.float64)
+    if matrix.shape != (20, 20) or np.any(np.diag(matrix) != 0):
+        raise ValueError(f"距离核 {name} 应为对角线为 0 的 20x20 矩阵")
+    table = np.zeros((21, 21), dtype=np.float64)
+    table[:20, :20] = matrix
+    table.setflags(write=False)
+    return table
+
+
+def stacked_kernel_tables(names):
+    """将多个距离核堆叠为 (21*21, K) 的查找表，行号为残基配对编码 code1 * 21 + code2"""
+    import numpy as np
+
+    return np.stack([kernel_table(name).ravel() for name in names], axis=1)
+
+
+register_kernel("grantham", lambda: GRANTHAM_MATRIX, "Grantham 距离（原 HED）")
+register_kernel("sandberg", _sandberg_distances, "Sandberg z-scale 欧氏距离")
+register_kernel("p", _p_distances, "p-distance（差异位点比例）")
+register_kernel("blosum62", _blosum62_distances, "BLOSUM62 导出距离 (s_aa + s_bb) / 2 - s_ab")
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+持久化的 HED 结果缓存（SQLite）。
+
+以 (距离名称, seq1, seq2) 为键，seq1/seq2 为两条唯一序列的摘要（见 compute_HED.sequence_digests），
+按 seq1 <= seq2 排序存储（HED 对称），值为 HED（长度不一致等无法计算的配对存为 NULL）。
+键只取决于序列本身，fasta 更新或型别改名后未变化的序列仍能命中。缓存容量有上限，超出时按
+最近使用时间淘汰，重复运行或队列有重叠时几乎不需要重新计算。
+当前条目数记录在 cache_meta 表中，由触发器随插入 / 删除增减，写入时不必每次 COUNT(*) 全表。
+"""
+
+import sqlite3
+import time
+
+import numpy as np
+
+DEFAULT_MAX_ENTRIES = 5_000_000
+
+
+class HedCache:
+    def __init__(self, path, namespace, max_entries=None):
+        self.namespace = namespace
+        self.max_entries = max_entries or DEFAULT_MAX_ENTRIES
+        self.hits = self.misses = 0
+        # 手动管理事务：读写都以 BEGIN IMMEDIATE 开始，多个 worker 并发时排队等待写锁，
+        # 避免读事务升级为写事务时的死锁（database is locked）
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sequence_hed (
+                namespace TEXT NOT NULL,
+                seq1 TEXT NOT NULL,
+                seq2 TEXT NOT NULL,
+                hed REAL,
+                last_used INTEGER NOT NULL,
+                PRIMARY KEY (namespace, seq1, seq2)
+            );
+            CREATE INDEX IF NOT EXISTS sequence_hed_last_used ON sequence_hed (last_used);
+            CREATE TABLE IF NOT EXISTS cache_meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+        """)
+        # 条目计数：触发器与计数初始化在同一个写事务中完成，已有的旧缓存只在第一次打开时 COUNT(*) 一次
+        self.conn.execute("BEGIN IMMEDIATE")
+        if self.conn.execute("SELECT 1 FROM cache_meta WHERE key = 'entries'").fetchone() is None:
+            # executescript 会先提交当前事务，这里逐条执行
+            self.conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS sequence_hed_count_insert AFTER INSERT ON sequence_hed
+                BEGIN
+                    UPDATE cache_meta SET value = value + 1 WHERE key = 'entries';
+                END
+            """)
+            self.conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS sequence_hed_count_delete AFTER DELETE ON sequence_hed
+                BEGIN
+                    UPDATE cache_meta SET value = value - 1 WHERE key = 'entries';
+                END
+            """)
+            self.conn.execute("INSERT INTO cache_meta (key, value) SELECT 'entries', COUNT(*) FROM sequence_hed")
+        self.conn.execute("COMMIT")
+
+    def _clock(self):
+        return time.time_ns()
+
+    def get_many(self, pairs):
+        """批量查询 [(seq1, seq2), ...]，返回 {位置: hed}（hed 可能为 None）"""
+        cur = self.conn.cursor()
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS query (k INTEGER PRIMARY KEY, seq1 TEXT, seq2 TEXT)")
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("DELETE FROM query")
+        cur.executemany("INSERT INTO query VALUES (?, ?, ?)", ((k, s1, s2) for k, (s1, s2) in enumerate(pairs)))
+        found = dict(cur.execute(
+            "SELECT q.k, h.hed FROM query q JOIN sequence_hed h "
+            "ON h.namespace = ? AND h.seq1 = q.seq1 AND h.seq2 = q.seq2",
+            (self.namespace,),
+        ))
+        cur.execute(
+            "UPDATE sequence_hed SET last_used = ? WHERE namespace = ? "
+            "AND (seq1, seq2) IN (SELECT seq1, seq2 FROM query)",
+            (self._clock(), self.namespace),
+        )
+        cur.execute("COMMIT")
+        return found
+
+    def put_many(self, pairs, heds):
+        now = self._clock()
+        self.conn.execute("BEGIN IMMEDIATE")
+        # 用 upsert 而不是 INSERT OR REPLACE：REPLACE 删除旧行时不触发删除触发器，会使条目计数偏大
+        self.conn.executemany(
+            "INSERT INTO sequence_hed VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (namespace, seq1, seq2) DO UPDATE SET hed = excluded.hed, last_used = excluded.last_used",
+            ((self.namespace, s1, s2, None if np.isnan(h) else float(h), now)
+             for (s1, s2), h in zip(pairs, heds)),
+        )
+        self._evict()
+        self.conn.execute("COMMIT")
+
+    def size(self):
+        (size,) = self.conn.execute("SELECT value FROM cache_meta WHERE key = 'entries'").fetchone()
+        return size
+
+    def _evict(self):
+        size = self.size()
+        if size > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM sequence_hed WHERE rowid IN (SELECT rowid FROM sequence_hed ORDER BY last_used LIMIT ?)",
+                (size - self.max_entries,),
+            )
+
+    def fetch_or_compute(self, keys, idx1, idx2, compute):
+        """
+        对唯一配对（keys[行号] 为序列摘要）先查缓存，
+        未命中的调用 compute(idx1, idx2) 计算并写回。返回与 idx1 等长的 float64 数组。
+        """
+        pairs = [tuple(sorted((keys[i], keys[j]))) for i, j in zip(idx1.tolist(), idx2.tolist())]
+        heds = np.full(len(pairs), np.nan)
+        found = self.get_many(pairs)
+        for k, hed in found.items():
+            heds[k] = np.nan if hed is None else hed
+
+        missing = np.array(sorted(set(range(len(pairs))) - found.keys()), dtype=np.int64)
+        self.hits += len(found)
+        self.misses += len(missing)
+        if len(missing):
+            heds[missing] = compute(idx1[missing], idx2[missing])
+            self.put_many([pairs[k] for k in missing.tolist()], heds[missing])
+        return heds
+
+    def close(self):
+        self.conn.close()
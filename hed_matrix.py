@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+预计算每个 HLA 位点的全对全 HED 矩阵，并以内存映射文件的形式供 compute_HED.py 查询。
+
+目录结构（默认 ./data/hed_matrix）：
+    manifest.json     来源 fasta 的 sha256 及各位点信息
+    alleles.tsv       allele -> (locus, index, length) 索引表，index 为位点内唯一序列的编号
+    {locus}.npy       压缩（上三角）uint32 Grantham 距离总和
+
+矩阵只在唯一序列之间构建，蛋白序列相同的型别共用同一行，构建耗时和体积按折叠比例缩小。
+
+矩阵中保存的是整数距离总和而不是 float32 的 HED 值，查询时再除以序列长度，
+这样查表结果与 calculate_hed 逐位一致；长度不一致的配对以 MISSING_TOTAL 标记。
+"""
+
+import json
+import os
+
+import click
+import numpy as np
+
+from compute_HED import GRANTHAM_TABLE, UNKNOWN_CODE, encode_allele_sequences, load_allele_sequences
+from seq_store import file_sha256
+
+MISSING_TOTAL = np.iinfo(np.uint32).max
+BLOCK_ROWS = 512
+
+
+def condensed_offset(i, n):
+    """上三角压缩存储中第 i 行（j > i 部分）的起始位置"""
+    return i * n - i * (i + 1) // 2
+
+
+def condensed_index(i, j, n):
+    """i < j 时 (i, j) 在压缩数组中的位置，支持 numpy 数组"""
+    return condensed_offset(i, n) + (j - i - 1)
+
+
+# ------------------ 构建矩阵 ------------------
+def grantham_totals_matrix(residues, lengths, block_rows=BLOCK_ROWS):
+    """
+    逐块计算上三角的 Grantham 距离总和，按行产出 (i, totals[i+1:])。
+
+    通过 one-hot 编码把逐位查表转化为矩阵乘法：
+        totals[i, j] = sum_p GRANTHAM_TABLE[r_i[p], r_j[p]]
+                     = (GRANTHAM_TABLE[r_i] 展平) · (onehot(r_j) 展平)
+    float32 对不超过 2^24 的整数是精确的，单条序列的总和远小于该上限。
+    """
+    n, width = residues.shape
+    n_codes = UNKNOWN_CODE + 1
+    onehot = np.zeros((n, width, n_codes), dtype=np.float32)
+    onehot[np.arange(n)[:, None], np.arange(width)[None, :], residues] = 1.0
+    onehot = onehot.reshape(n, width * n_codes)
+    table = GRANTHAM_TABLE.astype(np.float32)
+
+    for start in range(0, n, block_rows):
+        stop = min(start + block_rows, n)
+        weights = table[residues[start:stop]].reshape(stop - start, width * n_codes)
+        block = np.rint(weights @ onehot[start:].T).astype(np.uint32)
+        for k, i in enumerate(range(start, stop)):
+            row = block[k, i - start + 1:]
+            row[lengths[i + 1:] != lengths[i]] = MISSING_TOTAL
+            yield i, row
+
+
+def build_hed_matrices(fasta_path, output_dir):
+    """为 fasta 中的每个位点构建压缩 HED 矩阵并写入 output_dir"""
+    os.makedirs(output_dir, exist_ok=True)
+    allele_seqs = load_allele_sequences(fasta_path)
+
+    by_locus = {}
+    for allele in allele_seqs:
+        by_locus.setdefault(allele.split("*")[0], []).append(allele)
+
+    manifest = {"fasta": os.path.abspath(fasta_path), "sha256": file_sha256(fasta_path), "loci": {}}
+    with open(os.path.join(output_dir, "alleles.tsv"), "w", encoding="utf-8") as index_file:
+        index_file.write("allele\tlocus\tindex\tlength\n")
+        for locus, alleles in by_locus.items():
+            encoded = encode_allele_sequences({a: allele_seqs[a] for a in alleles})
+            n = len(encoded["lengths"])
+            condensed = np.empty(n * (n - 1) // 2, dtype=np.uint32)
+            for i, row in grantham_totals_matrix(encoded["residues"], encoded["lengths"]):
+                offset = condensed_offset(i, n)
+                condensed[offset:offset + len(row)] = row
+            np.save(os.path.join(output_dir, f"{locus}.npy"), condensed)
+
+            for allele, i in zip(alleles, encoded["sequence_ids"].tolist()):
+                index_file.write(f"{allele}\t{locus}\t{i}\t{encoded['lengths'][i]}\n")
+            manifest["loci"][locus] = {"alleles": len(alleles), "sequences": n, "bytes": int(condensed.nbytes)}
+            print(f"✅ {locus}: {len(alleles)} 个型别, {n} 条唯一序列, 矩阵 {condensed.nbytes / 1e6:.1f} MB")
+
+    with open(os.path.join(output_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+# ------------------ 查询矩阵 ------------------
+def load_hed_matrices(matrix_dir, fasta_path=None):
+    """
+    以只读内存映射方式打开矩阵目录，多个进程可共享同一份页缓存。
+    提供 fasta_path 时校验矩阵是否由该 fasta 构建。
+    """
+    with open(os.path.join(matrix_dir, "manifest.json"), encoding="utf-8") as f:
+        manifest = json.load(f)
+    if fasta_path and os.path.exists(fasta_path) and file_sha256(fasta_path) != manifest["sha256"]:
+        raise ValueError(f"{matrix_dir} 不是由 {fasta_path} 构建的，请重新运行 hed_matrix.py")
+    if any("sequences" not in info for info in manifest["loci"].values()):
+        # 旧版矩阵按型别逐行构建（manifest 中没有 sequences），与按唯一序列构建的格式不兼容
+        raise ValueError(f"{matrix_dir} 由旧版 hed_matrix.py 构建（按型别而非唯一序列），"
+                         f"请重新运行 hed_matrix.py 生成矩阵目录")
+
+    loci = list(manifest["loci"])
+    locus_code = {locus: k for k, locus in enumerate(loci)}
+    index = {}
+    with open(os.path.join(matrix_dir, "alleles.tsv"), encoding="utf-8") as f:
+        next(f)
+        for line in f:
+            allele, locus, i, length = line.rstrip("\n").split("\t")
+            index[allele] = (locus_code[locus], int(i), int(length))
+    return {
+        "loci": loci,
+        "index": index,
+        "sizes": [manifest["loci"][locus]["sequences"] for locus in loci],
+        "matrices": [np.load(os.path.join(matrix_dir, f"{locus}.npy"), mmap_mode="r") for locus in loci],
+    }
+
+
+def lookup_hed_from_matrices(store, alleles1, alleles2):
+    """
+    将每一行配对转换为两次整数查表。
+
+    返回:
+        (heds, uncovered): heds 为 float64 数组（无法查表的位置为 NaN），
+        uncovered 为两个型别都存在但属于不同位点、矩阵无法覆盖的行。
+    """
+    missing = (-1, -1, 0)
+    info1 = np.array([store["index"].get(a, missing) for a in alleles1], dtype=np.int64).reshape(-1, 3)
+    info2 = np.array([store["index"].get(a, missing) for a in alleles2], dtype=np.int64).reshape(-1, 3)
+    heds = np.full(len(info1), np.nan)
+
+    known = (info1[:, 0] >= 0) & (info2[:, 0] >= 0)
+    uncovered = known & (info1[:, 0] != info2[:, 0])
+    same_locus = known & ~uncovered & (info1[:, 2] > 0)
+
+    # 同一条序列（含蛋白序列相同的不同型别）的距离为 0
+    diagonal = same_locus & (info1[:, 1] == info2[:, 1])
+    heds[diagonal] = 0.0
+
+    pairs = same_locus & ~diagonal
+    for code, matrix in enumerate(store["matrices"]):
+        rows = np.flatnonzero(pairs & (info1[:, 0] == code))
+        if not len(rows):
+            continue
+        i = np.minimum(info1[rows, 1], info2[rows, 1])
+        j = np.maximum(info1[rows, 1], info2[rows, 1])
+        totals = matrix[condensed_index(i, j, store["sizes"][code])]
+        found = totals != MISSING_TOTAL
+        heds[rows[found]] = totals[found] / info1[rows[found], 2]
+    return heds, np.flatnonzero(uncovered)
+
+
+@click.command()
+@click.option('--fasta', '-f', default="./data/hla_exon_sequences.fasta", help='包含型别氨基酸序列的 fasta 文件')
+@click.option('--output-dir', '-o', default="./data/hed_matrix", help='矩阵输出目录')
+def main(fasta, output_dir):
+    build_hed_matrices(fasta, output_dir)
+    print(f"成功将 HED 矩阵写入到 {output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+近邻查询：与给定型别最接近 / 差异最大的同位点型别，以及 HED 阈值筛选。
+
+每个查询型别只与同位点、同长度的唯一序列做一次向量化距离计算（Q x N 的查表求和），
+再按型别展开并用 argpartition 做部分排序选出前 k 个，不需要逐对调用 compute_hed_between_alleles。
+
+    python hed_query.py "A*02:01" -k 20 --divergent
+    python hed_query.py "B*07:02" --max-hed 2.5
+    python hed_query.py -q queries.txt -k 10 -o neighbours.tsv
+"""
+
+import click
+import numpy as np
+import pandas as pd
+
+from compute_HED import GRANTHAM_TABLE, encode_allele_sequences, load_allele_sequences
+
+# 单次查表的元素上限（查询数 x 候选序列数 x 序列长度），控制中间矩阵的内存
+QUERY_BLOCK_ELEMENTS = 1 << 24
+
+
+def locus_groups(encoded):
+    """按 (位点, 长度) 分组，返回 {(locus, length): (型别行号数组, 对应的唯一序列行号数组)}"""
+    sequence_ids = encoded["sequence_ids"]
+    loci = np.array([a.split("*")[0] for a in encoded["alleles"]], dtype=object)
+    lengths = encoded["lengths"][sequence_ids]
+    frame = pd.DataFrame({"locus": loci, "length": lengths})
+    return {(locus, int(length)): (rows, sequence_ids[rows])
+            for (locus, length), rows in frame.groupby(["locus", "length"], sort=False).indices.items()}
+
+
+def distances_to_sequences(encoded, query_ids, target_ids, length):
+    """查询序列（唯一序列行号）与目标序列之间的 HED 矩阵 (len(query_ids), len(target_ids))"""
+    residues = encoded["residues"]
+    targets = residues[target_ids, :length]
+    block = max(1, QUERY_BLOCK_ELEMENTS // max(1, len(target_ids) * length))
+    out = np.empty((len(query_ids), len(target_ids)))
+    for start in range(0, len(query_ids), block):
+        queries = residues[query_ids[start:start + block], :length]
+        out[start:start + block] = GRANTHAM_TABLE[queries[:, None, :], targets[None, :, :]].sum(axis=2) / length
+    return out
+
+
+def select_top_k(distances, k, largest=False):
+    """
+    用 argpartition 选出 k 个最小（largest 时最大）距离的位置，按距离排序返回；
+    与第 k 个距离相同的并列项按位置（即 fasta 顺序）取舍，结果确定。
+    """
+    n = len(distances)
+    if k is None or k >= n:
+        selected = np.arange(n)
+    else:
+        keys = -distances if largest else distances
+        kth = keys[np.argpartition(keys, k - 1)[k - 1]]
+        better = np.flatnonzero(keys < kth)
+        ties = np.flatnonzero(keys == kth)[:k - len(better)]
+        selected = np.concatenate([better, ties])
+    keys = -distances[selected] if largest else distances[selected]
+    return selected[np.lexsort((selected, keys))]
+
+
+def query_neighbours(encoded, queries, k=None, largest=False, max_hed=None, min_hed=None, include_self=False):
+    """
+    对一批查询型别返回近邻表 DataFrame: query, allele, HED, rank。
+
+    返回 (近邻表, 不在 encoded 中的查询型别列表)。
+
+    参数:
+        k: 每个查询返回的型别数（>= 1），None 时返回全部（仍受阈值筛选）
+        largest: True 时返回差异最大的型别
+        max_hed / min_hed: 只保留 HED 在该范围内的型别（先筛选再取前 k 个）
+        include_self: 是否包含查询型别本身
+    """
+    if k is not None and k < 1:
+        raise ValueError(f"k 应为正整数: {k}")
+    groups = locus_groups(encoded)
+    alleles = np.array(encoded["alleles"], dtype=object)
+    index = encoded["index"]
+    lengths = encoded["lengths"]
+
+    missing = [q for q in queries if q not in index]
+    by_group = {}
+    for query in queries:
+        if query in index:
+            key = (query.split("*")[0], int(lengths[index[query]]))
+            by_group.setdefault(key, []).append(query)
+
+    tables = []
+    for key, group_queries in by_group.items():
+        rows, target_seq_ids = groups[key]
+        unique_targets, inverse = np.unique(target_seq_ids, return_inverse=True)
+        query_ids = np.array([index[q] for q in group_queries])
+        seq_distances = distances_to_sequences(encoded, query_ids, unique_targets, key[1])
+
+        for query, dist in zip(group_queries, seq_distances):
+            candidates = rows
+            d = dist[inverse]
+            keep = np.ones(len(rows), dtype=bool)
+            if not include_self:
+                keep &= alleles[rows] != query
+            if max_hed is not None:
+                keep &= d <= max_hed
+            if min_hed is not None:
+                keep &= d >= min_hed
+            candidates, d = candidates[keep], d[keep]
+            order = select_top_k(d, k, largest)
+            tables.append(pd.DataFrame({
+                "query": query,
+                "allele": alleles[candidates[order]],
+                "HED": d[order],
+                "rank": np.arange(1, len(order) + 1),
+            }))
+
+    result = pd.concat(tables, ignore_index=True) if tables else \
+        pd.DataFrame({"query": [], "allele": [], "HED": [], "rank": []})
+    return result, missing
+
+
+@click.command()
+@click.argument('queries', nargs=-1)
+@click.option('--queries-file', '-q', default=None, help='查询型别列表文件（每行一个）')
+@click.option('--fasta', '-f', default="./data/hla_exon_sequences.fasta", help='包含型别氨基酸序列的 fasta 文件')
+@click.option('-k', 'k', type=click.IntRange(min=1), default=None, help='每个查询返回的型别数，默认返回全部')
+@click.option('--divergent', is_flag=True, help='返回差异最大的型别（默认返回最接近的型别）')
+@click.option('--max-hed', type=float, default=None, help='只保留 HED <= 该值的型别')
+@click.option('--min-hed', type=float, default=None, help='只保留 HED >= 该值的型别')
+@click.option('--include-self', is_flag=True, help='结果中包含查询型别本身')
+@click.option('--output', '-o', default=None, help='输出 TSV，默认打印到屏幕')
+def main(queries, queries_file, fasta, k, divergent, max_hed, min_hed, include_self, output):
+    from allele_names import AlleleResolver
+
+    queries = list(queries)
+    if queries_file:
+        with open(queries_file, encoding="utf-8") as f:
+            queries += [line.strip() for line in f if line.strip()]
+    if not queries:
+        raise click.UsageError("请提供至少一个查询型别")
+
+    allele_seqs = load_allele_sequences(fasta)
+    encoded = encode_allele_sequences(allele_seqs)
+    resolver = AlleleResolver(allele_seqs)
+    resolved = resolver.resolve_many(queries)
+    targets = [r for r in resolved if r is not None]
+
+    result, missing = query_neighbours(encoded, list(dict.fromkeys(targets)), k, divergent, max_hed, min_hed, include_self)
+    if output:
+        result.to_csv(output, sep="\t", index=False)
+        print(f"✅ {len(result)} 条结果已写入 {output}")
+    else:
+        with pd.option_context("display.max_rows", None):
+            print(result.to_string(index=False, float_format=lambda x: f"{x:.2f}"))
+    if missing:
+        print(f"⚠️ {len(missing)} 个查询型别没有序列，未返回结果: {', '.join(missing)}")
+    resolver.report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+常驻的本地 HED 查询服务（asyncio）。
+
+服务启动时加载一次序列并编码，之后通过 Unix socket（或 localhost TCP）接收查询，
+避免每次调用 compute_HED_pairewise.py 都重新启动解释器、加载序列。
+
+协议：每行一个 JSON 请求，返回一行 JSON。
+    请求: {"pairs": [["A*01:01", "A*02:01"], ...]}  或  {"allele1": "A*01:01", "allele2": "A*02:01"}
+    响应: {"results": [{"allele1": ..., "allele2": ..., "hed": 10.5 或 null, "error": null 或 错误信息}, ...]}
+
+同时到达的多个请求会合并为一批，由向量化引擎一次算完。
+
+客户端函数 query_hed_server 只依赖标准库，可在其他脚本中轻量调用。
+"""
+
+import asyncio
+import json
+import os
+import socket
+
+DEFAULT_SOCKET = "/tmp/hla_hed.sock"
+BATCH_WINDOW = 0.002  # 秒：合并同时到达的请求的等待时间
+
+
+def _tcp_address(address):
+    """address 为 host:port 时返回 (host, port)，否则返回 None（视为 Unix socket 路径）"""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and "/" not in address:
+        return host or "127.0.0.1", int(port)
+    return None
+
+
+# ------------------ 客户端 ------------------
+def _connect(address):
+    tcp = _tcp_address(address)
+    if tcp:
+        return socket.create_connection(tcp)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+
+def query_hed_server(address, pairs):
+    """向服务查询一批 (allele1, allele2)，返回结果字典列表（与请求顺序一致）"""
+    with _connect(address) as sock:
+        sock.sendall(json.dumps({"pairs": [list(p) for p in pairs]}).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as f:
+            response = json.loads(f.readline())
+    if "error" in response:
+        raise ValueError(response["error"])
+    return response["results"]
+
+
+# ------------------ 服务端 ------------------
+class HedService:
+    """持有编码后的序列，把一批配对交给向量化引擎计算，并给出与 pairwise 脚本一致的错误信息"""
+
+    def __init__(self, fasta_path):
+        from compute_HED import encode_allele_sequences, load_allele_sequences
+
+        self.encoded = encode_allele_sequences(load_allele_sequences(fasta_path))
+        self.queue = asyncio.Queue()
+
+    def compute(self, pairs):
+        from compute_HED import calculate_hed_batch
+
+        index, lengths = self.encoded["index"], self.encoded["lengths"]
+        heds = calculate_hed_batch(self.encoded, [p[0] for p in pairs], [p[1] for p in pairs])
+        results = []
+        for (a1, a2), hed in zip(pairs, heds.tolist()):
+            error = None
+            if a1 not in index:
+                error = f"{a1} not found in fasta file"
+            elif a2 not in index:
+                error = f"{a2} not found in fasta file"
+            elif lengths[index[a1]] != lengths[index[a2]]:
+                error = f"Length mismatch between {a1} and {a2}"
+            results.append({"allele1": a1, "allele2": a2,
+                            "hed": None if error or hed != hed else hed, "error": error})
+        return results
+
+    async def batcher(self):
+        """合并排队中的请求，每批只调用一次向量化引擎"""
+        while True:
+            batch = [await self.queue.get()]
+            await asyncio.sleep(BATCH_WINDOW)
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            pairs = [pair for request_pairs, _ in batch for pair in request_pairs]
+            try:
+                results = self.compute(pairs)
+            except Exception as e:  # 单个异常不应拖垮整个服务
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            start = 0
+            for request_pairs, future in batch:
+                future.set_result(results[start:start + len(request_pairs)])
+                start += len(request_pairs)
+
+    async def submit(self, pairs):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((pairs, future))
+        return await future
+
+    async def handle(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                    if "pairs" in request:
+                        pairs = [(str(a1), str(a2)) for a1, a2 in request["pairs"]]
+                    else:
+                        pairs = [(str(request["allele1"]), str(request["allele2"]))]
+                    response = {"results": await self.submit(pairs)}
+                except (ValueError, KeyError, TypeError) as e:
+                    response = {"error": f"invalid request: {e}"}
+                writer.write(json.dumps(response, ensure_ascii=False).encode("utf-8") + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+async def serve(fasta_path, address):
+    service = HedService(fasta_path)
+    batcher = asyncio.create_task(service.batcher())
+
+    tcp = _tcp_address(address)
+    if tcp:
+        server = await asyncio.start_server(service.handle, *tcp)
+    else:
+        if os.path.exists(address):
+            os.unlink(address)
+        server = await asyncio.start_unix_server(service.handle, address)
+
+    print(f"✅ HED 服务已启动: {address}（{len(service.encoded['index'])} 个型别）")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batcher.cancel()
+        if not tcp and os.path.exists(address):
+            os.unlink(address)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="常驻的本地 HED 查询服务")
+    parser.add_argument("--fasta", "-f", default="./data/hla_exon_sequences.fasta", help="包含型别氨基酸序列的 fasta 文件")
+    parser.add_argument("--address", "-a", default=DEFAULT_SOCKET, help="Unix socket 路径或 host:port")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.fasta, args.address))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+HED 汇总的统计推断：中位数 / IQR 的 bootstrap 置信区间，以及两组之间的置换检验。
+
+输入为 compute_HED.py 输出的注释表（HED 列，或 --wide 模式的 HED_* 列）。
+
+HED 是整数 Grantham 总和除以序列长度，每列不同取值的数量远小于行数，因此重采样在
+“不同取值的计数”上进行，而不是在 (重采样次数 x 行数) 的下标矩阵上：
+    - bootstrap：每次重采样等价于对各取值的计数做一次多项分布抽样（rng.multinomial）
+    - 置换检验：随机分组后第一组的计数服从多元超几何分布（rng.multivariate_hypergeometric）
+分位数直接由计数的累积和得到（compute_HED.percentiles_from_counts，与流式汇总共用），与 np.percentile（linear 插值）逐位一致。
+10k 次重采样的内存与耗时只与不同取值数有关，与行数（可达百万）无关。
+
+不同取值超过 MAX_DISTINCT_VALUES 的列（如 class I/II 平均 HED）在重采样时先四舍五入到能使不同取值
+不超过该上限的最多小数位（最多 RESAMPLE_DECIMALS 位，HED 的取值范围下通常为 2 位），仍走计数路径；
+观测到的中位数与 IQR 仍按原始值计算，置信区间与零分布的误差不超过舍入精度的一半。
+只有舍入到整数后仍超过上限时才分块在下标矩阵上重采样，耗时随行数增长（百万行 x 1 万次需数分钟），并打印警告。
+
+    python hed_stats.py -i annotated.tsv
+    python hed_stats.py -i annotated.tsv --group-col response -o stats.tsv
+"""
+
+import click
+import numpy as np
+import pandas as pd
+
+from compute_HED import QUANTILES, percentiles_from_counts
+
+DEFAULT_RESAMPLES = 10000
+MAX_DISTINCT_VALUES = 20000
+RESAMPLE_DECIMALS = 6
+RESAMPLE_BLOCK = 1 << 24  # 每块重采样的元素上限（重采样次数 x 取值数或行数）
+
+
+# ------------------ 基于计数的重采样 ------------------
+def _blocks(n_resamples, width):
+    block = max(1, RESAMPLE_BLOCK // max(1, width))
+    for start in range(0, n_resamples, block):
+        yield min(block, n_resamples - start)
+
+
+def distinct_counts(x):
+    """
+    返回重采样所用的 (升序不同取值, 计数)。不同取值超过 MAX_DISTINCT_VALUES 时逐步减少小数位四舍五入，
+    取不超过上限的最多小数位；舍入到整数仍超过上限时返回原始取值，并打印警告（调用方改走下标矩阵）。
+    """
+    values, counts = np.unique(x, return_counts=True)
+    for decimals in range(RESAMPLE_DECIMALS, -1, -1):
+        if len(values) <= MAX_DISTINCT_VALUES:
+            return values, counts
+        values, counts = np.unique(np.round(x, decimals), return_counts=True)
+    if len(values) <= MAX_DISTINCT_VALUES:
+        return values, counts
+    print(f"⚠️ 取整后仍有 {len(values)} 个不同取值（上限 {MAX_DISTINCT_VALUES}），"
+          f"改为在 {len(x)} 行的下标矩阵上重采样，耗时随行数增长")
+    return np.unique(x, return_counts=True)
+
+
+def bootstrap_quantiles(x, n_resamples, rng):
+    """返回 (n_resamples, 3) 的 bootstrap 分位数（25/50/75）"""
+    values, counts = distinct_counts(x)
+    out = []
+    if len(values) <= MAX_DISTINCT_VALUES:
+        p = counts / counts.sum()
+        for size in _blocks(n_resamples, len(values)):
+            out.append(percentiles_from_counts(values, rng.multinomial(len(x), p, size=size)))
+    else:
+        for size in _blocks(n_resamples, len(x)):
+            samples = x[rng.integers(len(x), size=(size, len(x)))]
+            out.append(np.percentile(samples, QUANTILES, axis=1).T)
+    return np.concatenate(out)
+
+
+def permutation_quantile_diffs(x, y, n_resamples, rng):
+    """
+    置换检验的零分布：随机重新分组后两组分位数之差 (n_resamples, 3)。
+    """
+    pooled = np.concatenate([x, y])
+    values, counts = distinct_counts(pooled)
+    out = []
+    if len(values) <= MAX_DISTINCT_VALUES:
+        for size in _blocks(n_resamples, len(values)):
+            first = rng.multivariate_hypergeometric(counts, len(x), size=size)
+            diff = percentiles_from_counts(values, first) - percentiles_from_counts(values, counts - first)
+            out.append(diff)
+    else:
+        for size in _blocks(n_resamples, len(pooled)):
+            perm = rng.permuted(np.broadcast_to(pooled, (size, len(pooled))), axis=1)
+            q = np.percentile(perm[:, :len(x)], QUANTILES, axis=1).T
+            out.append(q - np.percentile(perm[:, len(x):], QUANTILES, axis=1).T)
+    return np.concatenate(out)
+
+
+# ------------------ 汇总 ------------------
+def _median_iqr(quantiles):
+    """(…, 3) 的 25/50/75 分位数 -> (中位数, IQR)"""
+    return quantiles[..., 1] * 1.0, quantiles[..., 2] - quantiles[..., 0]
+
+
+def bootstrap_summary(x, n_resamples, ci, rng):
+    """单列（或单组）的中位数、IQR 及其 bootstrap 百分位置信区间"""
+    x = x[~np.isnan(x)]
+    row = {"n": len(x)}
+    if not len(x):
+        return row
+    median, iqr = _median_iqr(np.percentile(x, QUANTILES))
+    boot_median, boot_iqr = _median_iqr(bootstrap_quantiles(x, n_resamples, rng))
+    alpha = (1 - ci) / 2 * 100
+    row.update({
+        "median": median,
+        "median_ci_low": np.percentile(boot_median, alpha),
+        "median_ci_high": np.percentile(boot_median, 100 - alpha),
+        "IQR": iqr,
+        "IQR_ci_low": np.percentile(boot_iqr, alpha),
+        "IQR_ci_high": np.percentile(boot_iqr, 100 - alpha),
+    })
+    return row
+
+
+def permutation_test(x, y, n_resamples, rng):
+    """两组中位数与 IQR 之差的双侧置换检验，p 值为 (1 + 至少一样极端的次数) / (1 + 置换次数)"""
+    x, y = x[~np.isnan(x)], y[~np.isnan(y)]
+    if not len(x) or not len(y):
+        return {}
+    median_x, iqr_x = _median_iqr(np.percentile(x, QUANTILES))
+    median_y, iqr_y = _median_iqr(np.percentile(y, QUANTILES))
+    observed_median, observed_iqr = median_x - median_y, iqr_x - iqr_y
+    null = permutation_quantile_diffs(x, y, n_resamples, rng)
+    null_median, null_iqr = _median_iqr(null)
+    # 浮点误差内相等的置换统计量也算作“一样极端”
+    tol = 1e-9
+    return {
+        "median_diff": observed_median,
+        "median_p": (1 + np.sum(np.abs(null_median) >= abs(observed_median) - tol)) / (1 + n_resamples),
+        "IQR_diff": observed_iqr,
+        "IQR_p": (1 + np.sum(np.abs(null_iqr) >= abs(observed_iqr) - tol)) / (1 + n_resamples),
+    }
+
+
+def hed_columns(columns):
+    return [c for c in columns if c == "HED" or str(c).startswith("HED_")]
+
+
+@click.command()
+@click.option('--input', '-i', required=True, help='compute_HED.py 输出的注释表（TSV 或 .parquet）')
+@click.option('--columns', default=None, help='要统计的列（逗号分隔），默认 HED 与所有 HED_* 列')
+@click.option('--group-col', default=None, help='分组列，提供时对每组分别估计并做两组间的置换检验')
+@click.option('--groups', default=None, help='参与比较的两个组名（逗号分隔），默认取分组列中仅有的两个组')
+@click.option('--n-boot', type=int, default=DEFAULT_RESAMPLES, show_default=True, help='bootstrap 重采样次数')
+@click.option('--n-perm', type=int, default=DEFAULT_RESAMPLES, show_default=True, help='置换次数')
+@click.option('--ci', type=float, default=0.95, show_default=True, help='置信水平')
+@click.option('--seed', type=int, default=0, show_default=True, help='随机种子，结果可复现')
+@click.option('--output', '-o', default=None, help='输出 TSV，默认打印到屏幕')
+def main(input, columns, group_col, groups, n_boot, n_perm, ci, seed, output):
+    df = pd.read_parquet(input) if input.endswith(".parquet") else pd.read_csv(input, sep="\t")
+    columns = columns.split(",") if columns else hed_columns(df.columns)
+    if not columns:
+        raise click.UsageError("输入中没有 HED 列")
+    rng = np.random.default_rng(seed)
+
+    if group_col:
+        labels = df[group_col].where(df[group_col].isna(), df[group_col].astype(str))
+        levels = groups.split(",") if groups else sorted(labels.dropna().unique())
+        if len(levels) != 2:
+            raise click.UsageError(f"置换检验需要恰好两个组，{group_col} 中有: {', '.join(levels)}")
+    else:
+        levels = None
+
+    rows = []
+    for col in columns:
+        x = df[col].to_numpy(np.float64)
+        if levels is None:
+            rows.append({"column": col, "group": "all", **bootstrap_summary(x, n_boot, ci, rng)})
+            continue
+        parts = [x[(labels == level).to_numpy()] for level in levels]
+        for level, part in zip(levels, parts):
+            rows.append({"column": col, "group": level, **bootstrap_summary(part, n_boot, ci, rng)})
+        rows.append({"column": col, "group": f"{levels[0]} vs {levels[1]}",
+                     **permutation_test(parts[0], parts[1], n_perm, rng)})
+
+    result = pd.DataFrame(rows)
+    if output:
+        result.to_csv(output, sep="\t", index=False)
+        print(f"✅ 统计结果已写入 {output}")
+    else:
+        with pd.option_context("display.max_columns", None, "display.width", 200):
+            print(result.to_string(index=False, float_format=lambda v: f"{v:.4g}"))
+
+
+if __name__ == "__main__":
+    main()
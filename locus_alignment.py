@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+将每个位点的型别序列放到同一套比对坐标上，使长度不一致的型别（Q 结尾、截短等）也能计算 HED。
+
+构建规则：
+    - 每个位点以最常见的序列长度为标准长度，标准长度型别逐列取最常见残基得到共识序列；
+    - 标准长度的型别直接按位置放入坐标系；
+    - 其余型别与共识序列做半全局 Needleman-Wunsch 比对（两端的空位不罚分），
+      比对到共识位置上的残基写入对应列，型别缺失的列记为 GAP_CODE，
+      型别相对共识多出的插入残基不占列（丢弃）。
+
+查询规则：
+    - 长度相同的两个型别（包括跨位点配对）直接按位置计算，与 calculate_hed 完全一致。
+      每个型别各自与共识比对，同长度型别的空位可能落在不同的列上，在比对坐标上计算会改变原本正确的 HED；
+    - 只有长度不同的配对才在比对坐标上计算，HED 只在两个型别都有残基的列上计算：
+        HED = 共同列上的 Grantham 距离总和 / 共同列数
+
+目录结构（默认 ./data/hed_alignment）：
+    manifest.json     来源 fasta 的 sha256、空位规则及各位点的宽度和共识序列
+    alleles.tsv       allele -> (locus, index, length, aligned) 索引表，index 为位点内唯一序列的编号
+    {locus}.npy       uint8 定宽残基矩阵 (n_sequences, width)，蛋白序列相同的型别共用一行
+"""
+
+import json
+import os
+
+import click
+import numpy as np
+
+from compute_HED import (AA_LIST, GRANTHAM_TABLE, HED_CHUNK_SIZE, UNKNOWN_CODE, calculate_hed_batch,
+                         calculate_hed_for_pairs, calculate_hed_from_indices, encode_allele_sequences,
+                         encode_sequence, load_allele_sequences, lookup_allele_indices)
+from seq_store import file_sha256
+
+GAP_CODE = UNKNOWN_CODE + 1
+
+# 22x22 查找表：在 GRANTHAM_TABLE 基础上增加空位行/列（距离为 0，且该列不计入分母）
+ALIGNED_TABLE = np.zeros((GAP_CODE + 1, GAP_CODE + 1), dtype=np.int32)
+ALIGNED_TABLE[:GAP_CODE, :GAP_CODE] = GRANTHAM_TABLE
+
+# 比对打分：相同残基 +2，不同残基按 Grantham 距离在 [-2, -1] 之间罚分，内部空位每个 -4
+MATCH_SCORE = 2.0
+GAP_PENALTY = 4.0
+_MAX_GRANTHAM = float(GRANTHAM_TABLE.max())
+SUBSTITUTION = [
+    [0.0 if UNKNOWN_CODE in (i, j) else MATCH_SCORE if i == j else -1.0 - GRANTHAM_TABLE[i, j] / _MAX_GRANTHAM
+     for j in range(UNKNOWN_CODE + 1)]
+    for i in range(UNKNOWN_CODE + 1)
+]
+
+
+# ------------------ 比对 ------------------
+def locus_consensus(residues, lengths, weights):
+    """
+    返回 (标准长度, 共识序列编码)：标准长度为最常见长度，共识为该长度型别逐列最常见的残基。
+    residues/lengths 为唯一序列，weights 为每条序列对应的型别数，统计按型别计数。
+    """
+    values, inverse = np.unique(lengths, return_inverse=True)
+    width = int(values[np.argmax(np.bincount(inverse, weights=weights))])
+    canonical = lengths == width
+    consensus = np.array([np.bincount(col, weights=weights[canonical], minlength=UNKNOWN_CODE + 1).argmax()
+                          for col in residues[canonical, :width].T], dtype=np.uint8)
+    return width, consensus
+
+
+def semiglobal_align(seq, ref):
+    """
+    将 seq 与 ref 做半全局比对（两条序列两端的空位均不罚分），
+    返回长度为 len(ref) 的列表：第 j 个元素为比对到 ref[j] 的 seq 残基，没有对应残基时为 GAP_CODE。
+    """
+    seq, ref = [int(x) for x in seq], [int(x) for x in ref]
+    m, n = len(seq), len(ref)
+    score = [[0.0] * (n + 1) for _ in range(m + 1)]
+    trace = [bytearray(n + 1) for _ in range(m + 1)]  # 0: 对角, 1: seq 插入, 2: seq 缺失
+    for i in range(1, m + 1):
+        trace[i][0] = 1
+    for j in range(1, n + 1):
+        trace[0][j] = 2
+
+    for i in range(1, m + 1):
+        subst = SUBSTITUTION[seq[i - 1]]
+        prev, cur, tr = score[i - 1], score[i], trace[i]
+        for j in range(1, n + 1):
+            diag = prev[j - 1] + subst[ref[j - 1]]
+            up = prev[j] - GAP_PENALTY
+            left = cur[j - 1] - GAP_PENALTY
+            if diag >= up and diag >= left:
+                cur[j] = diag
+            elif up >= left:
+                cur[j] = up
+                tr[j] = 1
+            else:
+                cur[j] = left
+                tr[j] = 2
+
+    # 末端空位不罚分：从最后一行或最后一列的最高分处回溯，同分时优先右下角
+    i, j = m, n
+    best = score[m][n]
+    for jj in range(n - 1, -1, -1):
+        if score[m][jj] > best:
+            best, i, j = score[m][jj], m, jj
+    for ii in range(m - 1, -1, -1):
+        if score[ii][n] > best:
+            best, i, j = score[ii][n], ii, n
+
+    row = [GAP_CODE] * n
+    while i > 0 and j > 0:
+        step = trace[i][j]
+        if step == 0:
+            row[j - 1] = seq[i - 1]
+            i, j = i - 1, j - 1
+        elif step == 1:
+            i -= 1
+        else:
+            j -= 1
+    return row
+
+
+def align_locus(residues, lengths, weights):
+    """返回 (定宽矩阵, 共识序列编码, 是否经过比对的布尔数组)，每条唯一序列一行"""
+    width, consensus = locus_consensus(residues, lengths, weights)
+    aligned = np.full((len(lengths), width), GAP_CODE, dtype=np.uint8)
+    needs_alignment = lengths != width
+    aligned[~needs_alignment] = residues[~needs_alignment, :width]
+    for i in np.flatnonzero(needs_alignment):
+        aligned[i] = semiglobal_align(residues[i, :lengths[i]], consensus)
+    return aligned, consensus, needs_alignment
+
+
+def build_alignment(fasta_path, output_dir):
+    """为 fasta 中的每个位点构建定宽比对矩阵并写入 output_dir"""
+    os.makedirs(output_dir, exist_ok=True)
+    allele_seqs = load_allele_sequences(fasta_path)
+
+    by_locus = {}
+    for allele in allele_seqs:
+        by_locus.setdefault(allele.split("*")[0], []).append(allele)
+
+    manifest = {
+        "fasta": os.path.abspath(fasta_path),
+        "sha256": file_sha256(fasta_path),
+        "gap_rule": "HED 只在两个型别都有残基的列上计算：共同列 Grantham 总和 / 共同列数",
+        "loci": {},
+    }
+    letters = AA_LIST + ["X"]
+    with open(os.path.join(output_dir, "alleles.tsv"), "w", encoding="utf-8") as index_file:
+        index_file.write("allele\tlocus\tindex\tlength\taligned\n")
+        for locus, alleles in by_locus.items():
+            encoded = encode_allele_sequences({a: allele_seqs[a] for a in alleles})
+            sequence_ids = encoded["sequence_ids"]
+            weights = np.bincount(sequence_ids, minlength=len(encoded["lengths"])).astype(np.float64)
+            aligned, consensus, realigned = align_locus(encoded["residues"], encoded["lengths"], weights)
+            np.save(os.path.join(output_dir, f"{locus}.npy"), aligned)
+
+            for allele, i in zip(alleles, sequence_ids.tolist()):
+                index_file.write(f"{allele}\t{locus}\t{i}\t{encoded['lengths'][i]}\t{int(realigned[i])}\n")
+            n_realigned = int(realigned[sequence_ids].sum())
+            manifest["loci"][locus] = {
+                "alleles": len(alleles),
+                "sequences": len(aligned),
+                "width": aligned.shape[1],
+                "aligned": n_realigned,
+                "consensus": "".join(letters[c] for c in consensus),
+            }
+            print(f"✅ {locus}: {len(alleles)} 个型别, {len(aligned)} 条唯一序列, 宽度 {aligned.shape[1]}, "
+                  f"其中 {n_realigned} 个型别经过比对")
+
+    with open(os.path.join(output_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+# ------------------ 查询 ------------------
+def load_alignment(alignment_dir, fasta_path=None):
+    """
+    读取比对目录，合并为一个与 encode_allele_sequences 结构相同的编码字典：
+    index 把型别映射到唯一序列的行，residues 补齐到最大宽度（补齐部分为 GAP_CODE），
+    widths 为每行所属位点的坐标宽度；raw / lengths 为每行未比对的原始序列编码及长度，
+    用于长度相同的配对按位置计算。fasta_path 默认为构建时记录的 fasta。
+    """
+    with open(os.path.join(alignment_dir, "manifest.json"), encoding="utf-8") as f:
+        manifest = json.load(f)
+    fasta_path = fasta_path or manifest["fasta"]
+    if not os.path.exists(fasta_path):
+        raise ValueError(f"找不到构建 {alignment_dir} 时使用的 fasta: {fasta_path}")
+    if file_sha256(fasta_path) != manifest["sha256"]:
+        raise ValueError(f"{alignment_dir} 不是由 {fasta_path} 构建的，请重新运行 locus_alignment.py")
+
+    loci = list(manifest["loci"])
+    matrices = [np.load(os.path.join(alignment_dir, f"{locus}.npy")) for locus in loci]
+    max_width = max((m.shape[1] for m in matrices), default=0)
+    residues = np.full((sum(len(m) for m in matrices), max_width), GAP_CODE, dtype=np.uint8)
+    widths = np.empty(len(residues), dtype=np.int32)
+    start = {}
+    row = 0
+    for locus, matrix in zip(loci, matrices):
+        residues[row:row + len(matrix), :matrix.shape[1]] = matrix
+        widths[row:row + len(matrix)] = matrix.shape[1]
+        start[locus] = row
+        row += len(matrix)
+
+    index = {}
+    with open(os.path.join(alignment_dir, "alleles.tsv"), encoding="utf-8") as f:
+        next(f)
+        for line in f:
+            allele, locus, i = line.rstrip("\n").split("\t")[:3]
+            index[allele] = start[locus] + int(i)
+
+    # 原始序列：每行取第一个映射到该行的型别（同一行的型别序列相同）
+    allele_seqs = load_allele_sequences(fasta_path)
+    row_seqs = {}
+    for allele, i in index.items():
+        row_seqs.setdefault(i, allele_seqs[allele])
+    lengths = np.zeros(len(residues), dtype=np.int64)
+    for i, seq in row_seqs.items():
+        lengths[i] = len(seq)
+    raw = np.full((len(residues), int(lengths.max(initial=0))), UNKNOWN_CODE, dtype=np.uint8)
+    for i, seq in row_seqs.items():
+        raw[i, :len(seq)] = encode_sequence(seq)
+    return {
+        "alleles": list(index),
+        "index": index,
+        "residues": residues,
+        "widths": widths,
+        "raw": raw,
+        "lengths": lengths,
+    }
+
+
+def calculate_aligned_hed_for_pairs(aligned, idx1, idx2, chunk_size=HED_CHUNK_SIZE):
+    """
+    逐对计算 HED，返回 float64 数组。长度相同的配对按原始序列逐位置计算（与 calculate_hed 一致），
+    长度不同的配对在比对坐标上计算；坐标宽度不同（不同坐标系的位点）或没有共同列的配对为 NaN。
+    """
+    residues, widths, lengths = aligned["residues"], aligned["widths"], aligned["lengths"]
+    heds = np.full(len(idx1), np.nan)
+    positional = lengths[idx1] == lengths[idx2]
+    if positional.any():
+        heds[positional] = calculate_hed_for_pairs({"residues": aligned["raw"], "lengths": lengths},
+                                                   idx1[positional], idx2[positional], chunk_size)
+    rows = np.flatnonzero(~positional & (widths[idx1] == widths[idx2]))
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        r1, r2 = residues[idx1[chunk]], residues[idx2[chunk]]
+        totals = ALIGNED_TABLE[r1, r2].sum(axis=1, dtype=np.int64)
+        shared = ((r1 != GAP_CODE) & (r2 != GAP_CODE)).sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            heds[chunk] = np.where(shared > 0, totals / shared, np.nan)
+    return heds
+
+
+def calculate_aligned_hed_batch(aligned, alleles1, alleles2, chunk_size=HED_CHUNK_SIZE):
+    """对一整列 (allele1, allele2) 在比对坐标上批量计算 HED，重复配对只计算一次"""
+    idx1 = lookup_allele_indices(aligned, alleles1)
+    idx2 = lookup_allele_indices(aligned, alleles2)
+    return calculate_hed_from_indices(
+        aligned, idx1, idx2, pair_fn=lambda u1, u2: calculate_aligned_hed_for_pairs(aligned, u1, u2, chunk_size))
+
+
+# ------------------ 一致性检查 ------------------
+def verify_alignment(alignment_dir, fasta_path, n_pairs=100000, seed=0):
+    """
+    检查比对坐标不改变原本就能计算的 HED：所有同位点、同长度的唯一序列配对（每组超过
+    n_pairs 时随机抽样），以及 n_pairs 个任意型别配对，原始 HED 非 NaN 时比对结果必须逐位相同。
+    返回不一致的 (allele1, allele2, 原始 HED, 比对 HED) 列表。
+    """
+    allele_seqs = load_allele_sequences(fasta_path)
+    encoded = encode_allele_sequences(allele_seqs)
+    aligned = load_alignment(alignment_dir, fasta_path)
+    rng = np.random.default_rng(seed)
+
+    alleles = np.array(encoded["alleles"], dtype=object)
+    _, first = np.unique(encoded["sequence_ids"], return_index=True)
+    representatives = alleles[first]  # 每条唯一序列一个代表型别
+    keys = np.array([f"{a.split('*')[0]}:{len(allele_seqs[a])}" for a in representatives], dtype=object)
+    pairs1, pairs2 = [rng.choice(alleles, n_pairs)], [rng.choice(alleles, n_pairs)]
+    for key in np.unique(keys):
+        group = representatives[keys == key]
+        i, j = np.triu_indices(len(group), 1)
+        if len(i) > n_pairs:
+            pick = rng.choice(len(i), n_pairs, replace=False)
+            i, j = i[pick], j[pick]
+        pairs1.append(group[i])
+        pairs2.append(group[j])
+    alleles1, alleles2 = np.concatenate(pairs1), np.concatenate(pairs2)
+
+    baseline = calculate_hed_batch(encoded, alleles1, alleles2)
+    result = calculate_aligned_hed_batch(aligned, alleles1, alleles2)
+    bad = np.flatnonzero(~np.isnan(baseline) & (baseline != result))
+    print(f"检查 {len(alleles1)} 个配对，其中 {int((~np.isnan(baseline)).sum())} 个原本可计算，"
+          f"{len(bad)} 个结果被比对改变")
+    return [(alleles1[k], alleles2[k], baseline[k], result[k]) for k in bad.tolist()]
+
+
+@click.command()
+@click.option('--fasta', '-f', default="./data/hla_exon_sequences.fasta", help='包含型别氨基酸序列的 fasta 文件')
+@click.option('--output-dir', '-o', default="./data/hed_alignment", help='比对矩阵输出目录')
+@click.option('--verify', is_flag=True, help='构建后检查所有原本可计算的配对 HED 不被比对改变，不一致时以状态码 1 退出')
+def main(fasta, output_dir, verify):
+    build_alignment(fasta, output_dir)
+    print(f"成功将比对矩阵写入到 {output_dir}")
+    if verify:
+        changed = verify_alignment(output_dir, fasta)
+        for allele1, allele2, before, after in changed[:20]:
+            print(f"  ❌ {allele1} vs {allele2}: {before:.4f} -> {after:.4f}")
+        if changed:
+            raise SystemExit(1)
+        print("✅ 比对未改变任何原本可计算的 HED")
+
+
+if __name__ == "__main__":
+    main()
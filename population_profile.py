@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+群体谱 HED：每个型别相对参考群体的期望 HED。
+
+对每个 (位点, 序列长度) 分组，先统计参考群体逐位置的氨基酸频率谱 P（L x 21，可按队列中的
+出现次数加权），再一次矩阵乘法得到每个位置上每种残基的期望 Grantham 距离：
+    E = P @ GRANTHAM_TABLE.T        E[p, c] = sum_a P[p, a] * G(c, a)
+型别 x 的期望 HED 即为 sum_p E[p, x_p] / L，等于 x 与群体中所有同位点、同长度型别（含自身）
+逐对 HED 的加权平均，但每个型别只需 O(L) 次查表，而不是与群体逐一比较。
+
+    python population_profile.py -o population_hed.tsv
+    python population_profile.py --cohort cohort.tsv -o population_hed.tsv
+"""
+
+import click
+import numpy as np
+import pandas as pd
+
+from compute_HED import GRANTHAM_TABLE, UNKNOWN_CODE, encode_allele_sequences, load_allele_sequences
+
+N_CODES = UNKNOWN_CODE + 1
+
+
+# ------------------ 权重 ------------------
+def cohort_allele_weights(cohort_path, alleles):
+    """
+    以队列（id, allele1, allele2）中每个型别出现的次数作为权重，返回 (与 alleles 对应的权重数组, 未知型别计数)。
+    """
+    df = pd.read_csv(cohort_path, sep="\t", dtype=str)
+    if df.shape[1] < 3:
+        raise ValueError("队列文件应至少包含3列：id, allele1, allele2")
+    counts = pd.concat([df.iloc[:, 1], df.iloc[:, 2]]).dropna().value_counts()
+    known = counts.index.isin(alleles)
+    weights = pd.Series(alleles).map(counts).fillna(0).to_numpy(np.float64)
+    return weights, counts[~known]
+
+
+# ------------------ 频率谱 ------------------
+def build_profiles(encoded, weights=None):
+    """
+    按 (位点, 长度) 分组构建频率谱。
+
+    参数:
+        encoded: encode_allele_sequences 的返回值
+        weights: 与 encoded["alleles"] 对应的型别权重，默认每个型别权重为 1
+
+    返回:
+        dict: {(locus, length): {"profile": (L, 21) 频率矩阵, "expected": (L, 21) 期望距离矩阵, "weight": 总权重}}
+    """
+    alleles = encoded["alleles"]
+    sequence_ids = encoded["sequence_ids"]
+    lengths = encoded["lengths"][sequence_ids]
+    loci = np.array([a.split("*")[0] for a in alleles], dtype=object)
+    weights = np.ones(len(alleles)) if weights is None else np.asarray(weights, dtype=np.float64)
+
+    keep = weights > 0
+    frame = pd.DataFrame({"locus": loci[keep], "length": lengths[keep], "seq": sequence_ids[keep],
+                          "weight": weights[keep]})
+    # 同一条序列的权重先合并，频率谱只需在唯一序列上统计
+    frame = frame.groupby(["locus", "length", "seq"], sort=False, as_index=False)["weight"].sum()
+
+    profiles = {}
+    for (locus, length), group in frame.groupby(["locus", "length"], sort=False):
+        if length == 0:
+            continue
+        codes = encoded["residues"][group["seq"].to_numpy(), :length]
+        w = group["weight"].to_numpy()
+        flat = (np.arange(length) * N_CODES + codes).ravel()
+        profile = np.bincount(flat, weights=np.repeat(w, length), minlength=length * N_CODES)
+        profile = profile.reshape(length, N_CODES) / w.sum()
+        profiles[(locus, int(length))] = {
+            "profile": profile,
+            "expected": profile @ GRANTHAM_TABLE.T,
+            "weight": float(w.sum()),
+        }
+    return profiles
+
+
+def expected_hed(encoded, profiles, alleles):
+    """
+    计算每个型别相对同位点、同长度群体的期望 HED，返回 float64 数组；
+    型别不存在或没有对应群体时为 NaN。
+    """
+    heds = np.full(len(alleles), np.nan)
+    index = encoded["index"]
+    rows = [(k, index[a]) for k, a in enumerate(alleles) if a in index]
+    if not rows:
+        return heds
+    positions = np.array([k for k, _ in rows])
+    seq_ids = np.array([i for _, i in rows])
+    loci = np.array([alleles[k].split("*")[0] for k in positions.tolist()], dtype=object)
+    lengths = encoded["lengths"][seq_ids]
+
+    for (locus, length), entry in profiles.items():
+        mask = (loci == locus) & (lengths == length)
+        if not mask.any():
+            continue
+        codes = encoded["residues"][seq_ids[mask], :length]
+        heds[positions[mask]] = entry["expected"][np.arange(length), codes].sum(axis=1) / length
+    return heds
+
+
+# ------------------ CLI 主逻辑 ------------------
+@click.command()
+@click.option('--fasta', '-f', default="./data/hla_exon_sequences.fasta", help='包含型别氨基酸序列的 fasta 文件')
+@click.option('--cohort', '-c', default=None, help='队列 TSV（id, allele1, allele2），提供时按型别出现次数加权构建群体谱')
+@click.option('--alleles', '-a', default=None, help='只对该文件中列出的型别（每行一个）打分，默认对 fasta 中的全部型别打分')
+@click.option('--output', '-o', required=True, help='输出 TSV：allele, locus, length, population_weight, expected_HED')
+def main(fasta, cohort, alleles, output):
+    encoded = encode_allele_sequences(load_allele_sequences(fasta))
+
+    weights = None
+    if cohort:
+        weights, unknown = cohort_allele_weights(cohort, encoded["alleles"])
+        print(f"队列中共 {int(weights.sum())} 个型别拷贝用于构建群体谱")
+        if len(unknown):
+            print(f"⚠️ {len(unknown)} 个型别不在 fasta 中，已忽略（共 {int(unknown.sum())} 次）")
+    profiles = build_profiles(encoded, weights)
+
+    if alleles:
+        with open(alleles, encoding="utf-8") as f:
+            targets = [line.strip() for line in f if line.strip()]
+    else:
+        targets = list(encoded["alleles"])
+
+    heds = expected_hed(encoded, profiles, targets)
+    lengths = [int(encoded["lengths"][encoded["index"][a]]) if a in encoded["index"] else None for a in targets]
+    loci = [a.split("*")[0] for a in targets]
+    population = [profiles[(locus, length)]["weight"] if (locus, length) in profiles else 0.0
+                  for locus, length in zip(loci, lengths)]
+    pd.DataFrame({
+        "allele": targets,
+        "locus": loci,
+        "length": pd.array(lengths, dtype="Int64"),
+        "population_weight": population,
+        "expected_HED": heds,
+    }).to_csv(output, sep="\t", index=False)
+
+    n_valid = int((~np.isnan(heds)).sum())
+    print(f"✅ 计算完成，共 {n_valid} 个型别得到期望 HED，结果已写入 {output}")
+
+
+if __name__ == "__main__":
+    main()
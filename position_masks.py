@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+按位置加权的 HED：只在肽结合区（PBR）或 A-F 口袋位置上计算，或按自定义的逐位置权重计算。
+
+每个 (位点, 序列长度) 分组的掩码在一次构建后堆叠为权重矩阵 W (M, L)，并预先算好每个掩码的
+归一化系数 sum(W[m])。每块配对只查一次 Grantham 表得到逐位置距离 D (n, L)，再一次矩阵乘法
+    HED[:, m] = (D @ W.T)[:, m] / sum(W[m])
+同时得到全部掩码的结果，不需要对每个掩码、每个配对重新切片字符串。
+full 掩码（权重全为 1）与 calculate_hed 逐位一致。
+
+内置掩码（仅 class I：A/B/C）按成熟蛋白残基编号定义；hla_exon_sequences.fasta 中 class I 的
+exon2+3 序列从 2 号残基开始，因此序列下标 = 残基编号 - CLASS_I_FIRST_RESIDUE。
+    pbr               与肽接触的 α1/α2 残基（Bjorkman et al. 1987；Saper et al. 1991）
+    pocketA-pocketF   A-F 口袋残基（Saper et al. 1991）
+
+自定义权重文件为 TSV，列为 mask, locus, position, weight：position 是 fasta 序列中从 1 开始的位置，
+未列出的位置权重为 0；与内置掩码同名时覆盖该位点的内置定义。
+
+位点特异的掩码只用于同一位点的两条序列；跨位点配对（以及被多个位点共用的序列）只有 full 有结果，
+其余掩码为 NaN。掩码在某个位点上没有任何位置（如 class II 位点上的内置 pbr / 口袋掩码）时，
+该位点的结果同样为 NaN，第一次遇到时打印一次警告。
+"""
+
+import numpy as np
+import pandas as pd
+
+from compute_HED import CLASS_I_LOCI, DISTANCE_CHUNK_SIZE, GRANTHAM_TABLE
+
+CLASS_I_FIRST_RESIDUE = 2
+
+CLASS_I_POCKETS = {
+    "pocketA": (5, 7, 59, 63, 66, 159, 163, 167, 171),
+    "pocketB": (7, 9, 24, 34, 45, 63, 66, 67, 70, 99),
+    "pocketC": (9, 70, 73, 74, 97),
+    "pocketD": (99, 114, 155, 156, 159, 160),
+    "pocketE": (97, 114, 133, 147, 152, 155, 156),
+    "pocketF": (77, 80, 81, 84, 95, 116, 123, 143, 146, 147),
+}
+
+CLASS_I_PBR = (5, 7, 9, 22, 24, 45, 59, 62, 63, 65, 66, 67, 69, 70, 73, 74, 76, 77, 80, 81, 84, 95, 97, 99,
+               114, 116, 118, 123, 124, 133, 143, 146, 147, 150, 152, 155, 156, 159, 160, 163, 167, 171)
+
+BUILTIN_MASKS = ("full", "pbr") + tuple(CLASS_I_POCKETS)
+
+
+def mask_columns(masks):
+    """掩码对应的输出列名：full 仍为 HED，其余为 HED_{掩码}"""
+    return ["HED" if mask == "full" else f"HED_{mask}" for mask in masks]
+
+
+# ------------------ 掩码定义 ------------------
+def load_position_weights(path):
+    """读取自定义权重文件，返回 {(mask, locus): {从 0 开始的序列下标: 权重}}"""
+    df = pd.read_csv(path, sep="\t", dtype={"mask": str, "locus": str})
+    missing = {"mask", "locus", "position", "weight"} - set(df.columns)
+    if missing:
+        raise ValueError(f"权重文件缺少列: {', '.join(sorted(missing))}")
+    if (df["position"] < 1).any():
+        raise ValueError("权重文件中的 position 应从 1 开始")
+    weights = {}
+    for row in df.itertuples(index=False):
+        weights.setdefault((row.mask, row.locus), {})[int(row.position) - 1] = float(row.weight)
+    return weights
+
+
+def _builtin_weights(mask, locus, length):
+    w = np.zeros(length)
+    if mask == "full":
+        w[:] = 1.0
+        return w
+    if locus not in CLASS_I_LOCI:
+        return w
+    residues = CLASS_I_PBR if mask == "pbr" else CLASS_I_POCKETS[mask]
+    positions = np.array(residues) - CLASS_I_FIRST_RESIDUE
+    w[positions[positions < length]] = 1.0
+    return w
+
+
+def build_mask_matrix(masks, locus, length, custom=None):
+    """
+    构建一个 (位点, 长度) 分组的权重矩阵 W (len(masks), length) 与归一化系数 sum(W, axis=1)。
+    该分组没有定义的掩码权重全为 0，归一化系数为 0，对应结果为 NaN；locus 为 None 表示跨位点配对。
+    """
+    custom = custom or {}
+    W = np.zeros((len(masks), length))
+    for m, mask in enumerate(masks):
+        if locus is None:
+            # 跨位点配对：只保留与位点无关的 full
+            if mask == "full":
+                W[m] = 1.0
+        elif (mask, locus) in custom:
+            for position, weight in custom[(mask, locus)].items():
+                if position < length:
+                    W[m, position] = weight
+        elif mask in BUILTIN_MASKS:
+            W[m] = _builtin_weights(mask, locus, length)
+    return W, W.sum(axis=1)
+
+
+def sequence_loci(encoded):
+    """每条唯一序列的位点；被多个位点的型别共用的序列（如个别 DRB1/DRB3）位点不确定，记为空字符串"""
+    frame = pd.DataFrame({"seq": encoded["sequence_ids"],
+                          "locus": [a.split("*")[0] for a in encoded["alleles"]]})
+    loci = frame.groupby("seq")["locus"].agg(lambda x: x.iloc[0] if x.nunique() == 1 else "")
+    out = np.full(len(encoded["lengths"]), "", dtype=object)
+    out[loci.index.to_numpy()] = loci.to_numpy()
+    return out
+
+
+# ------------------ 加权 HED ------------------
+class MaskedHed:
+    """
+    一组掩码在所有 (位点, 长度) 分组上的权重矩阵，按需构建并缓存。
+    calculate(idx1, idx2) 对唯一序列行号逐对计算，返回 (n, len(masks))。
+    """
+
+    def __init__(self, encoded, masks, custom=None, chunk_size=DISTANCE_CHUNK_SIZE):
+        self.encoded = encoded
+        self.masks = list(masks)
+        self.custom = custom
+        known = set(BUILTIN_MASKS) | {mask for mask, _ in (custom or {})}
+        unknown = [mask for mask in self.masks if mask not in known]
+        if unknown:
+            raise ValueError(f"未知的位置掩码: {', '.join(unknown)}（可选: {', '.join(sorted(known))}）")
+        self.chunk_size = chunk_size
+        self.loci = sequence_loci(encoded)
+        self._matrices = {}
+        self._warned = set()
+
+    def matrix(self, locus, length):
+        key = (locus, length)
+        if key not in self._matrices:
+            W, norms = build_mask_matrix(self.masks, locus, length, self.custom)
+            self._matrices[key] = (W.T.copy(), np.where(norms != 0, norms, np.nan))
+            if locus is not None:
+                self._warn_uncovered(locus, norms)
+        return self._matrices[key]
+
+    def _warn_uncovered(self, locus, norms):
+        """每个 (掩码, 位点) 只警告一次：该位点上没有定义任何位置的掩码，结果全为 NaN"""
+        for mask, norm in zip(self.masks, norms):
+            if norm == 0 and (mask, locus) not in self._warned:
+                self._warned.add((mask, locus))
+                print(f"⚠️ 位置掩码 {mask} 在 {locus} 位点上没有定义任何位置，"
+                      f"该位点的 {mask_columns([mask])[0]} 为 NaN")
+
+    def calculate(self, idx1, idx2):
+        residues, lengths = self.encoded["residues"], self.encoded["lengths"]
+        out = np.full((len(idx1), len(self.masks)), np.nan)
+        valid = (lengths[idx1] == lengths[idx2]) & (lengths[idx1] > 0)
+        rows = np.flatnonzero(valid)
+        if not len(rows):
+            return out
+
+        # 按 (位点, 长度) 分组，每组共用一个权重矩阵；跨位点配对的位点记为空字符串
+        loci1, loci2 = self.loci[idx1[rows]], self.loci[idx2[rows]]
+        groups = pd.DataFrame({"locus": np.where(loci1 == loci2, loci1, ""), "length": lengths[idx1[rows]]})
+        for (locus, length), positions in groups.groupby(["locus", "length"], sort=False).indices.items():
+            weights_t, norms = self.matrix(locus or None, int(length))
+            group_rows = rows[positions]
+            for start in range(0, len(group_rows), self.chunk_size):
+                chunk = group_rows[start:start + self.chunk_size]
+                r1, r2 = idx1[chunk], idx2[chunk]
+                d = GRANTHAM_TABLE[residues[r1, :length], residues[r2, :length]].astype(np.float64)
+                out[chunk] = (d @ weights_t) / norms
+        return out
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+型别氨基酸序列的二进制索引存储。
+
+首次使用时由 fasta 编译为一个 .hedstore 文件，之后以 mmap 方式加载，不依赖 Biopython
+（本模块只使用标准库）。文件布局：
+
+    MAGIC (8 字节) | header 长度 (uint64) | JSON header (8 字节对齐)
+    | offsets (int64 x (n+1)) | lengths (int32 x n) | 残基缓冲区 (ASCII)
+
+header 中记录来源 fasta 的大小、mtime 和 sha256，fasta 变化后自动重新编译；
+同时记录每个型别的唯一序列编号（外显子蛋白序列完全相同的型别共用一个编号）。
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections.abc import Mapping
+
+MAGIC = b"HEDSTOR2"
+STORE_SUFFIX = ".hedstore"
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def default_store_path(fasta_path):
+    return os.path.splitext(fasta_path)[0] + STORE_SUFFIX
+
+
+def _pad8(n):
+    return (8 - n % 8) % 8
+
+
+def _native_little_endian(arr):
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr
+
+
+# ------------------ 存储对象 ------------------
+class SequenceStore(Mapping):
+    """
+    只读的 {allele: seq} 映射，可直接替代 load_allele_sequences 返回的 dict。
+
+    除 Mapping 接口外还提供：
+        alleles / classes / loci: 与行号对应的型别名、class（"I"/"II"）与位点
+        index: {allele: 行号}
+        sequence_ids: 每个型别的唯一序列编号（按首次出现的顺序编号，0..n_sequences-1）
+        offsets / lengths: 每个型别在残基缓冲区中的位置
+        residue_buffer(): 所有序列首尾相接的连续 ASCII 缓冲区（memoryview）
+    """
+
+    def __init__(self, buffer, path=None):
+        if bytes(buffer[:8]) != MAGIC:
+            raise ValueError(f"{path or 'buffer'} 不是有效的序列存储文件")
+        (header_len,) = struct.unpack_from("<Q", buffer, 8)
+        pos = 16
+        header = json.loads(bytes(buffer[pos:pos + header_len]).decode("utf-8"))
+        pos += header_len + _pad8(header_len)
+
+        n = len(header["alleles"])
+        self.path = path
+        self.source = header["source"]
+        self.alleles = header["alleles"]
+        self.classes = header["classes"]
+        self.loci = [a.split("*")[0] for a in self.alleles]
+        self.index = {a: i for i, a in enumerate(self.alleles)}
+        self.sequence_ids = header["sequence_ids"]
+        self.n_sequences = max(self.sequence_ids, default=-1) + 1
+
+        self.offsets = _native_little_endian(array("q", bytes(buffer[pos:pos + 8 * (n + 1)])))
+        pos += 8 * (n + 1)
+        self.lengths = _native_little_endian(array("i", bytes(buffer[pos:pos + 4 * n])))
+        pos += 4 * n + _pad8(4 * n)
+        self._residues = memoryview(buffer)[pos:pos + self.offsets[n]]
+        self._buffer = buffer
+
+    def residue_buffer(self):
+        return self._residues
+
+    def __getitem__(self, allele):
+        i = self.index[allele]
+        return bytes(self._residues[self.offsets[i]:self.offsets[i + 1]]).decode("ascii")
+
+    def __contains__(self, allele):
+        return allele in self.index
+
+    def __iter__(self):
+        return iter(self.alleles)
+
+    def __len__(self):
+        return len(self.alleles)
+
+
+# ------------------ 编译 ------------------
+def read_fasta_records(fasta_path):
+    """逐条读取 fasta，产出 (allele, class, seq)；class 取自描述中的 class_I / class_II"""
+    allele = cls = None
+    seq_lines = []
+    with open(fasta_path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith(">"):
+                if allele is not None:
+                    yield allele, cls, "".join(seq_lines)
+                fields = line[1:].split()
+                allele = fields[0]
+                cls = next((x[len("class_"):] for x in fields[1:] if x.startswith("class_")), "")
+                seq_lines = []
+            elif allele is not None:
+                seq_lines.append(line.replace(" ", ""))
+    if allele is not None:
+        yield allele, cls, "".join(seq_lines)
+
+
+def compile_sequence_store(fasta_path):
+    """将 fasta 编译为序列存储的字节内容"""
+    records = {}
+    for allele, cls, seq in read_fasta_records(fasta_path):
+        records[allele] = (cls, seq)  # 与 dict 赋值一致：重复 ID 以最后一条为准
+
+    alleles = list(records)
+    sequence_ids = {}
+    for allele in alleles:
+        sequence_ids.setdefault(records[allele][1], len(sequence_ids))
+    st = os.stat(fasta_path)
+    header = json.dumps({
+        "source": {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": file_sha256(fasta_path)},
+        "alleles": alleles,
+        "classes": [records[a][0] for a in alleles],
+        "sequence_ids": [sequence_ids[records[a][1]] for a in alleles],
+    }, ensure_ascii=False).encode("utf-8")
+
+    residues = "".join(records[a][1] for a in alleles).encode("ascii")
+    lengths = array("i", (len(records[a][1]) for a in alleles))
+    offsets = array("q", [0])
+    for length in lengths:
+        offsets.append(offsets[-1] + length)
+
+    parts = [MAGIC, struct.pack("<Q", len(header)), header, b"\0" * _pad8(len(header)),
+             _native_little_endian(offsets).tobytes(), _native_little_endian(lengths).tobytes(),
+             b"\0" * _pad8(4 * len(lengths)), residues]
+    return b"".join(parts)
+
+
+def _store_is_fresh(store, fasta_path):
+    st = os.stat(fasta_path)
+    source = store.source
+    if source["size"] == st.st_size and source["mtime_ns"] == st.st_mtime_ns:
+        return True
+    return source["size"] == st.st_size and source["sha256"] == file_sha256(fasta_path)
+
+
+def _open_store(store_path):
+    with open(store_path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return SequenceStore(buffer, store_path)
+
+
+def load_sequence_store(fasta_path, store_path=None):
+    """
+    加载 fasta 对应的序列存储；不存在或来源 fasta 已变化时自动重新编译。
+    存储目录不可写时退化为内存中的存储。
+    """
+    store_path = store_path or default_store_path(fasta_path)
+    if os.path.exists(store_path):
+        try:
+            store = _open_store(store_path)
+            if not os.path.exists(fasta_path) or _store_is_fresh(store, fasta_path):
+                return store
+        except (ValueError, KeyError, struct.error):
+            pass  # 文件损坏或格式过旧，重新编译
+
+    blob = compile_sequence_store(fasta_path)
+    tmp_path = f"{store_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(blob)
+        os.replace(tmp_path, store_path)
+    except OSError:
+        return SequenceStore(blob)
+    return _open_store(store_path)
+
+
+def main():
+    fasta_path = sys.argv[1] if len(sys.argv) > 1 else "./data/hla_exon_sequences.fasta"
+    store = load_sequence_store(fasta_path)
+    print(f"✅ {store.path or '内存存储'}: {len(store)} 个型别, {store.n_sequences} 条唯一序列")
+
+
+if __name__ == "__main__":
+    main()
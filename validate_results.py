@@ -1,50 +1,190 @@
-def validate_exon_matches(output_fasta, positive_fasta):
-    from collections import defaultdict
-
-    def read_fasta(fasta_path, strip_class_info=False):
-        seqs = defaultdict(str)
-        current_id = None
-        with open(fasta_path, encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
-                if line.startswith(">"):
-                    current_id = line[1:].strip()
-                    if current_id.endswith("N"):
-                        current_id = None  # 跳过 null allele 型别
-
-                    if strip_class_info:
-                        current_id = current_id.split()[0]  # 去掉 class_I
-                elif current_id:
-                    seqs[current_id] += line
-        return seqs
-
-    # 读取两个 fasta 文件，output_fasta 需 strip class info
-    output_seqs = read_fasta(output_fasta, strip_class_info=True)
-    positive_seqs = read_fasta(positive_fasta)
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+校验 / 比较两个 exon 氨基酸序列 fasta（如本仓库输出与文献的 ABC_prot.fa，或两次重新生成的
+hla_exon_sequences.fasta）。
+
+两个文件都流式读取，每条序列计算 sha1 摘要并建立 {型别: 摘要} 与 {摘要: 型别} 的哈希索引：
+    - 双向比较：参考中缺失的型别（missing）、输出中多出的型别（extra）、序列不一致的型别（mismatched），
+      整体 O(n)，只有摘要不同的型别才逐残基比较；
+    - 序列不一致时用 numpy 向量化比较残基，给出每个不同位置（从 1 开始）及两边的残基；
+    - 缺失的型别若在输出中以其他名称存在相同序列（如 A*26:166Q / A*26:166），在 same_sequence_as 中给出。
+extra 只统计参考中出现过的位点（参考只有 A/B/C 时不把 class II 型别算作多出）。
+null（N 结尾）型别不表达，两边都跳过。
+
+结果可写为 JSON 报告；--fail-on-diff 时存在缺失或不一致（--strict 时还包括多出）的型别即以状态码 1 退出，
+用于把关每次重新生成的 hla_exon_sequences.fasta。
+
+    python validate_results.py
+    python validate_results.py -o new.fasta -r old.fasta --report diff.json --fail-on-diff
+"""
+
+import hashlib
+import json
+
+import click
+import numpy as np
+
+from seq_store import file_sha256, read_fasta_records
+
+
+# ------------------ 读取与索引 ------------------
+def sequence_digest(seq):
+    return hashlib.sha1(seq.encode("ascii")).hexdigest()
+
+
+def index_fasta(fasta_path):
+    """
+    流式读取 fasta，返回 (seqs, digests)：{型别: 序列}、{型别: 摘要}。
+    型别名取描述行第一个字段（去掉 class_I 等信息），跳过 N 结尾的 null 型别；重复 ID 以最后一条为准。
+    """
+    seqs, digests = {}, {}
+    for allele, _, seq in read_fasta_records(fasta_path):
+        if allele.endswith("N"):
+            continue
+        seqs[allele] = seq
+        digests[allele] = sequence_digest(seq)
+    return seqs, digests
+
+
+def _locus(allele):
+    return allele.split("*")[0]
+
+
+# ------------------ 逐残基比较 ------------------
+def mismatch_positions(reference_seq, output_seq):
+    """
+    向量化比较两条序列，返回 [(位置, 参考残基, 输出残基)]，位置从 1 开始；
+    长度不同时只比较共同前缀，多出的部分由调用方按长度报告。
+    """
+    a = np.frombuffer(reference_seq.encode("ascii"), dtype=np.uint8)
+    b = np.frombuffer(output_seq.encode("ascii"), dtype=np.uint8)
+    n = min(len(a), len(b))
+    diff = np.flatnonzero(a[:n] != b[:n])
+    return [(int(i) + 1, reference_seq[i], output_seq[i]) for i in diff.tolist()]
+
+
+# ------------------ 双向比较 ------------------
+def diff_fasta_sets(output_fasta, reference_fasta):
+    """比较输出与参考，返回可直接写为 JSON 的报告 dict"""
+    output_seqs, output_digests = index_fasta(output_fasta)
+    reference_seqs, reference_digests = index_fasta(reference_fasta)
+
+    by_digest = {}
+    for allele, digest in output_digests.items():
+        by_digest.setdefault(digest, []).append(allele)
 
     matched = 0
-    missing = []
-    mismatched = []
-
-    for allele, pos_seq in positive_seqs.items():
-        if allele not in output_seqs:
-            missing.append(allele)
-        elif output_seqs[allele] != pos_seq:
-            mismatched.append(allele)
+    missing, mismatched = [], []
+    for allele, digest in reference_digests.items():
+        if allele not in output_digests:
+            missing.append({"allele": allele, "same_sequence_as": by_digest.get(digest, [])})
+        elif output_digests[allele] != digest:
+            ref_seq, out_seq = reference_seqs[allele], output_seqs[allele]
+            positions = mismatch_positions(ref_seq, out_seq)
+            mismatched.append({
+                "allele": allele,
+                "reference_length": len(ref_seq),
+                "output_length": len(out_seq),
+                "n_differences": len(positions) + abs(len(ref_seq) - len(out_seq)),
+                "positions": [{"position": p, "reference": r, "output": o} for p, r, o in positions],
+            })
         else:
             matched += 1
-            print(f"✅ 匹配成功: {allele}")
 
-    # 总结输出
-    print(f"\n总计阳性型别: {len(positive_seqs)}")
-    print(f"  - 匹配成功: {matched}")
-    print(f"  - 缺失: {len(missing)}")
-    print(f"  - 序列不一致: {len(mismatched)}")
+    reference_loci = {_locus(allele) for allele in reference_digests}
+    extra = [allele for allele in output_digests
+             if allele not in reference_digests and _locus(allele) in reference_loci]
+
+    return {
+        "output": {"path": output_fasta, "sha256": file_sha256(output_fasta), "alleles": len(output_digests)},
+        "reference": {"path": reference_fasta, "sha256": file_sha256(reference_fasta),
+                      "alleles": len(reference_digests)},
+        "counts": {"matched": matched, "missing": len(missing), "extra": len(extra),
+                   "mismatched": len(mismatched)},
+        "missing": missing,
+        "extra": extra,
+        "mismatched": mismatched,
+    }
+
+
+def gate_failures(report, ignore=(), strict=False):
+    """返回需要把关的差异型别（已排除 ignore 中的型别）"""
+    ignore = set(ignore)
+    failures = [m["allele"] for m in report["missing"]] + [m["allele"] for m in report["mismatched"]]
+    if strict:
+        failures += report["extra"]
+    return [allele for allele in failures if allele not in ignore]
+
+
+def print_report(report, limit=20):
+    counts = report["counts"]
+    print(f"总计阳性型别: {report['reference']['alleles']}")
+    print(f"  - 匹配成功: {counts['matched']}")
+    print(f"  - 缺失: {counts['missing']}")
+    print(f"  - 序列不一致: {counts['mismatched']}")
+    print(f"  - 输出中多出（同位点）: {counts['extra']}")
+
+    if report["missing"]:
+        names = []
+        for m in report["missing"]:
+            same = m["same_sequence_as"]
+            if same:
+                more = f" 等 {len(same)} 个" if len(same) > 3 else ""
+                names.append(f"{m['allele']} (序列同 {', '.join(same[:3])}{more})")
+            else:
+                names.append(m["allele"])
+        print("❌ 缺失型别:", ", ".join(names))
+    for m in report["mismatched"][:limit]:
+        shown = ", ".join(f"{p['position']}{p['reference']}>{p['output']}" for p in m["positions"][:10])
+        more = " ..." if len(m["positions"]) > 10 else ""
+        if m["reference_length"] != m["output_length"]:
+            more += f"{'; ' if shown else ''}长度相差 {abs(m['reference_length'] - m['output_length'])}"
+        print(f"⚠️ 序列不一致: {m['allele']} 长度 {m['reference_length']} / {m['output_length']}，"
+              f"{m['n_differences']} 处不同: {shown}{more}")
+    if len(report["mismatched"]) > limit:
+        print(f"  ... 另有 {len(report['mismatched']) - limit} 个序列不一致型别")
+    if report["extra"]:
+        extra = report["extra"]
+        print(f"ℹ️ 输出中多出的型别: {', '.join(extra[:limit])}" + (" ..." if len(extra) > limit else ""))
+
+
+def validate_exon_matches(output_fasta, positive_fasta):
+    """比较输出与阳性参考并打印汇总，返回报告 dict"""
+    report = diff_fasta_sets(output_fasta, positive_fasta)
+    print_report(report)
+    return report
+
+
+@click.command()
+@click.option('--output-fasta', '-o', default="./data/hla_exon_sequences.fasta", show_default=True,
+              help='待校验的 exon 氨基酸序列 fasta（如新生成的版本）')
+@click.option('--reference', '-r', default="./data/ABC_prot.fa", show_default=True,
+              help='参考 fasta（文献序列或上一版输出）')
+@click.option('--report', default=None, help='将完整比较结果写入 JSON 报告')
+@click.option('--fail-on-diff', is_flag=True, help='存在缺失或序列不一致的型别时以状态码 1 退出')
+@click.option('--strict', is_flag=True, help='与 --fail-on-diff 一起使用：输出中多出的同位点型别也视为差异')
+@click.option('--ignore', 'ignore_path', default=None, help='已知差异的型别列表文件（每行一个），不参与把关')
+def main(output_fasta, reference, report, fail_on_diff, strict, ignore_path):
+    result = validate_exon_matches(output_fasta, reference)
+
+    ignore = []
+    if ignore_path:
+        with open(ignore_path, encoding="utf-8") as f:
+            ignore = [line.strip() for line in f if line.strip()]
+    failures = gate_failures(result, ignore, strict)
+    result["gate"] = {"strict": strict, "ignored": ignore, "failures": failures, "passed": not failures}
+
+    if report:
+        with open(report, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"报告已写入 {report}")
+    if fail_on_diff:
+        if failures:
+            print(f"❌ 校验未通过: {len(failures)} 个型别存在差异")
+            raise SystemExit(1)
+        print("✅ 校验通过")
 
-    if missing:
-        print("❌ 缺失型别:", ", ".join(missing))
-    if mismatched:
-        print("⚠️ 序列不一致型别:", ", ".join(mismatched))
 
 if __name__ == "__main__":
-    validate_exon_matches("./data/hla_exon_sequences.fasta", "./data/ABC_prot.fa")
+    main()